@@ -6,10 +6,30 @@ manage one or more wikifarms of containers for sql/xml dump tests
 import os
 import sys
 import getopt
+import bisect
+import contextlib
+import cProfile
+import fcntl
+import functools
+import glob
+import hashlib
+import io
+import json
+import shlex
+import shutil
+import socket
+import struct
+import subprocess
+import tarfile
+import threading
+import time
+import collections
+import concurrent.futures
 import yaml
 from docker import DockerClient
 import docker
 import netaddr
+from docker_helpers.dump_index import ChunkReader, DumpIndex, find_import_files
 
 
 class ContainerLabels():
@@ -42,6 +62,14 @@ class ContainerLabels():
                 return False
         return True
 
+    @staticmethod
+    def get_label_filters(labels):
+        '''
+        turn a dict of labels into the list of key=value strings the docker
+        api wants as a 'label' filter, so the daemon does the selection for us
+        '''
+        return [key + '=' + value for key, value in labels.items()]
+
     @staticmethod
     def has_labels(labels, labels_wanted):
         '''check that the one bleep of labels has all the other ones in it'''
@@ -51,12 +79,431 @@ class ContainerLabels():
         return True
 
 
+class Tracer():
+    '''
+    record timed spans of work (a config load, an image build, a build step,
+    a container start, the import of a dump file inside a build), each with
+    a name, start and end times and whatever fields are handy, such as the set,
+    the image or the number of bytes handled
+
+    spans may come from any thread; scripts running in an image build report
+    theirs by printing a line starting with PREFIX followed by the span as json,
+    which the build log hands to us. times are seconds since the epoch, so
+    spans from inside a build line up with ours.
+
+    nothing is recorded unless enabled is set; the spans can be shown as a
+    summary, or written out as json or in the chrome trace event format
+    (load it in chrome://tracing or https://ui.perfetto.dev)
+    '''
+    PREFIX = 'atg-trace: '
+    FORMATS = ['summary', 'json', 'chrome']
+
+    def __init__(self, clock=time.time):
+        self.enabled = False
+        self.clock = clock
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end, **fields):
+        '''record one span, if we are recording'''
+        if not self.enabled:
+            return
+        span = {'name': name, 'start': start, 'end': end,
+                'thread': threading.current_thread().name}
+        span.update({key: value for key, value in fields.items() if value is not None})
+        with self.lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        '''
+        record a span for the code in the with block; the fields dict is handed
+        back so that things like byte counts can be added along the way
+        '''
+        start = self.clock()
+        try:
+            yield fields
+        except BaseException:
+            fields['failed'] = True
+            raise
+        finally:
+            self.add(name, start, self.clock(), **fields)
+
+    def add_from_line(self, line, **fields):
+        '''
+        record the span in a line of output from a script in an image build,
+        adding the given fields; return False if the line has no span in it
+        '''
+        if not line.startswith(self.PREFIX):
+            return False
+        try:
+            span = json.loads(line[len(self.PREFIX):])
+        except ValueError:
+            return False
+        span.update(fields)
+        self.add(span.pop('name'), span.pop('start'), span.pop('end'), **span)
+        return True
+
+    def get_summary(self):
+        '''
+        return a list of (name, count, total seconds, longest seconds) for
+        the spans, in order of first appearance
+        '''
+        summary = {}
+        for span in sorted(self.spans, key=lambda entry: entry['start']):
+            elapsed = span['end'] - span['start']
+            count, total, longest = summary.get(span['name'], (0, 0, 0))
+            summary[span['name']] = (count + 1, total + elapsed, max(longest, elapsed))
+        return [(name,) + values for name, values in summary.items()]
+
+    def show_summary(self):
+        '''display the number of spans and time spent for each kind of span'''
+        summary = self.get_summary()
+        if not summary:
+            return
+        padding = max(len(entry[0]) for entry in summary)
+        print("timings (summed over threads):")
+        for name, count, total, longest in summary:
+            print("  {name} {count:>5}x {total:>9.2f}s total {longest:>9.2f}s longest".format(
+                name=name.ljust(padding), count=count, total=total, longest=longest))
+
+    def get_chrome_events(self):
+        '''return the spans as a list of chrome trace events, one track per thread'''
+        events = []
+        if not self.spans:
+            return events
+        origin = min(span['start'] for span in self.spans)
+        thread_ids = {}
+        for span in sorted(self.spans, key=lambda entry: entry['start']):
+            if span['thread'] not in thread_ids:
+                thread_ids[span['thread']] = len(thread_ids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': thread_ids[span['thread']],
+                               'args': {'name': span['thread']}})
+            events.append({
+                'name': span['name'], 'cat': 'atgdumps', 'ph': 'X', 'pid': 1,
+                'tid': thread_ids[span['thread']],
+                'ts': round((span['start'] - origin) * 1000000),
+                'dur': round((span['end'] - span['start']) * 1000000),
+                'args': {key: value for key, value in span.items()
+                         if key not in ['name', 'start', 'end', 'thread']}})
+        return events
+
+    def report(self, fmt, path=None):
+        '''show the summary, or write the spans in the given format to the file'''
+        if fmt == 'summary':
+            self.show_summary()
+            return
+        if fmt == 'json':
+            contents = {'spans': sorted(self.spans, key=lambda entry: entry['start'])}
+        else:
+            contents = {'traceEvents': self.get_chrome_events(), 'displayTimeUnit': 'ms'}
+        with open(path, "w") as fhandle:
+            json.dump(contents, fhandle)
+        print("trace with {count} spans written to {path}".format(
+            count=len(self.spans), path=path))
+
+
+# everyone records to this one; it is turned on from the command line
+TRACER = Tracer()
+
+
+class DockerInventory():
+    '''
+    hold one long-lived docker client for the whole command, along with a
+    snapshot of the images, containers and networks on the host that
+    carry our blame label
+
+    the daemon does the label filtering, so the cost of loading the
+    snapshot scales with the size of our testbed and not with everything
+    else on the host. the snapshot is loaded from the daemon the first time it is needed,
+    updated in place as we create and remove things, and only reloaded
+    if someone calls invalidate(); this way checking whether an image
+    or container exists is a dict lookup rather than a trip to the daemon
+    '''
+    def __init__(self, args, base_url='unix://var/run/docker.sock', pool_size=10):
+        self.verbose = args['verbose']
+        # builds and container operations may run in several threads, each
+        # wanting its own connection to the daemon
+        self.client = DockerClient(base_url=base_url, max_pool_size=pool_size)
+        self.label_filters = ContainerLabels.get_label_filters(ContainerLabels.get_blame_label())
+        # those threads share the snapshot, so it is only ever loaded, changed or
+        # thrown away while holding this; a list is loaded in full before anyone
+        # can see it, so no thread is ever handed one that is half filled in
+        self.lock = threading.Lock()
+        # tag -> image
+        self.images = None
+        # name -> container, short id -> container
+        self.containers = None
+        self.containers_by_id = None
+        # name -> network
+        self.networks = None
+
+    def invalidate(self, what=None):
+        '''
+        throw away the cached info about images, containers or networks,
+        or all of them if nothing is specified; it will be reloaded from
+        the daemon on next use
+        '''
+        with self.lock:
+            if what in [None, 'images']:
+                self.images = None
+            if what in [None, 'containers']:
+                self.containers = None
+                self.containers_by_id = None
+            if what in [None, 'networks']:
+                self.networks = None
+
+    def load_images(self):
+        '''
+        get the list of images from the daemon if we don't have it already,
+        and return the images by tag
+        '''
+        with self.lock:
+            if self.images is None:
+                if self.verbose:
+                    print("loading image list")
+                images = {}
+                # intermediate and dangling images are of no interest to anyone
+                for entry in self.client.images.list(filters={'label': self.label_filters,
+                                                              'dangling': False}):
+                    for tag in entry.tags:
+                        images[tag] = entry
+                self.images = images
+            return self.images
+
+    def load_containers(self):
+        '''
+        get the list of containers from the daemon if we don't have it already,
+        and return the containers by name and by short id
+        '''
+        with self.lock:
+            if self.containers is None:
+                if self.verbose:
+                    print("loading container list")
+                containers = {}
+                containers_by_id = {}
+                for entry in self.client.containers.list(all=True,
+                                                         filters={'label': self.label_filters}):
+                    containers[entry.name] = entry
+                    containers_by_id[entry.short_id] = entry
+                self.containers = containers
+                self.containers_by_id = containers_by_id
+            return self.containers, self.containers_by_id
+
+    def load_networks(self):
+        '''
+        get the list of networks from the daemon if we don't have it already,
+        and return the networks by name
+        '''
+        with self.lock:
+            if self.networks is None:
+                if self.verbose:
+                    print("loading network list")
+                networks = {}
+                for entry in self.client.networks.list(filters={'label': self.label_filters}):
+                    networks[entry.name] = entry
+                self.networks = networks
+            return self.networks
+
+    def get_images(self):
+        '''return a list of all known images, each one once'''
+        images = self.load_images()
+        seen = {}
+        with self.lock:
+            for entry in images.values():
+                seen[entry.id] = entry
+        return list(seen.values())
+
+    def get_image(self, tag):
+        '''return the image with the given tag, or None'''
+        return self.load_images().get(tag)
+
+    def add_image(self, image):
+        '''add a newly built or newly listed image to the inventory'''
+        with self.lock:
+            if self.images is None:
+                # we'll pick it up when we load everything
+                return
+            for tag in image.tags:
+                self.images[tag] = image
+
+    def remove_image(self, tag):
+        '''remove the image with the given tag from the host and from the inventory'''
+        self.client.images.remove(tag)
+        with self.lock:
+            if self.images is not None:
+                self.images.pop(tag, None)
+
+    def get_containers(self, labels=None):
+        '''return a list of all known containers, or those with all the given labels'''
+        containers, _by_id = self.load_containers()
+        with self.lock:
+            entries = list(containers.values())
+        if not labels:
+            return entries
+        return [entry for entry in entries if ContainerLabels.has_labels(entry.labels, labels)]
+
+    def get_container(self, name_or_id):
+        '''return the container with the given name or short id, or None'''
+        containers, containers_by_id = self.load_containers()
+        if name_or_id in containers:
+            return containers[name_or_id]
+        return containers_by_id.get(name_or_id)
+
+    def add_container(self, container):
+        '''add a newly created or newly listed container to the inventory'''
+        with self.lock:
+            if self.containers is None:
+                return
+            self.containers[container.name] = container
+            self.containers_by_id[container.short_id] = container
+
+    def remove_container(self, container):
+        '''remove the container from the host and from the inventory'''
+        container.remove()
+        with self.lock:
+            if self.containers is not None:
+                self.containers.pop(container.name, None)
+                self.containers_by_id.pop(container.short_id, None)
+
+    def get_networks(self, labels=None):
+        '''return a list of all known networks, or those with all the given labels'''
+        networks = self.load_networks()
+        with self.lock:
+            entries = list(networks.values())
+        if not labels:
+            return entries
+        return [entry for entry in entries
+                if ContainerLabels.has_labels(entry.attrs['Labels'], labels)]
+
+    def get_subnets_in_use(self):
+        '''
+        return the list of subnets used by every network on the host, ours or not;
+        this one can't be narrowed down by label, since any network's address space
+        is off limits to us, so it is not cached either
+        '''
+        subnets = []
+        for entry in self.client.api.networks():
+            for settings in (entry.get('IPAM') or {}).get('Config') or []:
+                if 'Subnet' in settings:
+                    subnets.append(settings['Subnet'])
+        return subnets
+
+    def get_network(self, name):
+        '''return the network with the given name, or None'''
+        return self.load_networks().get(name)
+
+    def add_network(self, network):
+        '''add a newly created or newly listed network to the inventory'''
+        with self.lock:
+            if self.networks is None:
+                return
+            self.networks[network.name] = network
+
+    def remove_network(self, network):
+        '''remove the network from the host and from the inventory'''
+        network.remove()
+        with self.lock:
+            if self.networks is not None and self.networks.get(network.name) is network:
+                del self.networks[network.name]
+
+
+class SubnetAllocator():
+    '''
+    pick free subnets for set networks out of an address pool, first fit,
+    given the subnets in use on the host by any network at all
+    '''
+    DEFAULT_POOL = '172.16.0.0/12'
+    DEFAULT_PREFIXLEN = 24
+    DEFAULT_LOCKFILE = '/tmp/docker-dumps-testbed-networks.lock'
+
+    def __init__(self, pool=None, prefixlen=None, verbose=False):
+        self.pool = netaddr.IPNetwork(pool or self.DEFAULT_POOL)
+        self.prefixlen = prefixlen or self.DEFAULT_PREFIXLEN
+        width = 32 if self.pool.version == 4 else 128
+        if self.prefixlen < self.pool.prefixlen or self.prefixlen > width:
+            raise ValueError("Subnet prefix length {plen} does not fit in pool {pool}".format(
+                plen=self.prefixlen, pool=self.pool))
+        self.blocksize = 2 ** (width - self.prefixlen)
+        self.verbose = verbose
+
+    def get_index(self, subnets):
+        '''
+        given a list of subnets in cidr notation, return the sorted list of starts
+        and the list of corresponding ends of the address ranges they cover within
+        our pool, with overlapping or adjacent ranges merged
+        '''
+        ranges = []
+        for subnet in subnets:
+            network = netaddr.IPNetwork(subnet)
+            if network.version != self.pool.version:
+                continue
+            if network.last < self.pool.first or network.first > self.pool.last:
+                continue
+            ranges.append((network.first, network.last))
+        ranges.sort()
+
+        starts = []
+        ends = []
+        for first, last in ranges:
+            if ends and first <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], last)
+            else:
+                starts.append(first)
+                ends.append(last)
+        return starts, ends
+
+    def align(self, address):
+        '''return the first block boundary at or after the address'''
+        offset = (address - self.pool.first) % self.blocksize
+        return address + self.blocksize - offset if offset else address
+
+    def pick(self, subnets):
+        '''
+        given the subnets in use, return the first free block of our prefix length
+        in the pool as an IPNetwork, or None if the pool is full
+
+        each candidate block is checked against the used ranges with a binary search;
+        on a collision we skip straight past the range it hit
+        '''
+        starts, ends = self.get_index(subnets)
+        candidate = self.pool.first
+        while candidate + self.blocksize - 1 <= self.pool.last:
+            index = bisect.bisect_right(starts, candidate + self.blocksize - 1) - 1
+            if index < 0 or ends[index] < candidate:
+                return netaddr.IPNetwork("{addr}/{plen}".format(
+                    addr=netaddr.IPAddress(candidate, self.pool.version), plen=self.prefixlen))
+            candidate = self.align(ends[index] + 1)
+        return None
+
+    @staticmethod
+    @contextlib.contextmanager
+    def locked(lockpath):
+        '''
+        hold an exclusive lock on the given file for the duration, so that two
+        of us running on the same host don't hand out the same subnet
+        '''
+        with open(lockpath, "a") as fhandle:
+            with TRACER.span('network lock wait'):
+                fcntl.flock(fhandle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fhandle, fcntl.LOCK_UN)
+
+
 class Networks():
     '''manage various aspects of container set networks'''
-    def __init__(self, args, labeler):
+    def __init__(self, args, config, labeler, inventory):
         self.args = args
         self.verbose = args['verbose']
         self.labeler = labeler
+        self.inventory = inventory
+        settings = config.config
+        self.allocator = SubnetAllocator(settings.get('network_pool'),
+                                         settings.get('network_prefixlen'), self.verbose)
+        self.lockpath = settings.get('network_lockfile', SubnetAllocator.DEFAULT_LOCKFILE)
 
     def get_network_name(self):
         '''
@@ -65,59 +512,59 @@ class Networks():
         '''
         return self.args['set'] + ".lan"
 
+    def network_exists(self):
+        '''return True if the network for the set exists already'''
+        entry = self.inventory.get_network(self.get_network_name())
+        return bool(entry and self.labeler.has_labels(entry.attrs['Labels'],
+                                                      self.labeler.get_set_label()))
+
     def create_network(self):
         '''
-        for the specified set, create a bridge network in the 172.xxx.yyy.0/16 space
-        with that name if none exists already; if one exists, just return
+        for the specified set, create a bridge network in the configured address pool
+        (by default a /24 in 172.16.0.0/12) with that name if none exists already;
+        if one exists, just return
 
         this will check all existing docker networks to make sure the new network does
-        not conflict with them. note that there is no guarantee that you will get
-        the same network ip space for the same set if the network is destroyed and
-        recreated.
-        '''
-        ip_spaces = []
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        networks = client.networks.list()
-        for entry in networks:
-            if (entry.name == self.args['set'] + ".lan" and
-                    self.labeler.has_labels(entry.attrs['Labels'], self.labeler.get_set_label())):
+        not conflict with them, while holding a lock so that other runs on this host
+        can't grab the same space in the meantime. note that there is no guarantee
+        that you will get the same network ip space for the same set if the network
+        is destroyed and recreated.
+        '''
+        if self.network_exists():
+            if self.verbose:
+                print("Network already exists.")
+            return
+
+        with SubnetAllocator.locked(self.lockpath), TRACER.span('create network',
+                                                                set=self.args['set']):
+            # someone else may have made it while we waited
+            self.inventory.invalidate('networks')
+            if self.network_exists():
                 if self.verbose:
                     print("Network already exists.")
                 return
-            # collect the address space info
-            for settings in entry.attrs['IPAM']['Config']:
-                if 'Subnet' in settings and settings['Subnet'].startswith('172.'):
-                    ip_spaces.append(settings['Subnet'])
 
-        if self.verbose:
-            print("ip spaces already used:", ip_spaces)
-        possible = netaddr.IPSet(['172.16.0.0/12'])
-        allocated = netaddr.IPSet(ip_spaces)
-        available = possible ^ allocated
-        using = None
-        for cidr in available.iter_cidrs():
-            if cidr.prefixlen != 24:
-                cidr.prefixlen = 24
-                using = cidr
-                if self.verbose:
-                    print("using:", using)
-                break
-        if not using:
-            raise ValueError("No network address space available in 172.16")
+            ip_spaces = self.inventory.get_subnets_in_use()
+            if self.verbose:
+                print("ip spaces already used:", ip_spaces)
+            using = self.allocator.pick(ip_spaces)
+            if not using:
+                raise ValueError("No network address space available in {pool}".format(
+                    pool=self.allocator.pool))
+            if self.verbose:
+                print("using:", using)
 
-        ipam_pool = docker.types.IPAMPool(subnet=str(using))
-        ipam_config = docker.types.IPAMConfig(pool_configs=[ipam_pool])
-        labels = self.labeler.get_set_label().copy()
-        labels.update(self.labeler.get_blame_label())
-        client.networks.create(self.get_network_name(), driver="bridge",
-                               labels=labels, ipam=ipam_config)
+            ipam_pool = docker.types.IPAMPool(subnet=str(using))
+            ipam_config = docker.types.IPAMConfig(pool_configs=[ipam_pool])
+            labels = self.labeler.get_set_label().copy()
+            labels.update(self.labeler.get_blame_label())
+            network = self.inventory.client.networks.create(
+                self.get_network_name(), driver="bridge", labels=labels, ipam=ipam_config)
+            self.inventory.add_network(network)
 
-    @staticmethod
-    def get_all_networks():
-        '''return list of all the networks defined on this host'''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        networks = client.networks.list()
-        return networks
+    def get_all_networks(self):
+        '''return list of all the networks defined on this host by us'''
+        return self.inventory.get_networks()
 
     def remove_network(self, labels=None, network=None):
         '''
@@ -130,22 +577,20 @@ class Networks():
         if we specify a dict of labels, then just remove every network
         with all of those labels
         '''
-        networks = self.get_all_networks()
         if labels:
-            for entry in networks:
-                if self.labeler.has_labels(entry.attrs['Labels'], labels):
-                    if self.verbose:
-                        print("Removing network")
-                    entry.remove()
+            for entry in self.inventory.get_networks(labels):
+                if self.verbose:
+                    print("Removing network")
+                self.inventory.remove_network(entry)
         else:
-            for entry in networks:
+            for entry in self.get_all_networks():
                 if ((network and entry.name == network) or
                     (entry.name == self.get_network_name()) and
                         self.labeler.has_labels(entry.attrs['Labels'],
                                                 self.labeler.get_set_label())):
                     if self.verbose:
                         print("Removing network")
-                    entry.remove()
+                    self.inventory.remove_network(entry)
 
 
 class ContainerConfig():
@@ -273,6 +718,14 @@ class ContainerConfig():
         # don't care
         return subtree
 
+    def get_db_root_password(self, setname):
+        '''return the db root password for the set, or the global one if the set has none'''
+        password = self.retrieve_value(self.get_containerset_config(setname),
+                                       ['passwords', 'dbs', 'root'])
+        if not password:
+            password = self.retrieve_value(self.config['global'], ['passwords', 'dbs', 'root'])
+        return password
+
     def write_creds_file(self, setname, path):
         '''
         write a yaml file to the specified output path consisting of
@@ -303,9 +756,7 @@ class ContainerConfig():
             sys.exit(1)
         contents.append("rootuser: " + root_password)
 
-        rootdbuser_password = self.retrieve_value(set_config, ['passwords', 'dbs', 'root'])
-        if not rootdbuser_password:
-            rootdbuser_password = self.retrieve_value(globals_config, ['passwords', 'dbs', 'root'])
+        rootdbuser_password = self.get_db_root_password(setname)
         if not rootdbuser_password:
             print("A root password for the db must be specified in your configuration")
             sys.exit(1)
@@ -330,186 +781,979 @@ class ContainerConfig():
             creds.write("\n".join(contents) + "\n")
 
 
+class FileDigests():
+    '''
+    sha256 digests of file contents, cached on disk by path, size and mtime
+    so that multi-GB import files are only read once; also keeps the list of
+    inputs that went into each image we built, so we can say what changed
+    '''
+    def __init__(self, cachepath):
+        self.cachepath = cachepath
+        self.lock = threading.Lock()
+        self.cache = {'files': {}, 'images': {}}
+        if os.path.exists(cachepath):
+            try:
+                with open(cachepath, "r") as fhandle:
+                    self.cache = json.load(fhandle)
+            except ValueError:
+                print("ignoring unreadable digest cache", cachepath)
+
+    def get(self, path):
+        '''return the hex digest of the contents of the file'''
+        stat_info = os.stat(path)
+        key = os.path.realpath(path)
+        cached = self.cache['files'].get(key)
+        if (cached and cached['size'] == stat_info.st_size
+                and cached['mtime'] == stat_info.st_mtime_ns):
+            return cached['digest']
+        digest = hashlib.sha256()
+        with open(path, "rb") as fhandle:
+            while True:
+                chunk = fhandle.read(BuildContext.CHUNKSIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        with self.lock:
+            self.cache['files'][key] = {'size': stat_info.st_size, 'mtime': stat_info.st_mtime_ns,
+                                        'digest': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def get_manifest(self, tag):
+        '''return the inputs recorded for the last build of the image, if any'''
+        return self.cache['images'].get(tag)
+
+    def set_manifest(self, tag, manifest):
+        '''record the inputs for a build of the image'''
+        with self.lock:
+            self.cache['images'][tag] = manifest
+
+    def save(self):
+        '''write the cache out for next time'''
+        with self.lock:
+            with open(self.cachepath, "w") as fhandle:
+                json.dump(self.cache, fhandle)
+
+
+class BuildContext():
+    '''
+    the build context for one Dockerfile: the Dockerfile itself plus just the
+    files from docker_helpers that it COPYs or ADDs, rather than the whole
+    tree (which has every set's db imports in it)
+
+    the context is handed to the daemon as a tar stream generated on the fly
+    from the files in place, so nothing gets copied or staged anywhere first.
+    symlinks are followed, so that import files symlinked from one set's
+    directory to another's arrive in the image as real files.
+
+    paths listed in unhashed are left out of the manifest; they are for
+    things whose contents are already covered by one of the build args.
+    '''
+    BLOCKSIZE = tarfile.BLOCKSIZE
+    CHUNKSIZE = 1024 * 1024
+
+    def __init__(self, topdir, dockerfile, buildargs=None, extra_paths=None, unhashed=None):
+        self.topdir = topdir
+        self.dockerfile = dockerfile
+        self.buildargs = buildargs if buildargs else {}
+        self.extra_paths = extra_paths if extra_paths else []
+        self.unhashed = [os.path.normpath(path) for path in unhashed or []]
+        self.entries = None
+
+    @staticmethod
+    def get_instructions(contents):
+        '''
+        return the list of (INSTRUCTION, args) from the text of a Dockerfile,
+        with comments dropped and continuation lines joined up
+        '''
+        instructions = []
+        current = ''
+        for line in contents.splitlines():
+            if line.strip().startswith('#') and not current:
+                continue
+            if line.rstrip().endswith('\\'):
+                current += line.rstrip()[:-1] + ' '
+                continue
+            current += line
+            if current.strip():
+                fields = current.strip().split(maxsplit=1)
+                instructions.append((fields[0].upper(), fields[1] if len(fields) > 1 else ''))
+            current = ''
+        return instructions
+
+    @staticmethod
+    def substitute_args(text, argvalues):
+        '''fill in $NAME and ${NAME} references to build args'''
+        for name, value in argvalues.items():
+            if value is None:
+                continue
+            text = text.replace('${' + name + '}', value).replace('$' + name, value)
+        return text
+
+    def get_parsed(self):
+        '''
+        return the list of (INSTRUCTION, args) from the Dockerfile, with
+        build args filled in
+        '''
+        with open(os.path.join(self.topdir, self.dockerfile), "r") as fhandle:
+            contents = fhandle.read()
+        argvalues = {}
+        parsed = []
+        for instruction, args in self.get_instructions(contents):
+            if instruction == 'ARG':
+                name, _sep, default = args.partition('=')
+                argvalues[name.strip()] = self.buildargs.get(name.strip(), default or None)
+            parsed.append((instruction, self.substitute_args(args, argvalues)))
+        return parsed
+
+    def get_parent_image(self):
+        '''return the name of the image in the FROM line of the Dockerfile'''
+        for instruction, args in self.get_parsed():
+            if instruction == 'FROM':
+                return args.split()[0]
+        return None
+
+    def get_copy_sources(self):
+        '''
+        parse the Dockerfile and return the paths in the context which it COPYs or ADDs;
+        these may be globs. COPY --from=<stage> entries don't come from the context
+        and are skipped.
+        '''
+        sources = []
+        for instruction, args in self.get_parsed():
+            if instruction not in ['COPY', 'ADD']:
+                continue
+            fields = []
+            while args.startswith('--'):
+                flag, _sep, args = args.partition(' ')
+                fields.append(flag)
+                args = args.strip()
+            if [flag for flag in fields if flag.startswith('--from=')]:
+                continue
+            if args.startswith('['):
+                paths = json.loads(args)
+            else:
+                paths = shlex.split(args)
+            # the last one is the destination
+            sources.extend(paths[:-1])
+        return sources
+
+    def add_path(self, relpath, entries):
+        '''
+        add the file or directory (and everything under it) to the list of
+        (full path, name in archive) entries, if it's not there already
+        '''
+        fullpath = os.path.join(self.topdir, relpath)
+        arcname = os.path.normpath(relpath)
+        if arcname in entries:
+            return
+        entries[arcname] = fullpath
+        if os.path.isdir(fullpath):
+            for entry in sorted(os.listdir(fullpath)):
+                self.add_path(os.path.join(relpath, entry), entries)
+
+    def get_entries(self):
+        '''
+        return the list of (full path, name in archive) for everything
+        that goes into the context
+        '''
+        if self.entries is not None:
+            return self.entries
+        entries = {}
+        self.add_path(self.dockerfile, entries)
+        for source in self.get_copy_sources() + self.extra_paths:
+            matches = sorted(glob.glob(os.path.join(self.topdir, source)))
+            if not matches:
+                # let the build fail with the daemon's error about it
+                continue
+            for match in matches:
+                self.add_path(os.path.relpath(match, self.topdir), entries)
+        self.entries = sorted((fullpath, arcname) for arcname, fullpath in entries.items())
+        return self.entries
+
+    def get_size(self):
+        '''return the number of files and the total bytes of file data in the context'''
+        count = 0
+        size = 0
+        for fullpath, _arcname in self.get_entries():
+            if not os.path.isdir(fullpath):
+                count += 1
+                size += os.stat(fullpath).st_size
+        return count, size
+
+    def is_hashed(self, arcname):
+        '''return whether the path in the context goes into the manifest'''
+        return not [path for path in self.unhashed
+                    if arcname == path or arcname.startswith(path + os.sep)]
+
+    def get_file_digests(self, digests):
+        '''return a dict of the digest of every file in the context that goes into the manifest'''
+        files = {}
+        for fullpath, arcname in self.get_entries():
+            if not self.is_hashed(arcname):
+                continue
+            if os.path.isdir(fullpath):
+                files[arcname] = 'dir'
+            else:
+                files[arcname] = digests.get(fullpath)
+        return files
+
+    def get_manifest(self, parent_id, digests):
+        '''
+        return a dict of everything that goes into building the image: the digest of
+        the Dockerfile and of every file in the context, the build args and the id
+        of the image it is built FROM
+        '''
+        return {'files': self.get_file_digests(digests), 'buildargs': self.buildargs,
+                'parent': parent_id}
+
+    @staticmethod
+    def get_digest(manifest):
+        '''return the content hash for a build manifest'''
+        return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_changes(old_manifest, new_manifest):
+        '''return a list of short descriptions of what differs between two build manifests'''
+        changes = []
+        if old_manifest['parent'] != new_manifest['parent']:
+            changes.append("parent image")
+        if old_manifest['buildargs'] != new_manifest['buildargs']:
+            changes.append("build args")
+        for arcname in sorted(set(old_manifest['files']) | set(new_manifest['files'])):
+            if old_manifest['files'].get(arcname) != new_manifest['files'].get(arcname):
+                changes.append(arcname)
+        return changes
+
+    def stream(self):
+        '''generate the tar archive of the context, a chunk at a time'''
+        return self.stream_entries(self.get_entries())
+
+    @staticmethod
+    def stream_entries(entries):
+        '''
+        given a list of (full path, name in archive) for files and directories,
+        generate a tar archive of them, a chunk at a time
+        '''
+        for fullpath, arcname in entries:
+            stat_info = os.stat(fullpath)
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.mode = stat_info.st_mode & 0o7777
+            tarinfo.mtime = stat_info.st_mtime
+            if os.path.isdir(fullpath):
+                tarinfo.type = tarfile.DIRTYPE
+                yield tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+                continue
+            tarinfo.size = stat_info.st_size
+            yield tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+            with open(fullpath, "rb") as fhandle:
+                while True:
+                    chunk = fhandle.read(BuildContext.CHUNKSIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            remainder = tarinfo.size % BuildContext.BLOCKSIZE
+            if remainder:
+                yield b'\0' * (BuildContext.BLOCKSIZE - remainder)
+        # end of archive marker
+        yield b'\0' * (BuildContext.BLOCKSIZE * 2)
+
+
+class BuildTarget():
+    '''
+    one image we may want to build: its tag, the Dockerfile and build args used
+    to build it, and the tag of the image it is built from if that one is ours
+
+    tuning args are build args that change how the image gets built but not
+    what ends up in it; they are left out of its content hash
+
+    imports, for the db data image only, are the (wiki, path) of the import
+    files that are linked into its build context just before it is built
+    '''
+    def __init__(self, name, stage, tag, dockerfile, parent=None, buildargs=None, tuning=None,
+                 imports=None):
+        self.name = name
+        self.stage = stage
+        self.tag = tag
+        self.dockerfile = dockerfile
+        self.parent = parent
+        self.buildargs = buildargs
+        self.tuning = tuning
+        self.imports = imports
+
+    def describe(self):
+        '''a short human readable description of the image'''
+        if self.stage == 'basest':
+            return "common base image"
+        if self.stage == 'data':
+            return "db data image"
+        return "{name} {stage} image".format(name=self.name, stage=self.stage)
+
+    def get_all_buildargs(self):
+        '''return all the build args to hand to the daemon, tuning args included'''
+        if not self.tuning:
+            return self.buildargs
+        buildargs = dict(self.buildargs or {})
+        buildargs.update(self.tuning)
+        return buildargs
+
+
+class BuildLog():
+    '''
+    consume the decoded output of a streaming image build as it arrives,
+    reporting each Dockerfile step as it starts and how long it took
+    (or that it came from the layer cache) when it is done
+
+    output goes to stdout, each line prefixed with the image tag so that
+    several builds going at once can be told apart, or if jsonlog is set,
+    as one json object per line with the tag as one of the fields. all
+    builds share the one lock so that their lines don't get mixed up.
+    without verbose, only step starts and ends are shown as they happen;
+    the last few lines of everything else are kept for display if the build fails
+    '''
+    KEEP_LINES = 50
+
+    def __init__(self, tag, lock, jsonlog=False, verbose=False, clock=time.monotonic):
+        self.tag = tag
+        self.lock = lock
+        self.jsonlog = jsonlog
+        self.verbose = verbose
+        self.clock = clock
+        self.start = clock()
+        # list of {'step': n, 'total': m, 'instruction': text, 'elapsed': secs, 'cached': bool}
+        self.steps = []
+        self.current = None
+        # wall clock time the current step started, for the trace
+        self.current_wall = None
+        self.image_id = None
+        self.lines = []
+        self.recent = collections.deque(maxlen=self.KEEP_LINES)
+
+    def emit(self, event, **fields):
+        '''write one line of output for the given event'''
+        if self.jsonlog:
+            record = {'time': round(time.time(), 3), 'image': self.tag, 'event': event}
+            record.update(fields)
+            text = json.dumps(record)
+        elif event == 'step':
+            text = "[{tag}] Step {step}/{total} : {instruction}".format(tag=self.tag, **fields)
+        elif event == 'step_done':
+            text = "[{tag}] Step {step}/{total} {how} {elapsed:.1f}s".format(
+                tag=self.tag, how='cached' if fields['cached'] else 'done in', **fields)
+        elif event == 'done':
+            text = "[{tag}] built {image_id} in {elapsed:.1f}s".format(tag=self.tag, **fields)
+        else:
+            text = "[{tag}] {text}".format(tag=self.tag, text=fields['text'])
+        with self.lock:
+            print(text, flush=True)
+
+    def finish_step(self):
+        '''record how long the step underway took and report it'''
+        if not self.current:
+            return
+        self.current['elapsed'] = self.clock() - self.current['started']
+        del self.current['started']
+        self.steps.append(self.current)
+        self.emit('step_done', **self.current)
+        TRACER.add('build step', self.current_wall, time.time(), image=self.tag,
+                   step=self.current['step'], instruction=self.current['instruction'],
+                   cached=self.current['cached'])
+        self.current = None
+
+    def add_line(self, line):
+        '''handle one line of text from the build output'''
+        if TRACER.add_from_line(line, image=self.tag):
+            return
+        self.lines.append(line)
+        self.recent.append(line)
+        if line.startswith('Step ') and ' : ' in line:
+            self.finish_step()
+            counts, instruction = line[5:].split(' : ', 1)
+            step, _sep, total = counts.partition('/')
+            self.current = {'step': int(step), 'total': int(total),
+                            'instruction': instruction, 'cached': False,
+                            'started': self.clock()}
+            self.current_wall = time.time()
+            self.emit('step', **{key: value for key, value in self.current.items()
+                                 if key != 'started'})
+            return
+        if self.current and line.strip() == '---> Using cache':
+            self.current['cached'] = True
+        if self.verbose:
+            self.emit('output', text=line)
+
+    def add(self, chunk):
+        '''
+        handle one decoded chunk of build output; raise BuildError if
+        the daemon tells us the build failed
+        '''
+        if 'stream' in chunk:
+            for line in chunk['stream'].splitlines():
+                if line.strip():
+                    self.add_line(line)
+        if 'aux' in chunk and 'ID' in chunk['aux']:
+            self.image_id = chunk['aux']['ID']
+        if 'error' in chunk:
+            self.finish_step()
+            self.emit('error', text=chunk['error'].strip())
+            raise docker.errors.BuildError(chunk['error'], self.lines)
+
+    def consume(self, chunks):
+        '''handle all of the output of a build and return the id of the image built'''
+        for chunk in chunks:
+            self.add(chunk)
+        self.finish_step()
+        if not self.image_id:
+            raise docker.errors.BuildError("no image id in output of build", self.lines)
+        self.emit('done', image_id=self.image_id, elapsed=self.clock() - self.start)
+        return self.image_id
+
+    def show_recent(self):
+        '''display the last lines of output, for when a build has failed'''
+        with self.lock:
+            for line in self.recent:
+                print("[{tag}] {line}".format(tag=self.tag, line=line))
+
+
+class BuildScheduler():
+    '''
+    run a set of image builds with as many going at once as we are allowed,
+    where each build waits for the image it is built from, if that image is
+    also being built
+
+    after wikimedia-dumps/base every <type>-base build is independent of the
+    others, and each <type>-<set>-final build only needs its own base, so
+    on a box with some cores there is plenty to do in parallel.
+
+    the first failed build stops any new builds from being started; builds
+    already underway are allowed to finish, and then the failure is raised
+    '''
+    def __init__(self, targets, builder, workers, verbose):
+        self.targets = targets
+        self.builder = builder
+        self.workers = max(1, workers)
+        self.verbose = verbose
+        # tag -> (status, elapsed seconds)
+        self.results = {}
+
+    @staticmethod
+    def get_ready(pending, running):
+        '''return the pending targets whose parent is not waiting to be built or being built'''
+        unfinished = [target.tag for target in pending] + [target.tag for target in running]
+        return [target for target in pending if target.parent not in unfinished]
+
+    def timed_build(self, target):
+        '''build one image, returning the elapsed time'''
+        start = time.monotonic()
+        self.builder(target)
+        return time.monotonic() - start
+
+    def run(self):
+        '''
+        build everything, respecting dependencies, and display the timings;
+        re-raise the first build failure, if any
+        '''
+        pending = list(self.targets)
+        failure = None
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                if not failure:
+                    # only hand the executor what it can start right away, so that
+                    # nothing is left queued up in there if a build fails
+                    ready = self.get_ready(pending, running.values())
+                    for target in ready[:self.workers - len(running)]:
+                        pending.remove(target)
+                        running[executor.submit(self.timed_build, target)] = target
+                if not running:
+                    break
+                finished, _unused = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    target = running.pop(future)
+                    try:
+                        self.results[target.tag] = ('built', future.result())
+                    except Exception as ohno:
+                        self.results[target.tag] = ('FAILED', None)
+                        if not failure:
+                            failure = ohno
+        for target in pending:
+            self.results[target.tag] = ('not built', None)
+        self.show_timings()
+        if failure:
+            raise failure
+
+    def show_timings(self):
+        '''display the status and build time of every image we were asked to build'''
+        if not self.results:
+            return
+        padding = max(len(tag) for tag in self.results)
+        print("image build summary:")
+        for target in self.targets:
+            status, elapsed = self.results[target.tag]
+            if elapsed is None:
+                elapsed_text = '-'
+            else:
+                elapsed_text = "{secs:.1f}s".format(secs=elapsed)
+            print("  {tag} {status:<10} {elapsed}".format(
+                tag=target.tag.ljust(padding), status=status, elapsed=elapsed_text))
+
+
 class Images():
     '''
     manage the build and removal of images as defined in a config
     '''
-    def __init__(self, args, config, labeler, networks):
+    HASH_LABEL = 'atgdumps.content-hash'
+    DBDATA_IMAGE = 'wikimedia-dumps/dbdata'
+    # where in docker_helpers the import files for each db data image are linked
+    DBDATA_DIR = 'mariadb/dbdata'
+    # a physical copy of a wiki db, loaded in place of its sql dumps if present
+    TABLESPACES_SUFFIX = '.tablespaces.tar'
+    # final images for these are built on the db data image for the set
+    DBDATA_TYPES = ['dbprimary', 'dbreplica', 'dbextstore']
+
+    def __init__(self, args, config, labeler, networks, inventory, digests=None,
+                 output_lock=None):
         self.args = args
         self.verbose = args['verbose']
         self.dryrun = args['dryrun']
         self.labeler = labeler
         self.nets = networks
         self.config = config
+        self.inventory = inventory
+        # when several sets are handled at once, they all share these two
+        if not digests:
+            digests = FileDigests(os.path.join(os.getcwd(), '.build_digests.json'))
+        self.digests = digests
+        # shared by all builds, so lines from builds running at the same time don't interleave
+        self.output_lock = output_lock or threading.Lock()
+        # (wiki, path, index) for the set's import files, once the db data target is worked out
+        self.import_indexes = []
 
     def image_exists(self, tag):
         '''check if the image with the specific tag in the container set exists'''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        entries = client.images.list(all=True)
-        for entry in entries:
-            if self.labeler.has_blame_label(entry) and tag in entry.tags:
-                return True
-        return False
+        entry = self.inventory.get_image(tag)
+        return bool(entry and self.labeler.has_blame_label(entry))
 
     @staticmethod
     def get_known_image_types():
         '''these are the image types we know how to build'''
         return ['snapshot', 'dbprimary', 'dbreplica', 'dbextstore', 'dumpsdata', 'httpd', 'phpfpm']
 
-    def do_basest_base_build(self, client):
-        '''build the base image for all other base images.'''
+    def get_basest_base_target(self):
+        '''return the build target for the base image for all other base images, if needed'''
 
         # this is the basest of all base images :-P
         base_image = 'wikimedia-dumps/base:latest'
-        do_squash = self.config.config['squash']
-        if not self.image_exists(base_image):
-            path = os.path.join(os.getcwd(), 'docker_helpers')
-            dockerfile = 'Dockerfile.base'
-            if self.verbose:
-                print("building base image for all images in " + self.args['set'])
-            try:
-                _unused, logs = client.images.build(
-                    path=path,
-                    rm=True,
-                    forcerm=True,
-                    dockerfile=dockerfile,
-                    tag=base_image,
-                    squash=do_squash,
-                    labels=self.labeler.get_blame_label())
-            except docker.errors.BuildError as error:
-                print("BUILD FAILED for base image for all images in " + self.args['set'])
-                for line in error.build_log:
-                    print(line)
-                raise
-            if self.verbose:
-                print("BUILD SUCCEEDED for common base image in {setname}".format(
-                    setname=self.args['set']))
-                for entry in logs:
-                    print(entry)
+        return [BuildTarget('base', 'basest', base_image, 'Dockerfile.base')]
 
-    def do_base_build(self):
+    def get_base_targets(self):
         '''
-        build base images needed for the containers associated with a wikifarm set.
-        these will be independent of network names and eventual container names.
-        if all of the images exist and are current, return
+        return the build targets for base images needed for the containers associated
+        with a wikifarm set, including the base image for all of them
         '''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        self.do_basest_base_build(client)
+        targets = self.get_basest_base_target()
+        path = os.path.join(os.getcwd(), 'docker_helpers')
 
         todos = self.get_known_image_types()
         if self.args['name']:
             todos = [self.args['name']]
-        do_squash = self.config.config['squash']
         for image_name in todos:
             base_image = 'wikimedia-dumps/{name}-base:latest'.format(name=image_name)
             if self.config.container_configured(image_name, self.args['set']):
-                if not self.image_exists(base_image):
-                    path = os.path.join(os.getcwd(), 'docker_helpers')
-                    dockerfile = 'Dockerfile.' + image_name + '-base'
-
-                    # see, a bunch of these don't exist yet :-P :-P FIXME by removing later.
-                    if not os.path.exists(os.path.join(path, dockerfile)):
-                        if self.verbose:
-                            print("skipping build of {name} base image, no Dockerfile yet".format(
-                                name=image_name))
-                        continue
+                dockerfile = 'Dockerfile.' + image_name + '-base'
 
+                # see, a bunch of these don't exist yet :-P :-P FIXME by removing later.
+                if not os.path.exists(os.path.join(path, dockerfile)):
                     if self.verbose:
-                        print("building {name} base image for".format(name=base_image),
-                              self.args['set'])
-                    try:
-                        _unused, logs = client.images.build(
-                            path=path,
-                            rm=True,
-                            forcerm=True,
-                            dockerfile=dockerfile,
-                            tag=base_image,
-                            squash=do_squash,
-                            labels=self.labeler.get_blame_label())
-                    except docker.errors.BuildError as error:
-                        print("BUILD FAILED for {name} base image in {setname}".format(
-                            name=image_name, setname=self.args['set']))
-                        for line in error.build_log:
-                            print(line)
-                        raise
+                        print("skipping build of {name} base image, no Dockerfile yet".format(
+                            name=image_name))
+                    continue
+                targets.append(BuildTarget(image_name, 'base', base_image, dockerfile,
+                                           parent='wikimedia-dumps/base:latest'))
+        return targets
+
+    def get_import_files(self):
+        '''
+        return the sorted list of (wiki, path) for the import files in the
+        set's imports directory that belong to wikis in the set, sql dumps
+        and tablespace archives both
+        '''
+        wikis = self.config.get_containerset_config(self.args['set']).get('wikidbs') or []
+        importdir = os.path.join(os.getcwd(), 'docker_helpers', 'mariadb', 'imports',
+                                 self.args['set'])
+        import_files = []
+        for path in sorted(find_import_files(importdir) +
+                           glob.glob(os.path.join(importdir, "*" + self.TABLESPACES_SUFFIX))):
+            wiki = os.path.basename(path).split('.')[0]
+            if wiki in wikis:
+                import_files.append((wiki, path))
+        return import_files
+
+    def get_dbdata_code_digests(self):
+        '''
+        return a dict of the digests of everything besides the import files that
+        goes into the db data image: the dbdata and dbprimary base Dockerfiles,
+        which say which MariaDB gets installed, and the files they copy in, such
+        as the MariaDB config and the scripts that do the imports
+        '''
+        files = {}
+        for dockerfile in ['Dockerfile.dbprimary-base', 'Dockerfile.dbdata']:
+            context = BuildContext(os.path.join(os.getcwd(), 'docker_helpers'), dockerfile,
+                                   unhashed=[self.DBDATA_DIR])
+            files.update(context.get_file_digests(self.digests))
+        return files
+
+    def get_dbdata_key(self, wikis, import_files, sample=None):
+        '''
+        return the key for the db data image with these wikis and import files:
+        a hash of the wiki names, the names and contents of the import files, the
+        sample settings if only part of each wiki is imported, and the Dockerfiles
+        and scripts that build the image. sets with the same wikis, dumps and sample
+        get the same key, no matter where the files live; a change to the way
+        imports are done gets a new key, so a shared image is never reused stale
+        '''
+        hasher = hashlib.sha256()
+        for arcname, digest in sorted(self.get_dbdata_code_digests().items()):
+            hasher.update(b'code\0' + arcname.encode('utf-8') + b'\0' + digest.encode('utf-8'))
+        for wiki in sorted(wikis):
+            hasher.update(b'wiki\0' + wiki.encode('utf-8') + b'\0')
+        for _wiki, path in import_files:
+            hasher.update(b'file\0' + os.path.basename(path).encode('utf-8') + b'\0' +
+                          self.digests.get(path).encode('utf-8'))
+        if sample:
+            hasher.update(b'sample\0' + json.dumps(sample, sort_keys=True).encode('utf-8'))
+        return hasher.hexdigest()[:16]
+
+    def get_import_indexes(self, import_files):
+        '''
+        return a list of (wiki, path, index) for the import files, reading through
+        any file that has no up to date index alongside it to make one. an
+        index records what is in the file, so the imports can be planned
+        and their progress reported without reading the file again
+
+        the index is only a help; a file that can't be read through here, because
+        it is damaged or there is nothing on the host to decompress it with, gets
+        None for its index, and it is left to the import to say what is wrong with it
+        '''
+        indexes = []
+        for wiki, path in import_files:
+            if path.endswith(self.TABLESPACES_SUFFIX):
+                continue
+            digest = self.digests.get(path)
+            index = DumpIndex.load(path, digest)
+            if not index:
+                if self.verbose:
+                    print("indexing import file", path)
+                try:
+                    with TRACER.span('index dump', file=os.path.basename(path),
+                                     size=os.stat(path).st_size):
+                        index = DumpIndex.get(path, digest)
+                except (ValueError, OSError) as ohno:
+                    print("WARNING: can't index import file {path}, going on without an index "
+                          "({error})".format(path=path, error=ohno))
+            indexes.append((wiki, path, index))
+        return indexes
+
+    @staticmethod
+    def stage_dbdata(datadir, import_files):
+        '''
+        fill the directory the db data image gets its import files from with
+        symlinks to the import files and their indexes
+
+        the directory is named by the key, and the key covers the names and
+        contents of the files, so any link already there is as good as a new
+        one; they are left alone, since another build with the same key may
+        be reading them right now. only links to files that are gone are replaced
+        '''
+        os.makedirs(datadir, exist_ok=True)
+        wanted = {}
+        for _wiki, path in import_files:
+            for filepath in [path, DumpIndex.get_path(path)]:
+                if os.path.exists(filepath):
+                    wanted[os.path.basename(filepath)] = os.path.realpath(filepath)
+        for name in os.listdir(datadir):
+            if name not in wanted:
+                os.unlink(os.path.join(datadir, name))
+        for name, filepath in wanted.items():
+            linkpath = os.path.join(datadir, name)
+            if os.path.exists(linkpath):
+                continue
+            # swap the link in whole, in case a dangling one is there
+            os.symlink(os.path.relpath(filepath, datadir), linkpath + '.tmp')
+            os.replace(linkpath + '.tmp', linkpath)
+
+    def get_dbdata_target(self):
+        '''
+        return the build target for the db data image for the set: the db server
+        with the set's wikis imported, which the final images of all the db
+        servers in any set with the same wikis and dumps are built on.
+        return None if the set has no db servers
+        '''
+        todos = self.DBDATA_TYPES
+        if self.args['name']:
+            todos = [name for name in todos if name == self.args['name']]
+        if not [name for name in todos
+                if self.config.container_configured(name, self.args['set'])]:
+            return None
+        set_config = self.config.get_containerset_config(self.args['set'])
+        wikis = set_config.get('wikidbs') or []
+        import_files = self.get_import_files()
+        # a sample is a different set of data, unlike the import settings
+        sample = set_config.get('import_sample')
+        key = self.get_dbdata_key(wikis, import_files, sample)
+        # the indexes are made from the files, so they don't go into the key
+        self.import_indexes = self.get_import_indexes(import_files)
+        import_settings = set_config.get('imports') or {}
+        buildargs = {'DATAKEY': key, 'WIKIS': ','.join(wikis)}
+        if sample:
+            buildargs['IMPORT_SAMPLE'] = json.dumps(sample, sort_keys=True)
+        return BuildTarget('dbdata', 'data', self.DBDATA_IMAGE + ':' + key, 'Dockerfile.dbdata',
+                           parent='wikimedia-dumps/dbprimary-base:latest',
+                           buildargs=buildargs,
+                           tuning={'IMPORT_SETTINGS': json.dumps(import_settings)},
+                           imports=import_files)
+
+    def get_final_targets(self):
+        '''
+        return the build targets for final images needed for the containers associated
+        with a wikifarm set, along with the db data image they need, if any
+        '''
+        targets = []
+        path = os.path.join(os.getcwd(), 'docker_helpers')
+
+        # If there are no import files set up, we'll make a placeholder so the image and
+        # container will be built, but we will warn the user as well.
+        db_imports_dir = os.path.join("./docker_helpers/mariadb/imports", self.args['set'])
+        if (self.config.container_configured("dbprimary", self.args['set']) and
+                not os.path.exists(db_imports_dir)):
+            os.makedirs(db_imports_dir)
+            print("WARNING: No imports for primary db for set", self.args['set'])
+
+        dbdata_target = self.get_dbdata_target()
+        if dbdata_target:
+            targets.append(dbdata_target)
+
+        todos = self.get_known_image_types()
+        if self.args['name']:
+            todos = [self.args['name']]
+        for image_name in todos:
+            final_image = 'wikimedia-dumps/{name}-{setname}-final:latest'.format(
+                name=image_name, setname=self.args['set'])
+            if self.config.container_configured(image_name, self.args['set']):
+                dockerfile = 'Dockerfile.' + image_name + '-final'
+
+                # see, a bunch of these don't exist yet :-P :-P FIXME by removing later.
+                if not os.path.exists(os.path.join(path, dockerfile)):
                     if self.verbose:
-                        print("BUILD SUCCEEDED for {name} base image in {setname}".format(
-                            name=image_name, setname=self.args['set']))
-                        for entry in logs:
-                            print(entry)
+                        print("skipping build of {name} final image, no Dockerfile yet".format(
+                            name=image_name))
+                    continue
+                parent = 'wikimedia-dumps/{name}-base:latest'.format(name=image_name)
+                buildargs = {'SETNAME': self.args['set']}
+                if image_name in self.DBDATA_TYPES:
+                    parent = dbdata_target.tag
+                    buildargs['DBDATA'] = dbdata_target.tag
+                targets.append(BuildTarget(image_name, 'final', final_image, dockerfile,
+                                           parent=parent, buildargs=buildargs))
+        return targets
+
+    def get_context(self, target):
+        '''
+        return the build context for the target; the import files for the db data
+        image are covered by its key, which is a build arg, so they are not hashed again
+        '''
+        return BuildContext(os.path.join(os.getcwd(), 'docker_helpers'),
+                            target.dockerfile, target.buildargs,
+                            unhashed=[self.DBDATA_DIR] if target.stage == 'data' else None)
 
-    def do_final_build(self):
+    def get_parent_id(self, context):
         '''
-        build final images needed for the containers associated with a wikifarm set.
-        these will be dependent on the network name and eventual container names.
-        this will also build base images if required.
-        if all of the images exist and are current, return
+        return the id of the image the target is built FROM, or its name
+        if it isn't on the host (yet)
         '''
-        self.do_base_build()
+        parent = context.get_parent_image()
+        entry = self.inventory.get_image(parent)
+        if entry:
+            return entry.id
+        try:
+            return self.inventory.client.images.get(parent).id
+        except docker.errors.ImageNotFound:
+            return parent
+
+    def get_manifest(self, target, context=None):
+        '''return the build manifest for the target as things stand right now'''
+        if not context:
+            context = self.get_context(target)
+        return context.get_manifest(self.get_parent_id(context), self.digests)
+
+    def get_rebuild_reason(self, target, rebuilding):
+        '''
+        return the reason the image for the target must be built, or None if it
+        can be left alone
+
+        if the image is missing, it must be built. if we are doing incremental
+        builds, it must also be built if the image it is built from is being
+        rebuilt, or if its content hash label doesn't match the hash of its
+        current inputs
+        '''
+        image = self.inventory.get_image(target.tag)
+        if not image or not self.labeler.has_blame_label(image):
+            return "image does not exist"
+        if not self.args['incremental']:
+            return None
+        if target.parent in rebuilding:
+            return "parent {parent} will be rebuilt".format(parent=target.parent)
+        old_digest = image.labels.get(self.HASH_LABEL)
+        if not old_digest:
+            return "image has no content hash label"
+        manifest = self.get_manifest(target)
+        if old_digest == BuildContext.get_digest(manifest):
+            return None
+        old_manifest = self.digests.get_manifest(target.tag)
+        if not old_manifest or BuildContext.get_digest(old_manifest) != old_digest:
+            return "content hash changed"
+        return "content hash changed ({changes})".format(
+            changes=', '.join(BuildContext.get_changes(old_manifest, manifest)))
 
+    def get_build_plan(self, targets):
+        '''
+        given the targets, parents before children, return a list of (target, reason)
+        for every target, where reason is None if the image is up to date
+        '''
+        rebuilding = []
+        plan = []
+        with TRACER.span('build plan', set=self.args['set'], images=len(targets)):
+            for target in targets:
+                reason = self.get_rebuild_reason(target, rebuilding)
+                if reason:
+                    rebuilding.append(target.tag)
+                plan.append((target, reason))
+            self.digests.save()
+        return plan
+
+    def show_build_plan(self):
+        '''display what a build for the set would do, and why'''
+        self.write_set_files()
+        plan = self.get_build_plan(self.get_base_targets() + self.get_final_targets())
+        padding = max([len(target.tag) for target, _reason in plan], default=0)
+        print("build plan for set {setname}{mode}:".format(
+            setname=self.args['set'],
+            mode=" (incremental)" if self.args['incremental'] else ""))
+        for target, reason in plan:
+            print("  {tag} {action}".format(
+                tag=target.tag.ljust(padding),
+                action="build: " + reason if reason else "up to date"))
+        if self.import_indexes:
+            sample = self.config.get_containerset_config(self.args['set']).get('import_sample')
+            print("import files{sample}:".format(
+                sample=" (sampled: " + json.dumps(sample, sort_keys=True) + ")" if sample else ""))
+            for wiki, path, index in self.import_indexes:
+                print("  {wiki}: {name}, {contents}".format(
+                    wiki=wiki, name=os.path.basename(path),
+                    contents=index.describe() if index else "not indexed"))
+
+    def build_one(self, target):
+        '''
+        build the image for one build target; this may be called from
+        several threads at once
+        '''
+        path = os.path.join(os.getcwd(), 'docker_helpers')
+        if target.stage == 'basest':
+            setinfo = "all images in " + self.args['set']
+        elif target.stage == 'data':
+            setinfo = "all sets with the same wikis and dumps as " + self.args['set']
+        else:
+            setinfo = self.args['set']
+        if target.imports is not None:
+            # only now, so that planning never touches a directory a build may be reading
+            self.stage_dbdata(os.path.join(path, self.DBDATA_DIR, target.buildargs['DATAKEY']),
+                              target.imports)
+        context = self.get_context(target)
+        manifest = self.get_manifest(target, context)
+        labels = self.labeler.get_blame_label().copy()
+        labels[self.HASH_LABEL] = BuildContext.get_digest(manifest)
+        count, size = context.get_size()
+        print("build context for {name}: {count} files, {size} bytes".format(
+            name=target.tag, count=count, size=size))
+        if self.verbose:
+            print("building {name} for {setinfo}".format(name=target.tag, setinfo=setinfo))
+        buildlog = BuildLog(target.tag, self.output_lock, self.args['jsonlog'], self.verbose)
+        try:
+            with TRACER.span('build image', set=self.args['set'], image=target.tag,
+                             stage=target.stage, bytes=size):
+                # the low level api hands us the build output as it is produced,
+                # rather than all at once at the end
+                image_id = buildlog.consume(self.inventory.client.api.build(
+                    fileobj=context.stream(),
+                    custom_context=True,
+                    rm=True,
+                    forcerm=True,
+                    dockerfile=target.dockerfile,
+                    tag=target.tag,
+                    squash=self.config.config['squash'],
+                    labels=labels,
+                    buildargs=target.get_all_buildargs(),
+                    decode=True))
+                self.inventory.add_image(self.inventory.client.images.get(image_id))
+            self.digests.set_manifest(target.tag, manifest)
+        except docker.errors.BuildError:
+            print("BUILD FAILED for {desc} in {setinfo}".format(
+                desc=target.describe(), setinfo=setinfo))
+            if not self.verbose and not self.args['jsonlog']:
+                buildlog.show_recent()
+            raise
+        if self.verbose:
+            print("BUILD SUCCEEDED for {desc} in {setinfo}".format(
+                desc=target.describe(), setinfo=setinfo))
+
+    def run_builds(self, targets, builder=None):
+        '''
+        build whichever of the given targets need it, as many at once as
+        the config permits; each one is built by build_one unless some other
+        builder is passed in
+        '''
+        targets = [target for target, reason in self.get_build_plan(targets) if reason]
+        if not targets:
+            return
+        workers = self.config.config.get('build_workers', os.cpu_count() or 1)
+        scheduler = BuildScheduler(targets, builder or self.build_one, workers, self.verbose)
+        try:
+            scheduler.run()
+        finally:
+            self.digests.save()
+
+    def write_set_files(self):
+        '''write out the per-set files that get copied into final images'''
         # this will get copied into these final images and has creds from per-set config
         credsfile_path = os.path.join(
             os.getcwd(), 'docker_helpers', 'credentials.' + self.args['set'] + ".yaml")
         self.config.write_creds_file(self.args['set'], credsfile_path)
 
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-
         # all known container names in this set go into a file that can be
         # COPYed into the docker image and the values used by a script during
         # the build
         self.config.write_container_set_names(self.args['set'], self.nets.get_network_name())
 
-        todos = self.get_known_image_types()
-        if self.args['name']:
-            todos = [self.args['name']]
-        do_squash = self.config.config['squash']
-        for image_name in todos:
-
-            # If there are no import files set up, we'll make a placeholder so the image and
-            # container will be built, but we will warn the user as well.
-            db_imports_dir = os.path.join("./docker_helpers/mariadb/imports", self.args['set'])
-            if image_name == "dbprimary" and not os.path.exists(db_imports_dir):
-                os.makedirs(db_imports_dir)
-                print("WARNING: No imports for primary db for set", self.args['set'])
-
-            final_image = 'wikimedia-dumps/{name}-{setname}-final:latest'.format(
-                name=image_name, setname=self.args['set'])
-            if self.config.container_configured(image_name, self.args['set']):
-                if not self.image_exists(final_image):
-                    path = os.path.join(os.getcwd(), 'docker_helpers')
-                    dockerfile = 'Dockerfile.' + image_name + '-final'
-
-                    # see, a bunch of these don't exist yet :-P :-P FIXME by removing later.
-                    if not os.path.exists(os.path.join(path, dockerfile)):
-                        if self.verbose:
-                            print("skipping build of {name} final image, no Dockerfile yet".format(
-                                name=image_name))
-                        continue
+    def do_base_build(self):
+        '''
+        build base images needed for the containers associated with a wikifarm set.
+        these will be independent of network names and eventual container names.
+        if all of the images exist and are current, return
+        '''
+        self.run_builds(self.get_base_targets())
 
-                    if self.verbose:
-                        print("building {name} final image for".format(name=final_image),
-                              self.args['set'])
-                    try:
-                        _unused, logs = client.images.build(
-                            path=path,
-                            rm=True,
-                            forcerm=True,
-                            dockerfile=dockerfile,
-                            tag=final_image,
-                            labels=self.labeler.get_blame_label(),
-                            squash=do_squash,
-                            buildargs={'SETNAME': self.args['set']})
-                    except docker.errors.BuildError as error:
-                        print("BUILD FAILED for {name} final image in {setname}".format(
-                            name=image_name, setname=self.args['set']))
-                        for line in error.build_log:
-                            print(line)
-                        raise
-                    if self.verbose:
-                        print("BUILD SUCCEEDED for {name} final image in {setname}".format(
-                            name=image_name, setname=self.args['set']))
-                        for entry in logs:
-                            print(entry)
+    def do_final_build(self):
+        '''
+        build final images needed for the containers associated with a wikifarm set.
+        these will be dependent on the network name and eventual container names.
+        this will also build base images if required.
+        if all of the images exist and are current, return
+        '''
+        self.write_set_files()
+
+        # base and final builds all go into one batch, so that a final image
+        # can get started as soon as its own base image is ready
+        self.run_builds(self.get_base_targets() + self.get_final_targets())
 
     def do_purge(self):
         '''
@@ -540,15 +1784,17 @@ class Images():
                 base_image = 'wikimedia-dumps/{name}-base:latest'.format(name=image_name)
                 if self.image_exists(base_image):
                     todos.append(base_image)
+            # the db data images are built on the dbprimary base image
+            for entry in self.inventory.get_images():
+                todos.extend(tag for tag in entry.tags if tag.startswith(self.DBDATA_IMAGE + ':'))
 
         if not todos:
             print("no base images to remove")
 
-        client = DockerClient(base_url='unix://var/run/docker.sock')
         for base_image in todos:
             if self.verbose:
                 print("removing {name} image".format(name=base_image))
-            client.images.remove(base_image)
+            self.inventory.remove_image(base_image)
 
     def do_purgeall(self):
         '''
@@ -564,8 +1810,7 @@ class Images():
         if self.image_exists(base_image):
             if self.verbose:
                 print("removing {name} image".format(name=base_image))
-            client = DockerClient(base_url='unix://var/run/docker.sock')
-            client.images.remove(base_image)
+            self.inventory.remove_image(base_image)
         else:
             print("no base image to remove")
 
@@ -580,8 +1825,6 @@ class Images():
 
         If images do not exist, just return
         '''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-
         if self.args['name']:
             # remove just this image
             names = [self.args['name']]
@@ -616,7 +1859,7 @@ class Images():
                 if network is not None:
                     message = message + " and network name " + network.name
                 print(message)
-            client.images.remove(image_name)
+            self.inventory.remove_image(image_name)
 
     def image_in_set(self, entry):
         '''check if an image is a final image in our set'''
@@ -627,9 +1870,12 @@ class Images():
 
     @staticmethod
     def image_is_base(entry):
-        '''check if an image is a base image (used to build final images for all sets'''
+        '''
+        check if an image is a base image (used to build final images for all sets),
+        counting db data images, which may be used by several sets
+        '''
         for tag in entry.tags:
-            if tag.endswith('-base:latest'):
+            if tag.endswith('-base:latest') or tag.startswith(Images.DBDATA_IMAGE + ':'):
                 return True
         return False
 
@@ -638,10 +1884,8 @@ class Images():
         list all of the images belonging to the specified set, or all sets
         if show_all is True
         '''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-
         displayed = False
-        entries = client.images.list(all=True)
+        entries = self.inventory.get_images()
         for entry in entries:
             if self.labeler.has_blame_label(entry):
                 if show_all or self.image_in_set(entry) or self.image_is_base(entry):
@@ -656,30 +1900,308 @@ class Images():
             print("<None>")
 
 
+class ParallelTasks():
+    '''
+    run a batch of independent tasks, one per container say, in a pool of
+    threads, with a limit on how long each one may take
+
+    every failure is collected rather than stopping the batch; once all
+    the tasks are done (or have run out of time) the failures are shown
+    together and raised as one error. a summary of the wall time for the
+    batch against the sum of the times for each task is displayed too,
+    so we can see what running them side by side bought us.
+
+    the time limit only means we stop waiting for a task: python threads
+    can't be interrupted, so a task that runs out of time, and whatever it
+    is doing (a docker exec, a container stop) goes on running in its thread
+    until it finishes by itself, and the command won't exit before then.
+    only tasks that haven't started yet are cancelled.
+    '''
+    def __init__(self, workers, timeout=None, verbose=False):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.verbose = verbose
+        # name -> (status, elapsed seconds, error)
+        self.results = {}
+
+    def run(self, description, tasks):
+        '''
+        run the tasks, a list of (name, callable) pairs; description is
+        something like "stop containers" and is used in messages
+        '''
+        self.results = {}
+        if not tasks:
+            return
+        started = {}
+
+        def timed(name, func):
+            started[name] = time.monotonic()
+            with TRACER.span(description, task=name):
+                func()
+            return time.monotonic() - started[name]
+
+        batch_start = time.monotonic()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        running = {executor.submit(timed, name, func): name for name, func in tasks}
+        while running:
+            finished, _unused = concurrent.futures.wait(
+                running, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    self.results[name] = ('ok', future.result(), None)
+                except Exception as ohno:
+                    self.results[name] = ('FAILED', time.monotonic() - started[name], ohno)
+            if self.timeout:
+                now = time.monotonic()
+                for future, name in list(running.items()):
+                    if name in started and now - started[name] > self.timeout:
+                        # we can't interrupt the thread, but we don't have to wait for it
+                        running.pop(future)
+                        self.results[name] = ('TIMED OUT', now - started[name], TimeoutError(
+                            "took more than {secs}s".format(secs=self.timeout)))
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.show_summary(description, time.monotonic() - batch_start)
+
+        failures = [(name, result[2]) for name, result in self.results.items() if result[2]]
+        if failures:
+            for name, error in failures:
+                print("failed to {desc} for {name}: {error}".format(
+                    desc=description, name=name, error=error))
+            raise RuntimeError("{desc}: {failed} of {total} failed".format(
+                desc=description, failed=len(failures), total=len(tasks)))
+
+    def show_summary(self, description, wall_time):
+        '''display per task timings if verbose, and the overall timing'''
+        if self.verbose:
+            for name, (status, elapsed, _error) in sorted(self.results.items()):
+                print("  {name}: {status} {elapsed:.1f}s".format(
+                    name=name, status=status, elapsed=elapsed))
+        summed = sum(result[1] for result in self.results.values())
+        print("{desc}: {count} done with {workers} workers in {wall:.1f}s wall time,"
+              " {summed:.1f}s summed over all".format(
+                  desc=description, count=len(self.results), workers=self.workers,
+                  wall=wall_time, summed=summed))
+
+
+class ReadinessProbe():
+    '''
+    check whether the service in a container is actually usable, not just
+    whether the container is running, and wait for it with backoff
+
+    database containers are checked by running SELECT 1 in them, php-fpm
+    by sending its ping page a FastCGI request, httpd by getting an HTTP
+    response on port 80, and everything else by getting the sshd banner
+    on port 22; all but the first are done from the host over the set network
+    '''
+    def __init__(self, network_name, db_password, timeout=300, verbose=False):
+        self.network_name = network_name
+        self.db_password = db_password
+        self.timeout = timeout
+        self.verbose = verbose
+
+    @staticmethod
+    def get_kind(basename):
+        '''return the kind of probe we use for the container type'''
+        if basename in ['dbprimary', 'db', 'dbextstore']:
+            return 'mariadb'
+        if basename in ['phpfpm', 'httpd']:
+            return basename
+        return 'sshd'
+
+    def get_address(self, container):
+        '''return the ip address of the container on the set network'''
+        container.reload()
+        networks = container.attrs['NetworkSettings']['Networks']
+        if self.network_name in networks:
+            return networks[self.network_name]['IPAddress']
+        return None
+
+    @staticmethod
+    def read_reply(sock, wanted):
+        '''read from the socket until it closes or we have the wanted number of bytes'''
+        reply = b''
+        while len(reply) < wanted:
+            chunk = sock.recv(wanted - len(reply))
+            if not chunk:
+                break
+            reply += chunk
+        return reply
+
+    def check_mariadb(self, container):
+        '''run SELECT 1 in the container as the db root user'''
+        environment = {}
+        if self.db_password:
+            # this keeps the password out of the container's process list
+            environment['MYSQL_PWD'] = self.db_password
+        result = container.exec_run(['mysql', '-u', 'root', '--connect-timeout=2',
+                                     '-e', 'SELECT 1'], environment=environment)
+        return result.exit_code == 0
+
+    @staticmethod
+    def fcgi_record(rtype, content, request_id=1):
+        '''return a FastCGI record of the given type with the given content'''
+        return struct.pack('>BBHHBx', 1, rtype, request_id, len(content), 0) + content
+
+    @staticmethod
+    def fcgi_params(params):
+        '''encode a dict of FastCGI name-value pairs (all short ones)'''
+        encoded = b''
+        for name, value in params.items():
+            encoded += bytes([len(name), len(value)]) + name.encode() + value.encode()
+        return encoded
+
+    def check_phpfpm(self, container):
+        '''ask php-fpm for its ping page (ping.path in the pool config) via FastCGI'''
+        address = self.get_address(container)
+        if not address:
+            return False
+        params = {'SCRIPT_NAME': '/livez', 'SCRIPT_FILENAME': '/livez', 'REQUEST_URI': '/livez',
+                  'REQUEST_METHOD': 'GET', 'SERVER_PROTOCOL': 'HTTP/1.1'}
+        # begin request (responder role, don't keep the connection), params, empty
+        # params and stdin to say we're done
+        request = (self.fcgi_record(1, struct.pack('>HB5x', 1, 0)) +
+                   self.fcgi_record(4, self.fcgi_params(params)) + self.fcgi_record(4, b'') +
+                   self.fcgi_record(5, b''))
+        with socket.create_connection((address, 9000), timeout=2) as sock:
+            sock.sendall(request)
+            output = b''
+            while True:
+                header = self.read_reply(sock, 8)
+                if len(header) < 8:
+                    break
+                _version, rtype, _reqid, length, padding = struct.unpack('>BBHHBx', header)
+                content = self.read_reply(sock, length + padding)[:length]
+                if rtype == 6:
+                    output += content
+                elif rtype == 3:
+                    break
+        return b'pong' in output
+
+    def check_httpd(self, container):
+        '''make sure we get an http response of some sort on port 80'''
+        address = self.get_address(container)
+        if not address:
+            return False
+        with socket.create_connection((address, 80), timeout=2) as sock:
+            sock.sendall(b'HEAD / HTTP/1.0\r\n\r\n')
+            return self.read_reply(sock, 5) == b'HTTP/'
+
+    def check_sshd(self, container):
+        '''make sure sshd on port 22 gives us its banner'''
+        address = self.get_address(container)
+        if not address:
+            return False
+        with socket.create_connection((address, 22), timeout=2) as sock:
+            return self.read_reply(sock, 4) == b'SSH-'
+
+    def wait_for(self, container, basename):
+        '''wait for the service in the container to be ready, recording how long it took'''
+        with TRACER.span('wait for ' + self.get_kind(basename), container=container.name):
+            self.wait_until_ready(container, basename)
+
+    def wait_until_ready(self, container, basename):
+        '''
+        poll the container until its service is ready, backing off between
+        checks; raise TimeoutError if it isn't ready in time
+        '''
+        check = getattr(self, 'check_' + self.get_kind(basename))
+        start = time.monotonic()
+        delay = 0.1
+        while True:
+            try:
+                if check(container):
+                    if self.verbose:
+                        print("{name} ready after {secs:.1f}s".format(
+                            name=container.name, secs=time.monotonic() - start))
+                    return
+            except OSError:
+                # connection refused, reset and so on, it's just not up yet
+                pass
+            container.reload()
+            if container.status not in ['created', 'running']:
+                raise RuntimeError("container {name} is {status}".format(
+                    name=container.name, status=container.status))
+            if time.monotonic() - start + delay > self.timeout:
+                raise TimeoutError("{name} not ready after {secs}s".format(
+                    name=container.name, secs=self.timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+
 class Containers():
     '''manage the creation, destruction, starting and stoppping of containers as
     defined in a config'''
-    def __init__(self, args, config, labeler, networks):
+    def __init__(self, args, config, labeler, networks, inventory):
         self.args = args
         self.verbose = args['verbose']
         self.dryrun = args['dryrun']
         self.labeler = labeler
         self.nets = networks
         self.config = config
+        self.inventory = inventory
+        # seconds docker waits after asking a container nicely to stop before killing it
+        self.stop_timeout = self.config.config.get('stop_timeout', 10)
+
+    def get_task_runner(self):
+        '''return something to run per-container tasks in parallel as the config says'''
+        return ParallelTasks(self.config.config.get('container_workers', 8),
+                             self.config.config.get('container_timeout', 300),
+                             self.verbose)
+
+    def get_probe(self):
+        '''return a readiness probe for containers in the set'''
+        return ReadinessProbe(self.nets.get_network_name(),
+                              self.config.get_db_root_password(self.args['set']),
+                              self.config.config.get('startup_timeout', 300), self.verbose)
 
     @staticmethod
     def get_known_container_types():
         '''these are the image types we know how to build'''
         return ['snapshot', 'dbprimary', 'dbreplica', 'dbextstore', 'dumpsdata', 'httpd', 'phpfpm']
 
+    @staticmethod
+    def get_startup_tiers():
+        '''
+        container basenames (names without the set prefix or number suffix) in the
+        order they must be started: databases before anything that talks to them,
+        php-fpm before the web server that sends it requests, and the dumps hosts
+        last of all
+        '''
+        return [['dbprimary'], ['db', 'dbextstore'], ['phpfpm'], ['httpd'],
+                ['snapshot', 'dumpsdata']]
+
+    def get_basename(self, container_name):
+        '''return the container name with the set prefix and any -nn suffix removed'''
+        basename = container_name[len(self.args['set']) + 1:]
+        fields = basename.rsplit('-', 1)
+        if len(fields) == 2 and fields[1].isdigit():
+            basename = fields[0]
+        return basename
+
+    def get_startup_order(self, container_ids):
+        '''
+        given the ids of containers to start, return them grouped into lists by
+        startup tier; anything we don't know about goes in with the last tier
+        '''
+        tiers = self.get_startup_tiers()
+        ordered = [[] for _unused in tiers]
+        for entry in container_ids:
+            basename = self.get_basename(self.inventory.get_container(entry).name)
+            tier_index = len(tiers) - 1
+            for index, tier in enumerate(tiers):
+                if basename in tier:
+                    tier_index = index
+            ordered[tier_index].append(entry)
+        return [tier for tier in ordered if tier]
+
     def do_list(self, show_all=False):
         '''
         list all of the containers belonging to the specified set
         '''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        entries = client.containers.list(all=True)
+        entries = self.inventory.get_containers()
         displayed = False
-        padding = max([len(entry.name) for entry in entries])
+        padding = max([len(entry.name) for entry in entries], default=0)
         for entry in entries:
             if 'set' in entry.labels:
                 if show_all or self.args['set'] in entry.labels['set']:
@@ -693,58 +2215,35 @@ class Containers():
 
     def get_container_ids(self, labels=None):
         '''return short ids of the containers for the given set'''
-        containers = []
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        entries = client.containers.list(all=True)
-        if labels:
-            for entry in entries:
-                if self.labeler.has_labels(entry.labels, labels):
-                    containers.append(entry.short_id)
-        else:
-            for entry in entries:
-                print(entry.labels, entry.name)
-                if self.labeler.has_labels(entry.labels, self.labeler.get_set_label()):
-                    containers.append(entry.short_id)
-        return containers
+        if not labels:
+            labels = self.labeler.get_set_label()
+        return [entry.short_id for entry in self.inventory.get_containers(labels)]
 
     def container_exists(self, short_id):
         '''check if the container with the specified id from a container set exists'''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        entries = client.containers.list(all=True)
-        for entry in entries:
-            if self.labeler.has_labels(entry.labels, self.labeler.get_set_label()):
-                if entry.short_id == short_id:
-                    return True
-        return False
+        entry = self.inventory.get_container(short_id)
+        return bool(entry and entry.short_id == short_id and
+                    self.labeler.has_labels(entry.labels, self.labeler.get_set_label()))
 
-    def container_exists_by_name(self, name, containers_known=None):
+    def container_exists_by_name(self, name):
         '''check if the container with the specified name from a container set exists'''
-        if not containers_known:
-            client = DockerClient(base_url='unix://var/run/docker.sock')
-            containers_known = client.containers.list(all=True)
-        for entry in containers_known:
-            if self.labeler.has_labels(entry.labels, self.labeler.get_set_label()):
-                if entry.name == name:
-                    return True
-        return False
+        entry = self.inventory.get_container(name)
+        return bool(entry and entry.name == name and
+                    self.labeler.has_labels(entry.labels, self.labeler.get_set_label()))
 
-    def get_container_ids_from_name(self, name, containers_known=None):
+    def get_container_ids_from_name(self, name):
         '''check if the container with the specified name from a container set exists'''
         container_ids = []
-        if not containers_known:
-            client = DockerClient(base_url='unix://var/run/docker.sock')
-            containers_known = client.containers.list(all=True)
-        for entry in containers_known:
-            if self.labeler.has_labels(entry.labels, self.labeler.get_set_label()):
-                # allow for names like <setname>-snapshot-nn
-                if (entry.name == self.args['set'] + '-' + name or
-                        entry.name.startswith(self.args['set'] + '-' + name + '-')):
-                    container_ids.append(entry.short_id)
+        for entry in self.inventory.get_containers(self.labeler.get_set_label()):
+            # allow for names like <setname>-snapshot-nn
+            if (entry.name == self.args['set'] + '-' + name or
+                    entry.name.startswith(self.args['set'] + '-' + name + '-')):
+                container_ids.append(entry.short_id)
         if container_ids:
             return container_ids
         return None
 
-    def create_one_container(self, name, image, client, containers_known=None, volumes=None):
+    def create_one_container(self, name, image, volumes=None):
         '''
         create a container with the standard attributes given
         the desired container name, labels and image name
@@ -758,20 +2257,21 @@ class Containers():
         if not volumes:
             volumes = {}
 
-        if not self.container_exists_by_name(name, containers_known):
-            client.containers.create(
+        if not self.container_exists_by_name(name):
+            container = self.inventory.client.containers.create(
                 image=image,
                 name=name, detach=True, labels=labels,
                 domainname=self.nets.get_network_name(),
                 network=self.nets.get_network_name(),
                 volumes=volumes)
+            self.inventory.add_container(container)
 
-    def check_and_create(self, opts, client, containers_known, volumes=None):
+    def check_and_create(self, opts, todo, volumes=None):
         '''
         check that we are configured to create this container type,
         and that an absurd number of containers was not requested;
-        if so, create it with the appropriate name from the right
-        image and return
+        if so, add the appropriate name, image and volumes for each
+        container to the todo list, for creation later
 
         the opts passed in should look like:
         {'config': config key for container,
@@ -792,16 +2292,12 @@ class Containers():
                                          maxnum=opts['max'], imagetype=opts['image']))
                 for i in range(container_config):
                     name = self.args['set'] + "-{name}-{:02d}".format(i + 1, name=opts['basename'])
-                    self.create_one_container(
-                        name, 'wikimedia-dumps/{name}-{setname}-final:latest'.format(
-                            name=opts['image'], setname=self.args['set']),
-                        client, containers_known, volumes=volumes)
+                    todo.append((name, 'wikimedia-dumps/{name}-{setname}-final:latest'.format(
+                        name=opts['image'], setname=self.args['set']), volumes))
             else:
                 name = self.args['set'] + "-{name}".format(name=opts['basename'])
-                self.create_one_container(
-                    name, 'wikimedia-dumps/{name}-{setname}-final:latest'.format(
-                        name=opts['image'], setname=self.args['set']),
-                    client, containers_known, volumes=volumes)
+                todo.append((name, 'wikimedia-dumps/{name}-{setname}-final:latest'.format(
+                    name=opts['image'], setname=self.args['set']), volumes))
 
     def do_create(self):
         '''
@@ -814,15 +2310,13 @@ class Containers():
             print("creating network if needed")
         self.nets.create_network()
 
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        containers_known = client.containers.list(all=True)
-
         if self.args['name']:
             todos = [self.args['name']]
         else:
             todos = self.get_known_container_types()
 
         config = self.config.get_containerset_config(self.args['set'])
+        todo = []
 
         # snapshot containers
         if 'snapshot' in todos:
@@ -839,27 +2333,24 @@ class Containers():
 
             self.check_and_create({'config': 'snapshots', 'max': 99,
                                    'basename': 'snapshot', 'image': 'snapshot'},
-                                  client, containers_known, volumes)
+                                  todo, volumes)
 
         # mariadb primary server container
         if 'dbprimary' in todos:
             self.check_and_create({'config': 'dbprimary', 'max': None,
-                                   'basename': 'dbprimary', 'image': 'dbprimary'},
-                                  client, containers_known)
+                                   'basename': 'dbprimary', 'image': 'dbprimary'}, todo)
 
         # mariadb replica containers
         # FIXME no image yet
         if 'dbreplica' in todos:
             self.check_and_create({'config': 'dbreplicas', 'max': 99,
-                                   'basename': 'db', 'image': 'dbreplica'},
-                                  client, containers_known)
+                                   'basename': 'db', 'image': 'dbreplica'}, todo)
 
         # external storage (content blobs) container
         # FIXME no image yet
         if 'dbextstore' in todos:
             self.check_and_create({'config': 'dbextstore', 'max': None,
-                                   'basename': 'dbextstore', 'image': 'dbextstore'},
-                                  client, containers_known)
+                                   'basename': 'dbextstore', 'image': 'dbextstore'}, todo)
 
         # httpd container
         if 'httpd' in todos:
@@ -868,7 +2359,7 @@ class Containers():
 
             self.check_and_create({'config': 'httpd', 'max': None,
                                    'basename': 'httpd', 'image': 'httpd'},
-                                  client, containers_known, volumes)
+                                  todo, volumes)
 
         # phpfpm container
         if 'phpfpm' in todos:
@@ -877,14 +2368,19 @@ class Containers():
 
             self.check_and_create({'config': 'phpfpm', 'max': None,
                                    'basename': 'phpfpm', 'image': 'phpfpm'},
-                                  client, containers_known, volumes)
+                                  todo, volumes)
 
         # nfs server (dumpsdata) container
         # FIXME no image yet
         if 'dumpsdata' in todos:
             self.check_and_create({'config': 'dumpsdata', 'max': None,
-                                   'basename': 'dumpsdata', 'image': 'dumpsdata'},
-                                  client, containers_known)
+                                   'basename': 'dumpsdata', 'image': 'dumpsdata'}, todo)
+
+        # the network exists by now, and creating the containers themselves
+        # can all happen at once
+        self.get_task_runner().run("create containers", [
+            (name, functools.partial(self.create_one_container, name, image, volumes))
+            for name, image, volumes in todo])
 
     def do_destroy(self, do_all=False):
         '''
@@ -892,17 +2388,13 @@ class Containers():
         set or all containers for all wikifarms.
         If the desired container(s) do not exist, just return
         '''
-
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-
         if do_all:
             # all sets
             container_ids = self.get_container_ids(self.labeler.get_blame_label())
             message = "all containers for all container sets"
         elif self.args['name']:
             # specified container
-            containers_known = client.containers.list(all=True)
-            container_ids = self.get_container_ids_from_name(self.args['name'], containers_known)
+            container_ids = self.get_container_ids_from_name(self.args['name'])
             message = "the specified container in this set "
         else:
             # just this set
@@ -916,67 +2408,705 @@ class Containers():
             print("No containers to remove")
             return True
 
-        for entry in container_ids:
-            container = client.containers.get(entry)
-
-            if self.dryrun:
-                print("would stop and remove container", entry)
-                continue
-
+        def destroy_one(entry):
+            container = self.inventory.get_container(entry)
             if self.verbose:
                 print("stopping container:", entry)
-            container.stop()
+            container.stop(timeout=self.stop_timeout)
             if self.verbose:
                 print("removing container:", entry)
-            container.remove()
+            self.inventory.remove_container(container)
+
+        if self.dryrun:
+            for entry in container_ids:
+                print("would stop and remove container", entry)
+            return True
+
+        self.get_task_runner().run("stop and remove containers", [
+            (entry, functools.partial(destroy_one, entry)) for entry in container_ids or []])
         return True
 
     def do_start(self):
         '''
         start containers associated with a wikifarm set.
         this will create the containers if needed.
+
+        containers are started a tier at a time (see get_startup_tiers), all the
+        containers in a tier at once, and we go on to the next tier only when
+        the services in the current one actually respond. when this returns,
+        the set is ready for use.
         '''
         self.do_create()
 
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        containers_known = client.containers.list(all=True)
-
         if self.args['name']:
-            container_ids = self.get_container_ids_from_name(self.args['name'], containers_known)
+            container_ids = self.get_container_ids_from_name(self.args['name'])
         else:
-            container_ids = self.get_container_ids(self.labeler.get_blame_label())
+            container_ids = self.get_container_ids(self.labeler.get_set_label())
 
-        for entry in container_ids:
-            container = client.containers.get(entry)
-            if self.dryrun:
-                print("would start container:", entry)
-                continue
+        probe = self.get_probe()
 
+        def start_one(entry):
+            container = self.inventory.get_container(entry)
             if self.verbose:
                 print("starting container:", entry)
             container.start()
+            probe.wait_for(container, self.get_basename(container.name))
+
+        for tier in self.get_startup_order(container_ids or []):
+            if self.dryrun:
+                for entry in tier:
+                    print("would start container:", entry)
+                continue
+            self.get_task_runner().run("start containers", [
+                (entry, functools.partial(start_one, entry)) for entry in tier])
 
     def do_stop(self):
         '''
         stop containers associated with a wikifarm set.
         If the containers do not exist for this set, just return
         '''
-        client = DockerClient(base_url='unix://var/run/docker.sock')
-        containers_known = client.containers.list(all=True)
         if self.args['name']:
-            container_ids = self.get_container_ids_from_name(self.args['name'], containers_known)
+            container_ids = self.get_container_ids_from_name(self.args['name'])
         else:
-            container_ids = self.get_container_ids(self.labeler.get_blame_label())
+            container_ids = self.get_container_ids(self.labeler.get_set_label())
 
-        for entry in container_ids:
-            container = client.containers.get(entry)
-            if self.dryrun:
+        def stop_one(entry):
+            if self.verbose:
+                print("stopping container:", entry)
+            self.inventory.get_container(entry).stop(timeout=self.stop_timeout)
+
+        if self.dryrun:
+            for entry in container_ids:
                 print("would stop container:", entry)
-                continue
+            return
+
+        self.get_task_runner().run("stop containers", [
+            (entry, functools.partial(stop_one, entry)) for entry in container_ids or []])
 
+
+class Snapshots():
+    '''
+    checkpoint the db servers of a set, and optionally its dump run output,
+    and put them back the way they were later, much faster than destroying
+    the set and creating it again from the final images
+
+    the db data lives in each container's own writable layer, so a snapshot of
+    a db container is a docker commit of it: the container is paused for the
+    commit, which gives a crash-consistent copy of the datadir that innodb
+    recovers on start, just as it would after a power cut, so the server does
+    not have to be stopped. only the layer of changes since the container was
+    created gets written. a reset replaces each db container with one created
+    from its snapshot image, under the same name, on the same network.
+
+    dump run output is on a host volume; it is copied to a directory next to
+    it, with reflinks on filesystems that can do them (btrfs, xfs) so that the
+    copy takes no time or space to speak of, and with a plain copy elsewhere
+    '''
+    # basenames of the containers with db data in them
+    DB_BASENAMES = ['dbprimary', 'db', 'dbextstore']
+
+    def __init__(self, args, config, containers, inventory):
+        self.args = args
+        self.verbose = args['verbose']
+        self.dryrun = args['dryrun']
+        self.config = config
+        self.containers = containers
+        self.inventory = inventory
+
+    @staticmethod
+    def get_image_repo(container_name):
+        '''return the name of the snapshot images for a container, without a tag'''
+        return 'wikimedia-dumps/{name}-snapshot'.format(name=container_name)
+
+    def get_image_name(self, container_name):
+        '''return the name of the snapshot image for a container'''
+        return '{repo}:{tag}'.format(repo=self.get_image_repo(container_name),
+                                     tag=self.args['tag'])
+
+    def get_db_containers(self):
+        '''return the containers in the set that have db data in them'''
+        return [container for container in self.inventory.get_containers(
+            self.containers.labeler.get_set_label())
+                if self.containers.get_basename(container.name) in self.DB_BASENAMES]
+
+    def get_db_container_names(self):
+        '''
+        return the names of the db containers the set has now, along with those
+        its config says it has, so that snapshots can be found even for containers
+        that are gone
+        '''
+        setname = self.args['set']
+        config = self.config.get_containerset_config(setname)
+        names = {container.name for container in self.get_db_containers()}
+        names.add(setname + '-dbprimary')
+        names.update(setname + '-db-{:02d}'.format(i + 1)
+                     for i in range(config.get('dbreplicas') or 0))
+        if config.get('dbextstore'):
+            names.add(setname + '-dbextstore')
+        return sorted(names)
+
+    def get_runs_paths(self):
+        '''return the path to the dump runs volume for the set and to its snapshot copy'''
+        runs = self.config.retrieve_value(self.config.get_containerset_config(self.args['set']),
+                                          ['volumes', 'dumpsruns'])
+        if not runs:
+            raise ValueError("No dumpsruns volume configured for set " + self.args['set'])
+        runs = runs.rstrip('/')
+        return runs, "{runs}.snapshot-{tag}".format(runs=runs, tag=self.args['tag'])
+
+    @staticmethod
+    def copy_tree(source, dest):
+        '''
+        replace the contents of the dest directory with a copy of the contents of
+        the source directory, sharing blocks between the two where we can
+        '''
+        os.makedirs(dest, exist_ok=True)
+        for entry in os.listdir(dest):
+            path = os.path.join(dest, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        subprocess.run(["cp", "-a", "--reflink=auto", os.path.join(source, "."), dest],
+                       check=True)
+
+    def do_snapshot(self):
+        '''checkpoint the db containers in the set, and the dump runs if asked'''
+        start = time.monotonic()
+        db_containers = self.get_db_containers()
+        if not db_containers:
+            print("no db containers to snapshot for set", self.args['set'])
+            return
+
+        def commit_one(container):
+            image_name = self.get_image_name(container.name)
             if self.verbose:
-                print("stopping container:", entry)
-            container.stop()
+                print("committing {name} to {image}".format(name=container.name, image=image_name))
+            repository, tag = image_name.rsplit(':', 1)
+            self.inventory.add_image(container.commit(
+                repository=repository, tag=tag, pause=True,
+                message="snapshot of {name}".format(name=container.name)))
+
+        if self.dryrun:
+            for container in db_containers:
+                print("would commit container {name} to {image}".format(
+                    name=container.name, image=self.get_image_name(container.name)))
+        else:
+            self.containers.get_task_runner().run("snapshot containers", [
+                (container.name, functools.partial(commit_one, container))
+                for container in db_containers])
+        if self.args['withruns']:
+            runs, runs_snapshot = self.get_runs_paths()
+            if self.dryrun:
+                print("would copy {runs} to {dest}".format(runs=runs, dest=runs_snapshot))
+            else:
+                self.copy_tree(runs, runs_snapshot)
+        print("snapshot {tag} of set {setname} taken in {secs:.1f}s".format(
+            tag=self.args['tag'], setname=self.args['set'], secs=time.monotonic() - start))
+
+    def do_reset(self):
+        '''put the db containers in the set, and the dump runs if asked, back to a snapshot'''
+        start = time.monotonic()
+        db_containers = self.get_db_containers()
+        missing = [self.get_image_name(container.name) for container in db_containers
+                   if not self.inventory.get_image(self.get_image_name(container.name))]
+        if missing:
+            raise ValueError("No snapshot image(s) {images} for set {setname}".format(
+                images=', '.join(missing), setname=self.args['set']))
+        probe = self.containers.get_probe()
+
+        def reset_one(container):
+            name = container.name
+            if self.verbose:
+                print("replacing {name} with {image}".format(
+                    name=name, image=self.get_image_name(name)))
+            # whatever is in the container now is about to be thrown away, so no
+            # need to give the server time to shut down nicely
+            container.reload()
+            if container.status == 'running':
+                container.kill()
+            self.inventory.remove_container(container)
+            self.containers.create_one_container(name, self.get_image_name(name))
+            replacement = self.inventory.get_container(name)
+            replacement.start()
+            probe.wait_for(replacement, self.containers.get_basename(name))
+
+        if self.dryrun:
+            for container in db_containers:
+                print("would replace container {name} with one from {image}".format(
+                    name=container.name, image=self.get_image_name(container.name)))
+        else:
+            self.containers.get_task_runner().run("reset containers", [
+                (container.name, functools.partial(reset_one, container))
+                for container in db_containers])
+        if self.args['withruns']:
+            runs, runs_snapshot = self.get_runs_paths()
+            if not os.path.exists(runs_snapshot):
+                raise ValueError("No snapshot {path} of the dump runs".format(path=runs_snapshot))
+            if self.dryrun:
+                print("would copy {dest} back to {runs}".format(runs=runs, dest=runs_snapshot))
+            else:
+                self.copy_tree(runs_snapshot, runs)
+        print("set {setname} reset to snapshot {tag} in {secs:.1f}s".format(
+            tag=self.args['tag'], setname=self.args['set'], secs=time.monotonic() - start))
+
+    def do_remove(self):
+        '''remove the snapshot images, all tags, for the db containers in the set'''
+        # exact names, so that another set whose name starts with ours is left alone
+        repos = [self.get_image_repo(name) for name in self.get_db_container_names()]
+        for entry in self.inventory.get_images():
+            for tag in entry.tags:
+                if tag.rpartition(':')[0] in repos:
+                    if self.verbose:
+                        print("removing {name} image".format(name=tag))
+                    if not self.dryrun:
+                        self.inventory.remove_image(tag)
+
+
+class PrefixedOutput():
+    '''
+    write output from a command in a container to stdout a line at a time,
+    each line prefixed with the container name, so that output from
+    several containers at once can be told apart
+    '''
+    def __init__(self, label, lock):
+        self.label = label
+        self.lock = lock
+        self.partial = b''
+
+    def show(self, lines):
+        '''display complete lines'''
+        with self.lock:
+            for line in lines:
+                print("[{label}] {line}".format(
+                    label=self.label, line=line.decode('utf-8', errors='replace')), flush=True)
+
+    def write(self, chunk):
+        '''display whatever complete lines we have now'''
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        self.show(lines)
+
+    def close(self):
+        '''display anything left over'''
+        if self.partial:
+            self.show([self.partial])
+            self.partial = b''
+
+
+class ContainerChannel():
+    '''
+    run commands in the containers of a set, and copy files and directories
+    into and out of them, through the docker api: no ssh, sshd, passwords
+    or name resolution needed, and no handshake for each command
+
+    containers are given by their name within the set, such as 'snapshot-01'
+    or 'dbprimary', or by type, such as 'snapshot', which means all of the
+    snapshot containers, or 'all' for every container in the set; when there
+    are several, the work is done in all of them at once
+    '''
+    def __init__(self, args, containers, inventory):
+        self.args = args
+        self.verbose = args['verbose']
+        self.dryrun = args['dryrun']
+        self.containers = containers
+        self.inventory = inventory
+        self.output_lock = threading.Lock()
+
+    def resolve(self, target):
+        '''
+        return the list of containers in the set for the name or type given,
+        sorted by name, or raise ValueError if there are none
+        '''
+        in_set = sorted(self.inventory.get_containers(self.containers.labeler.get_set_label()),
+                        key=lambda entry: entry.name)
+        if target == 'all':
+            found = in_set
+        else:
+            found = [entry for entry in in_set
+                     if entry.name in [self.args['set'] + '-' + target, target]]
+            if not found:
+                found = [entry for entry in in_set
+                         if self.containers.get_basename(entry.name) == target]
+        if not found:
+            raise ValueError("No container {target} in set {setname}".format(
+                target=target, setname=self.args['set']))
+        return found
+
+    def run(self, container, command, output, workdir=None, env=None):
+        '''
+        run the command (a list, or a string for the shell) in the container,
+        writing its output to output as it comes, and return the exit code
+        '''
+        if isinstance(command, str):
+            command = ["/bin/bash", "-c", command]
+        api = self.inventory.client.api
+        exec_id = api.exec_create(container.id, command, workdir=workdir, environment=env)
+        for chunk in api.exec_start(exec_id, stream=True):
+            output.write(chunk)
+        return api.exec_inspect(exec_id)['ExitCode']
+
+    def run_all(self, target, command, workdir=None, env=None):
+        '''
+        run the command in every container for the target at once, showing the
+        output of each line by line; raise if it fails anywhere
+        '''
+        found = self.resolve(target)
+        if self.dryrun:
+            for container in found:
+                print("would run {command} in {name}".format(command=command,
+                                                             name=container.name))
+            return
+
+        def run_one(container):
+            output = PrefixedOutput(container.name, self.output_lock)
+            try:
+                exit_code = self.run(container, command, output, workdir, env)
+            finally:
+                output.close()
+            if exit_code:
+                raise RuntimeError("exited with {code}".format(code=exit_code))
+
+        self.containers.get_task_runner().run("run command", [
+            (container.name, functools.partial(run_one, container)) for container in found])
+
+    @staticmethod
+    def get_local_entries(source):
+        '''
+        return the list of (full path, name in archive) for the local file or
+        directory and everything under it, with the archive names starting
+        from the basename of the source
+        '''
+        source = os.path.abspath(source)
+        topdir = os.path.dirname(source)
+        entries = [(source, os.path.basename(source))]
+        if os.path.isdir(source):
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames.sort()
+                for name in dirnames + sorted(filenames):
+                    fullpath = os.path.join(dirpath, name)
+                    entries.append((fullpath, os.path.relpath(fullpath, topdir)))
+        return entries
+
+    def put(self, container, source, dest):
+        '''copy the local file or directory into the directory dest in the container'''
+        if not container.put_archive(dest, BuildContext.stream_entries(
+                self.get_local_entries(source))):
+            raise RuntimeError("failed to copy {source} to {name}:{dest}".format(
+                source=source, name=container.name, dest=dest))
+
+    @staticmethod
+    def extract(chunks, dest):
+        '''extract a tar archive from a generator of chunks into the local directory dest'''
+        os.makedirs(dest, exist_ok=True)
+        with tarfile.open(fileobj=io.BufferedReader(ChunkReader(chunks)), mode='r|') as tar:
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(dest, filter='data')
+            else:
+                tar.extractall(dest)
+
+    def get(self, container, source, dest):
+        '''copy the file or directory source in the container into the local directory dest'''
+        chunks, _stat = container.get_archive(source)
+        self.extract(chunks, dest)
+
+    @staticmethod
+    def split_path(path):
+        '''
+        given <container>:<path> return (container, path), or (None, path) for
+        a local path
+        '''
+        name, sep, rest = path.partition(':')
+        if sep and name and '/' not in name:
+            return name, rest
+        return None, path
+
+    def copy(self, source, dest):
+        '''
+        copy a local file or directory into a directory in the containers, given
+        as <container>:<path>, or copy a file or directory from the containers,
+        given as <container>:<path>, into a local directory; when copying from
+        several containers, each one's copy goes in a subdirectory named for it
+        '''
+        from_target, from_path = self.split_path(source)
+        to_target, to_path = self.split_path(dest)
+        if bool(from_target) == bool(to_target):
+            raise ValueError("Exactly one of the source and destination must be "
+                             "<container>:<path>")
+        found = self.resolve(from_target or to_target)
+        tasks = []
+        for container in found:
+            if to_target:
+                task = functools.partial(self.put, container, from_path, to_path)
+                description = "{source} to {name}:{dest}".format(
+                    source=from_path, name=container.name, dest=to_path)
+            else:
+                local = to_path
+                if len(found) > 1:
+                    local = os.path.join(to_path, container.name)
+                task = functools.partial(self.get, container, from_path, local)
+                description = "{name}:{source} to {dest}".format(
+                    source=from_path, name=container.name, dest=local)
+            if self.dryrun:
+                print("would copy " + description)
+            else:
+                if self.verbose:
+                    print("copying " + description)
+                tasks.append((container.name, task))
+        self.containers.get_task_runner().run("copy files", tasks)
+
+    def do_exec(self):
+        '''run the command given on the command line in the containers named'''
+        command = self.args['remainder']
+        if len(command) == 1:
+            command = command[0]
+        self.run_all(self.args['container'], command)
+
+    def do_copy(self):
+        '''do the copy given on the command line'''
+        self.copy(*self.args['remainder'])
+
+
+class DataExports():
+    '''
+    export tablespace archives of wikis from the running dbprimary container of
+    a set into the set's imports directory, where the next build of the db data
+    image picks them up and loads them in place of replaying the sql dumps
+
+    the work is done inside the container by the image setup script, which
+    flushes each wiki's tables for export and copies their files while they
+    are locked; we then copy the archives out through the docker api
+    '''
+    EXPORT_DIR = '/root/exports'
+
+    def __init__(self, args, config, channel):
+        self.args = args
+        self.verbose = args['verbose']
+        self.dryrun = args['dryrun']
+        self.config = config
+        self.channel = channel
+
+    def get_wikis(self):
+        '''return the wikis to export: the ones from the command line, or all of the set's'''
+        wikis = self.config.get_containerset_config(self.args['set']).get('wikidbs') or []
+        if not self.args['wikis']:
+            return wikis
+        wanted = [wiki for wiki in self.args['wikis'].split(',') if wiki]
+        unknown = [wiki for wiki in wanted if wiki not in wikis]
+        if unknown:
+            raise ValueError("Wiki(s) not in set {setname}: {wikis}".format(
+                setname=self.args['set'], wikis=', '.join(unknown)))
+        return wanted
+
+    def do_export(self):
+        '''export the wikis from the set's dbprimary container'''
+        wikis = self.get_wikis()
+        container = self.channel.resolve('dbprimary')[0]
+        importdir = os.path.join(os.getcwd(), 'docker_helpers', 'mariadb', 'imports',
+                                 self.args['set'])
+        if self.dryrun:
+            print("would export {wikis} from {name} into {importdir}".format(
+                wikis=', '.join(wikis), name=container.name, importdir=importdir))
+            return
+        command = ["python3", "/root/setup_image.py", "--stage", "export", "--type", "dbprimary",
+                   "--set", self.args['set'], "--wikis", ",".join(wikis)]
+        output = PrefixedOutput(container.name, self.channel.output_lock)
+        try:
+            with TRACER.span('export', set=self.args['set'], wikis=len(wikis)):
+                exit_code = self.channel.run(container, command, output)
+        finally:
+            output.close()
+        if exit_code:
+            raise RuntimeError("export in {name} exited with {code}".format(
+                name=container.name, code=exit_code))
+        for wiki in wikis:
+            self.channel.get(container, os.path.join(self.EXPORT_DIR,
+                                                     wiki + Images.TABLESPACES_SUFFIX), importdir)
+            if self.verbose:
+                print("copied the tablespace archive for {wiki} into {importdir}".format(
+                    wiki=wiki, importdir=importdir))
+        self.channel.run(container, ["rm", "-rf", self.EXPORT_DIR], io.BytesIO())
+        print("exported {wikis}; the next build of the db data image for the set will "
+              "load them from their archives".format(wikis=', '.join(wikis)))
+
+
+class DumpsTestRunner():
+    '''
+    run tests defined in the config on the snapshot containers of a set
+
+    each test is a list of steps, shell commands run one after the other
+    via docker exec; a test stops at its first failed step. when there are
+    several tests and several snapshot containers, the tests are dealt out
+    among the containers and each container works through its share while
+    the others do the same.
+
+    the output of every step, and a results.json file with the exit code
+    and wall time of each one, go into a directory for the run under the
+    configured results directory
+    '''
+    def __init__(self, args, config, channel):
+        self.args = args
+        self.verbose = args['verbose']
+        self.dryrun = args['dryrun']
+        self.config = config
+        self.channel = channel
+        # test name -> list of step results
+        self.results = {}
+
+    @staticmethod
+    def get_set_tests(config, setname):
+        '''return the list of names of tests configured for the set'''
+        tests = (config.config.get('tests') or {}).get(setname) or []
+        if isinstance(tests, str):
+            tests = [tests]
+        return tests
+
+    @staticmethod
+    def resolve(testspec, config):
+        '''
+        given a test spec from the command line, [<setname>:]<testname>[,<testname>...],
+        return the set name and the list of test names; 'all' for the test name means
+        every test configured for the set. if no set name is given, the one set with
+        all of the tests configured is used
+        '''
+        setname = None
+        if ':' in testspec:
+            setname, testspec = testspec.split(':', 1)
+        testnames = [name.strip() for name in testspec.split(',') if name.strip()]
+        if not testnames:
+            raise ValueError("No test name specified")
+
+        if setname is None:
+            candidates = [name for name in config.config.get('tests') or {}
+                          if testnames == ['all'] or
+                          set(testnames) <= set(DumpsTestRunner.get_set_tests(config, name))]
+            if len(candidates) != 1:
+                raise ValueError("Test(s) {tests} configured for {count} sets; "
+                                 "specify <setname>:<testname>".format(
+                                     tests=', '.join(testnames), count=len(candidates)))
+            setname = candidates[0]
+        if setname not in config.config['sets']:
+            raise ValueError("Unknown set specified: " + setname)
+
+        set_tests = DumpsTestRunner.get_set_tests(config, setname)
+        if testnames == ['all']:
+            testnames = set_tests
+        missing = [name for name in testnames if name not in set_tests]
+        if missing:
+            raise ValueError("Test(s) not configured for set {setname}: {tests}".format(
+                setname=setname, tests=', '.join(missing)))
+        undefined = [name for name in testnames
+                     if name not in (config.config.get('testdefs') or {})]
+        if undefined:
+            raise ValueError("No definition in testdefs for test(s): " + ', '.join(undefined))
+        return setname, testnames
+
+    def get_steps(self, testname):
+        '''return the list of steps for the test, each a dict with a name and command'''
+        steps = (self.config.config['testdefs'][testname] or {}).get('steps') or []
+        for index, step in enumerate(steps):
+            if 'command' not in step:
+                raise ValueError("Step {num} of test {test} has no command".format(
+                    num=index + 1, test=testname))
+        return steps
+
+    def get_results_dir(self):
+        '''return the directory where output and results for this run go, creating it'''
+        topdir = (self.config.config.get('test_results') or
+                  os.path.join(os.getcwd(), 'test_results'))
+        path = os.path.join(topdir, self.args['set'], time.strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def run_step(self, container, step, logpath):
+        '''
+        run one step in the container, writing its output to the log file as it
+        comes, and return the exit code
+        '''
+        with open(logpath, "wb") as fhandle:
+            return self.channel.run(container, step['command'], fhandle,
+                                    step.get('workdir'), step.get('env'))
+
+    def run_test(self, container, testname, resultsdir):
+        '''run the steps of one test in order, stopping at the first failure'''
+        results = []
+        self.results[testname] = results
+        for index, step in enumerate(self.get_steps(testname)):
+            name = step.get('name') or "step{num}".format(num=index + 1)
+            logpath = os.path.join(resultsdir, "{test}.{num:02d}.{name}.log".format(
+                test=testname, num=index + 1, name=name))
+            if self.verbose:
+                print("running {test} step {name} on {container}".format(
+                    test=testname, name=name, container=container.name))
+            start = time.monotonic()
+            with TRACER.span('test step', set=self.args['set'], test=testname, step=name,
+                             container=container.name):
+                exit_code = self.run_step(container, step, logpath)
+            results.append({'step': name, 'command': step['command'], 'container': container.name,
+                            'exit_code': exit_code, 'elapsed': round(time.monotonic() - start, 3),
+                            'log': os.path.basename(logpath)})
+            if exit_code:
+                raise RuntimeError("test {test} step {name} exited with {code}".format(
+                    test=testname, name=name, code=exit_code))
+
+    def run_tests(self, container, testnames, resultsdir):
+        '''
+        run the tests one after the other in the container, going on to the
+        next one if a test fails, and raise if any of them failed
+        '''
+        failed = []
+        for testname in testnames:
+            try:
+                self.run_test(container, testname, resultsdir)
+            except RuntimeError as ohno:
+                print(ohno)
+                failed.append(testname)
+        if failed:
+            raise RuntimeError("failed tests: " + ', '.join(failed))
+
+    def show_results(self, testnames):
+        '''display the outcome and time of each step of each test'''
+        print("test summary for set {setname}:".format(setname=self.args['set']))
+        for testname in testnames:
+            results = self.results.get(testname)
+            if not results:
+                print("  {test}: not run".format(test=testname))
+                continue
+            print("  {test} on {container}:".format(test=testname,
+                                                    container=results[0]['container']))
+            for result in results:
+                print("    {step} exit {code} {elapsed:.1f}s".format(
+                    step=result['step'], code=result['exit_code'], elapsed=result['elapsed']))
+
+    def do_tests(self):
+        '''run the tests named in the args; the set must already be started'''
+        testnames = self.args['tests']
+        for testname in testnames:
+            self.get_steps(testname)
+        snapshots = self.channel.resolve('snapshot')
+        if self.dryrun:
+            for index, testname in enumerate(testnames):
+                print("would run test {test} on {container}".format(
+                    test=testname, container=snapshots[index % len(snapshots)].name))
+            return
+
+        # deal the tests out among the containers
+        todo = {}
+        for index, testname in enumerate(testnames):
+            todo.setdefault(snapshots[index % len(snapshots)], []).append(testname)
+
+        resultsdir = self.get_results_dir()
+        print("test output and results will be in", resultsdir)
+        self.results = {}
+        runner = ParallelTasks(len(todo), self.config.config.get('test_timeout'), self.verbose)
+        try:
+            runner.run("run tests", [
+                (container.name, functools.partial(self.run_tests, container, tests, resultsdir))
+                for container, tests in todo.items()])
+        finally:
+            with open(os.path.join(resultsdir, "results.json"), "w") as fhandle:
+                json.dump(self.results, fhandle, indent=4, sort_keys=True)
+            self.show_results(testnames)
 
 
 class WikifarmSets():
@@ -984,11 +3114,15 @@ class WikifarmSets():
     manage the build and running of images and containers as defined
     in a config
     '''
-    def __init__(self, args, images, containers):
+    def __init__(self, args, images, containers, snapshots, channel, tests, exports):
         self.args = args
         self.verbose = args['verbose']
         self.images = images
         self.containers = containers
+        self.snapshots = snapshots
+        self.channel = channel
+        self.tests = tests
+        self.exports = exports
 
     def show_wikifarm_info(self):
         '''display the sets, images and containers known for all wikifarms'''
@@ -1015,6 +3149,8 @@ class WikifarmSets():
             self.images.do_final_build()
         elif self.args['command'] == 'base':
             self.images.do_base_build()
+        elif self.args['command'] == 'plan':
+            self.images.show_build_plan()
         elif self.args['command'] == 'start':
             self.images.do_final_build()
             self.containers.do_start()
@@ -1023,13 +3159,29 @@ class WikifarmSets():
             self.containers.do_create()
         elif self.args['command'] == 'stop':
             self.containers.do_stop()
+        elif self.args['command'] == 'test':
+            self.images.do_final_build()
+            self.containers.do_start()
+            self.tests.do_tests()
+        elif self.args['command'] == 'exec':
+            self.channel.do_exec()
+        elif self.args['command'] == 'cp':
+            self.channel.do_copy()
+        elif self.args['command'] == 'export':
+            self.exports.do_export()
+        elif self.args['command'] == 'snapshot':
+            self.snapshots.do_snapshot()
+        elif self.args['command'] == 'reset':
+            self.snapshots.do_reset()
         elif self.args['command'] == 'destroy':
             self.containers.do_destroy()
         elif self.args['command'] == 'remove':
             self.containers.do_destroy()
+            self.snapshots.do_remove()
             self.images.do_remove()
         elif self.args['command'] == 'purge':
             self.containers.do_destroy()
+            self.snapshots.do_remove()
             self.images.do_remove()
             self.images.do_purge()
         elif self.args['command'] == 'purgeall':
@@ -1042,6 +3194,131 @@ class WikifarmSets():
             self.images.do_purgeall()
 
 
+class SetBatch():
+    '''
+    run one command over several sets at once, sharing the config, the
+    docker client and the image builds among them
+
+    the images for all the sets are planned and built as one batch, so the
+    base images and any db data image that sets have in common are built
+    just once; after that the container work for each set runs alongside
+    that for the others, and a summary for each set is shown at the end
+    '''
+    COMMANDS = ['build', 'create', 'start', 'stop', 'destroy']
+
+    def __init__(self, args, config, inventory, setnames):
+        self.args = args
+        self.verbose = args['verbose']
+        self.config = config
+        self.inventory = inventory
+        self.setnames = setnames
+        self.digests = FileDigests(os.path.join(os.getcwd(), '.build_digests.json'))
+        self.output_lock = threading.Lock()
+        # set name -> WikifarmSets
+        self.farms = {}
+        for setname in self.setnames:
+            set_args = dict(args)
+            set_args['set'] = setname
+            self.farms[setname] = get_wikifarm(set_args, config, inventory, self.digests,
+                                               self.output_lock)
+
+    @staticmethod
+    def is_batch(setnames):
+        '''return True if the set names given on the command line are for more than one set'''
+        return setnames == 'all' or ',' in setnames
+
+    @staticmethod
+    def get_set_names(setnames, config):
+        '''
+        given 'all' or a comma-separated list of set names, return the list of
+        set names, checking that each one is in the config
+        '''
+        known = list(config.config['sets'])
+        if setnames == 'all':
+            return known
+        wanted = []
+        for setname in setnames.split(','):
+            setname = setname.strip()
+            if setname and setname not in wanted:
+                wanted.append(setname)
+        unknown = [setname for setname in wanted if setname not in known]
+        if unknown:
+            raise ValueError("Unknown set(s) specified: " + ', '.join(unknown))
+        return wanted
+
+    def do_builds(self):
+        '''
+        build the base and final images for all of the sets in one go, building
+        each image only once even if several sets need it
+        '''
+        # tag -> Images instance for the set that will build it
+        owners = {}
+        targets = []
+        for setname in self.setnames:
+            images = self.farms[setname].images
+            images.write_set_files()
+            for target in images.get_base_targets() + images.get_final_targets():
+                if target.tag not in owners:
+                    owners[target.tag] = images
+                    targets.append(target)
+        self.farms[self.setnames[0]].images.run_builds(
+            targets, lambda target: owners[target.tag].build_one(target))
+
+    def get_set_task(self, setname):
+        '''return the callable that does the container work for the command for one set'''
+        containers = self.farms[setname].containers
+        command = self.args['command']
+        if command == 'create':
+            return containers.do_create
+        if command == 'start':
+            return containers.do_start
+        if command == 'stop':
+            return containers.do_stop
+        if command == 'destroy':
+            return containers.do_destroy
+        return None
+
+    def show_results(self, runner):
+        '''display the outcome and time taken for each set'''
+        padding = max(len(setname) for setname in self.setnames)
+        print("{command} summary:".format(command=self.args['command']))
+        for setname in self.setnames:
+            status, elapsed, error = runner.results.get(setname, ('not run', None, None))
+            if elapsed is None:
+                elapsed_text = '-'
+            else:
+                elapsed_text = "{secs:.1f}s".format(secs=elapsed)
+            print("  {name} {status:<10} {elapsed}{error}".format(
+                name=setname.ljust(padding), status=status, elapsed=elapsed_text,
+                error="  " + str(error) if error else ""))
+
+    def do_command(self):
+        '''run the command for all of the sets'''
+        if self.args['dryrun']:
+            print("Dry run: no images or containers will be acted upon")
+        if self.verbose:
+            print("running {command} for sets: {sets}".format(
+                command=self.args['command'], sets=', '.join(self.setnames)))
+
+        if self.args['command'] in ['build', 'create', 'start']:
+            self.do_builds()
+        if self.args['command'] == 'build':
+            return
+
+        # load everything up front, rather than have each set's threads race to do it
+        self.inventory.load_images()
+        self.inventory.load_containers()
+        self.inventory.load_networks()
+
+        runner = ParallelTasks(self.config.config.get('set_workers', len(self.setnames)),
+                               verbose=self.verbose)
+        try:
+            runner.run(self.args['command'] + " sets", [
+                (setname, self.get_set_task(setname)) for setname in self.setnames])
+        finally:
+            self.show_results(runner)
+
+
 class DumpsTestbedOpts():
     '''
     deal with command line options for this script
@@ -1068,25 +3345,34 @@ and the default values for every setting.  Multiple such definitions may be defi
 in the configuration file; each such definition is a "container set".
 
 To give a <command>, supply one of the folllowing, followed by the <setname>:
-  --base|build|create|list|start|stop|destroy|remove
+  --base|build|plan|create|list|start|stop|snapshot|reset|exec|cp|export|destroy|remove
+
+For --build, --create, --start, --stop and --destroy, <setname> may also be a
+comma-separated list of sets, or 'all' for every set in the config. The images for
+all of them are built together, each shared image just once, and then the containers
+for each set are handled alongside those for the others.
 
-Note that this script does not try to recreate existing containers or rebuild
-existing images. If you update a Dockerfile or a script or config file used
-in the image, you will need to remove the image and any containers that rely
- upon it, before rebuilding. A reminder that you can run 'docker images -a' and
-and 'docker ls -a' to see the list of images or containers, and the commands
- 'docker rm <container>' or 'docker rmi <image>' will remove the container or image
- in question.
+Note that this script does not try to recreate existing containers, and by default
+does not rebuild existing images. Every image we build is labelled with a hash of
+its Dockerfile, the files copied into it, its build args and the image it is built
+from; if you update a Dockerfile or a script or config file used in an image, give
+the --incremental flag and exactly the images affected, and the images built from
+them, will be rebuilt. Use --plan to see what would be rebuilt and why. Containers
+that rely on a rebuilt image must still be destroyed and created again.
 
 Arguments:
 
  --base     (-B):  build base images needed for containers for the specified container set
  --build    (-b):  build final images needed for containers for the specified container set
                    also do the base build if needed
+ --plan     (-L):  show which base and final images for the specified container set would be
+                   built, and why; with --incremental, include images that are out of date
  --create   (-c):  create containers in the specified container set for sql/xml dump tests
                    also do the base and final image builds if needed
  --start    (-s):  start up the containers for the wikifarm in the specified set
-                   also do container creation if needed
+                   also do container creation if needed; databases are started first,
+                   then php-fpm, then httpd, then the dumps hosts, and we wait for each
+                   service to respond before going on, so the set is usable on return
  --name     (-n):  build or remove the specified base or final image, where 'name' is one of
                    the image or container types in the set ('snapshot', 'httpd', 'dumpsdata' (nfs),
                    'dbextstore', 'dbreplica', 'phpfpm', 'dbprimary'), or create, start, destroy
@@ -1095,23 +3381,77 @@ Arguments:
                    --destroy or --stop and will be ignored in all other cases
  --list     (-l):  list containers created for the wikifarm in the specified set
  --stop     (-S):  stop the containers for the wikifarm in the specified set
+ --snapshot (-k):  checkpoint the db containers in the specified set, as images named
+                   wikimedia-dumps/<container>-snapshot:<tag>, without stopping them;
+                   with --withruns, also copy the dump run output
+ --reset    (-R):  put the db containers in the specified set back the way they were in
+                   a snapshot, replacing each with a container created from its snapshot
+                   image and waiting until it is ready; with --withruns, also put back
+                   the dump run output
+ --exec     (-e):  run a command in the container(s) of the specified set given by --container,
+                   via the docker api rather than ssh; the command goes after '--', e.g.
+                   --exec myset --container snapshot -- ls /srv/dumps/runs
+                   if it is a single argument it is run by bash. when there are several
+                   containers it runs in all of them at once, each line of output prefixed
+                   with the container name
+ --cp       (-y):  copy a local file or directory into a directory in containers of the specified
+                   set, or from containers into a local directory; the source and destination
+                   go after '--' and the container side is given as <container>:<path>, e.g.
+                   --cp myset -- ./etc snapshot:/srv/dumps/  or  --cp myset -- dbprimary:/tmp/x .
+                   copies from several containers go into subdirectories named for each
+ --export   (-E):  write a physical copy of the wiki dbs of the specified set, taken from its
+                   running dbprimary container, into the set's imports directory as
+                   <wikidb>.tablespaces.tar; db data images built afterwards load the wikis
+                   from these rather than from their sql dumps, which is much faster
+ --wikis    (-W):  with --export, a comma-separated list of the wikis to export
+                   default: all the wikis of the set
+ --container (-o): with --exec, the container(s) to run in, by name within the set
+                   ('snapshot-01', 'dbprimary'), by type ('snapshot' for all snapshot
+                   containers), or 'all'
+                   default value: 'snapshot'
  --destroy  (-d):  destroy the containers in the specified set
  --remove   (-r):  remove the final images for the containers in the specified set
-                   all running containers for this set will be stopped and destroyed first
+                   all running containers for this set will be stopped and destroyed first,
+                   and all snapshot images for this set will also be removed
  --purge    (-p):  purge the base images for the containers in the specified set
                    all running containers for this set will be stopped and destroyed first
                    and all final images for this set will also be removed
  --purgeall (-P):  purge the base image for all base images, final images, etc
                    all running containers for this set will be stopped and destroyed first
                    and all base and final images for this set will also be removed
- --test     (-t):  run the specified test as defined in the specified set
+ --test     (-t):  run the specified test(s), given as [<setname>:]<testname>[,<testname>...],
+                   on the snapshot containers of the set, building, creating and starting
+                   the set first if needed; 'all' runs every test configured for the set.
+                   without a set name, the one set that has the tests configured is used.
+                   test steps are defined in 'testdefs' in the config; output and timings
+                   for each step are written under the 'test_results' directory
+ --tag      (-T):  name of the snapshot to take or reset to, with --snapshot or --reset
+                   default value: 'latest'
  --config   (-C):  path to configuration file. settings in this file will override
                    settings in default.conf
                    default value: './docker-dumps.conf' in the current working directory
+ --trace    (-x):  time the phases of the command (config load, network creation, build
+                   planning, each image build and build step, imports inside the builds,
+                   each container operation and service readiness wait) and at the end
+                   either show a summary ('summary'), or write every span to the trace file
+                   as json ('json') or as chrome trace events ('chrome')
+ --tracefile (-X): file to write the trace to, with --trace json or --trace chrome
+                   default value: './trace.json' in the current working directory
+ --profile  (-F):  run the command under cProfile and write the stats to the given file,
+                   for use with pstats or snakeviz; only the main thread is profiled, so
+                   work done in builds and container operations shows up as waiting
 
 Flags:
 
  --dryrun  (-D):  say what would be done but don't do it
+ --withruns (-w):  with --snapshot or --reset, include the dump run output (the
+                   dumpsruns volume); it is copied with reflinks where the filesystem allows
+ --jsonlog (-j):  write image build progress as json, one object per line, with fields
+                   'time', 'image' and 'event' ('step', 'step_done', 'output', 'error' or
+                   'done') plus fields specific to the event
+ --incremental (-i):  with --base, --build, --create, --start or --plan, also rebuild images
+                   whose content hash no longer matches their inputs, along with all images
+                   built from them
  --verbose (-v):  write some progress messages some day
  --help    (-h):  show this help message
 """
@@ -1126,7 +3466,10 @@ Flags:
         test: a name for a specific test defined in the config and associated with a wikifarm
         '''
         args = {'config': None, 'set': None, 'test': None,
-                'name': None, 'verbose': False, 'dryrun': False}
+                'name': None, 'verbose': False, 'dryrun': False, 'incremental': False,
+                'jsonlog': False, 'tag': 'latest', 'withruns': False,
+                'trace': None, 'tracefile': os.path.join(os.getcwd(), 'trace.json'),
+                'profile': None, 'container': 'snapshot', 'wikis': None, 'remainder': []}
         return args
 
     def check_opts(self, args):
@@ -1136,25 +3479,40 @@ Flags:
         # note that if args['command'] was never set, we leave that to the caller
         # to handle. the caller, for example, may decide to show all known sets to the user.
         if 'command' in args and not args['command']:
-            self.usage("One of the args 'base', 'build', 'create', 'list', 'start', 'stop', "
-                       "'test', 'remove', 'destroy', 'purge' or 'purgeall'  must be specified")
+            self.usage("One of the args 'base', 'build', 'plan', 'create', 'list', 'start', "
+                       "'stop', 'snapshot', 'reset', 'exec', 'cp', 'export', 'test', 'remove', "
+                       "'destroy', 'purge' or 'purgeall' must be specified")
+        if args.get('command') == 'exec' and not args['remainder']:
+            self.usage("A command to run must be given after '--' with 'exec'")
+        if args.get('command') == 'cp' and len(args['remainder']) != 2:
+            self.usage("A source and a destination must be given after '--' with 'cp'")
         if args['name'] and args['name'] not in ['snapshot', 'httpd', 'dumpsdata', 'dbextstore',
                                                  'dbreplica', 'phpfpm', 'dbprimary']:
             self.usage("Unknown container type " + args['name'] + " specified.")
+        if args['trace'] and args['trace'] not in Tracer.FORMATS:
+            self.usage("The trace format must be one of " + ', '.join(Tracer.FORMATS))
+        if (args['set'] and SetBatch.is_batch(args['set']) and
+                args.get('command') not in SetBatch.COMMANDS):
+            self.usage("Several sets or 'all' may only be given with 'build', 'create', "
+                       "'start', 'stop' or 'destroy'")
 
     def process_opts(self):
         '''
         get command-line args and values, falling back to defaults
         where needed, whining about bad args
         '''
-        commands = {'B': 'base', 'b:': 'build', 'c': 'create', 'l': 'list', 's': 'start',
-                    'S': 'stop', 'd': 'destroy', 'r': 'remove', 'p': 'purge', 'P': 'purgeall'}
+        commands = {'B': 'base', 'b': 'build', 'L': 'plan', 'c': 'create', 'l': 'list',
+                    's': 'start', 'S': 'stop', 'k': 'snapshot', 'R': 'reset', 'd': 'destroy',
+                    'r': 'remove', 'p': 'purge', 'P': 'purgeall', 'e': 'exec', 'y': 'cp',
+                    'E': 'export'}
         try:
             (options, remainder) = getopt.gnu_getopt(
-                sys.argv[1:], "C:t:b:B:c:l:s:S:n:d:r:p:P:Dvh",
-                ["config=", "test=", "base=", "build=", "create=", "name=", "list=", "start=",
-                 "stop=", "destroy=", "remove=", "purge=", "purgeall=",
-                 "dryrun", "verbose", "help"])
+                sys.argv[1:], "C:t:b:B:L:c:l:s:S:k:R:T:n:d:r:p:P:e:y:E:W:o:x:X:F:Dijwvh",
+                ["config=", "test=", "base=", "build=", "plan=", "create=", "name=", "list=",
+                 "start=", "stop=", "snapshot=", "reset=", "tag=", "destroy=", "remove=",
+                 "purge=", "purgeall=", "exec=", "cp=", "export=", "wikis=", "container=", "trace=",
+                 "tracefile=", "profile=", "dryrun",
+                 "incremental", "jsonlog", "withruns", "verbose", "help"])
 
         except getopt.GetoptError as err:
             self.usage("Unknown option specified: " + str(err))
@@ -1170,13 +3528,31 @@ Flags:
                 args['set'] = val
             elif opt in ["-n", "--name"]:
                 args['name'] = val
+            elif opt in ["-T", "--tag"]:
+                args['tag'] = val
+            elif opt in ["-o", "--container"]:
+                args['container'] = val
+            elif opt in ["-W", "--wikis"]:
+                args['wikis'] = val
             elif opt in ["-t", "--test"]:
                 args['command'] = 'test'
                 args['test'] = val
             elif opt in ["-C", "--config"]:
                 args['config'] = val
+            elif opt in ["-x", "--trace"]:
+                args['trace'] = val
+            elif opt in ["-X", "--tracefile"]:
+                args['tracefile'] = val
+            elif opt in ["-F", "--profile"]:
+                args['profile'] = val
             elif opt in ["-D", "--dryrun"]:
                 args['dryrun'] = True
+            elif opt in ["-i", "--incremental"]:
+                args['incremental'] = True
+            elif opt in ["-j", "--jsonlog"]:
+                args['jsonlog'] = True
+            elif opt in ["-w", "--withruns"]:
+                args['withruns'] = True
             elif opt in ["-v", "--verbose"]:
                 args['verbose'] = True
             elif opt in ["-h", "--help"]:
@@ -1184,24 +3560,76 @@ Flags:
             else:
                 self.usage("Unknown option specified: <%s>" % opt)
 
-        if remainder:
+        if remainder and args.get('command') not in ['exec', 'cp']:
             self.usage("Unknown option(s) specified: {opt}".format(opt=remainder[0]))
+        args['remainder'] = remainder
 
         self.check_opts(args)
         return args
 
 
+def get_wikifarm(args, config, inventory, digests=None, output_lock=None):
+    '''set up everything needed to manage the set named in the args'''
+    labeler = ContainerLabels(args)
+    networks = Networks(args, config, labeler, inventory)
+    images = Images(args, config, labeler, networks, inventory, digests, output_lock)
+    containers = Containers(args, config, labeler, networks, inventory)
+    snapshots = Snapshots(args, config, containers, inventory)
+    channel = ContainerChannel(args, containers, inventory)
+    tests = DumpsTestRunner(args, config, channel)
+    exports = DataExports(args, config, channel)
+    return WikifarmSets(args, images, containers, snapshots, channel, tests, exports)
+
+
+def run_command(opts, args):
+    '''load the config and run the command for the set or sets'''
+    with TRACER.span('load config'):
+        config = ContainerConfig(args['config'], args['verbose'])
+    if args.get('command') == 'test':
+        try:
+            args['set'], args['tests'] = DumpsTestRunner.resolve(args['test'], config)
+        except ValueError as ohno:
+            opts.usage(str(ohno))
+    setnames = None
+    if args['set'] and SetBatch.is_batch(args['set']):
+        try:
+            setnames = SetBatch.get_set_names(args['set'], config)
+        except ValueError as ohno:
+            opts.usage(str(ohno))
+    # container work for every set in a batch may be going on at once
+    inventory = DockerInventory(args, pool_size=max(
+        config.config.get('build_workers', os.cpu_count() or 1),
+        config.config.get('container_workers', 8) * len(setnames or [None]), 10))
+    try:
+        with TRACER.span('command', command=args.get('command'), set=args['set']):
+            if setnames:
+                SetBatch(args, config, inventory, setnames).do_command()
+            else:
+                get_wikifarm(args, config, inventory).do_command()
+    except RuntimeError as ohno:
+        # the details of each failure in a batch have already been shown
+        print("Failed:", ohno)
+        sys.exit(1)
+
+
 def do_main():
     '''entry point'''
     opts = DumpsTestbedOpts()
     args = opts.process_opts()
-    config = ContainerConfig(args['config'], args['verbose'])
-    labeler = ContainerLabels(args)
-    networks = Networks(args, labeler)
-    images = Images(args, config, labeler, networks)
-    containers = Containers(args, config, labeler, networks)
-    wikifarm = WikifarmSets(args, images, containers)
-    wikifarm.do_command()
+    TRACER.enabled = bool(args['trace'])
+    profiler = None
+    if args['profile']:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run_command(opts, args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args['profile'])
+            print("profile written to", args['profile'])
+        if args['trace']:
+            TRACER.report(args['trace'], args['tracefile'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+"""
+Reading through sql dumps written by mysqldump, and the index of what is in
+each import file, kept next to it so the multi-GB files are only read once.
+
+This is used both on the host, which builds the indexes, and in the db data
+image, where setup_image.py uses them to plan and report on the imports; so it
+needs nothing outside of the standard library.
+"""
+import bz2
+import glob
+import gzip
+import io
+import json
+import lzma
+import os
+import re
+import shutil
+import subprocess
+import time
+try:
+    from compression import zstd
+except ImportError:
+    # only python 3.14 and later have it built in; without it, we need the zstd command
+    zstd = None
+
+
+# a new table starts at one of these lines naming a table other than the current one
+TABLE_LINE = re.compile(rb"(?:DROP TABLE IF EXISTS|CREATE TABLE(?: IF NOT EXISTS)?|"
+                        rb"LOCK TABLES|INSERT(?: IGNORE)? INTO|ALTER TABLE) `([^`]+)`")
+CHUNKSIZE = 1024 * 1024
+# how much of the end of one piece of sql to keep, so that a row marker split
+# between it and the next piece is still found: all but a byte of the longest one
+TAIL_SIZE = len(b"INSERT INTO ") - 1
+
+
+def count_markers(data):
+    '''return the number of row markers in the data'''
+    return data.count(b"INSERT INTO ") + data.count(b"),(")
+
+
+def count_rows(data, tail=b''):
+    '''
+    return the number of rows inserted by the sql in data, where tail is the
+    last TAIL_SIZE bytes of the previous piece of data, in case a marker is
+    split across them; markers that are all in the tail were counted already
+    '''
+    return count_markers(tail + data) - count_markers(tail)
+
+
+def get_table(line):
+    '''return the table named by the line of sql if it is one that can start a table, or None'''
+    # only the start of the line matters, and INSERT lines can be huge
+    match = TABLE_LINE.match(line[:512])
+    if match:
+        return match.group(1).decode('utf-8')
+    return None
+
+
+def iter_lines(source, chunksize=CHUNKSIZE):
+    '''generate the lines of sql read from the source file object, newlines included'''
+    pending = []
+    while True:
+        data = source.read(chunksize)
+        if not data:
+            break
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end == -1:
+                pending.append(data[start:])
+                break
+            pending.append(data[start:end + 1])
+            yield b''.join(pending)
+            pending = []
+            start = end + 1
+    if pending:
+        yield b''.join(pending)
+
+
+class ChunkReader(io.RawIOBase):
+    '''a read-only file object over a generator of byte strings'''
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return 0
+        count = min(len(buffer), len(self.pending))
+        buffer[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        return count
+
+
+class DumpReader():
+    '''
+    read the sql from an import file, which may be plain sql or compressed
+    with gzip, bzip2, zstd or xz, according to its suffix. it is decompressed
+    by the first of the commands for its format that is installed, which are
+    the multi-threaded ones where there are any, or if none are, by the python
+    module for the format, in our own thread
+
+    the time spent waiting on reads is kept, so that it can be set against the
+    time spent waiting for the loading of what was read, to see which is slower
+    '''
+    # suffix -> (commands to try, in order of preference, python module to fall back on)
+    FORMATS = {
+        '.sql.gz': ([["pigz", "-dc"], ["gzip", "-dc"]], gzip),
+        '.sql.bz2': ([["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]], bz2),
+        '.sql.zst': ([["zstd", "-dcq", "-T0"]], zstd),
+        '.sql.xz': ([["xz", "-dc", "-T0"]], lzma),
+        '.sql': ([], None),
+    }
+    # what the python modules raise for a file that is damaged or cut short
+    READ_ERRORS = (OSError, EOFError, lzma.LZMAError) + ((zstd.ZstdError,) if zstd else ())
+
+    def __init__(self, path):
+        self.path = path
+        self.suffix = self.get_suffix(path)
+        if not self.suffix:
+            raise ValueError("not an import file we know how to read: " + path)
+        self.command = self.get_command(self.suffix)
+        if self.command is None and self.suffix != '.sql' and not self.FORMATS[self.suffix][1]:
+            raise ValueError("no decompressor installed for " + path)
+        self.proc = None
+        self.source = None
+        self.error = None
+        self.read_time = 0
+
+    @staticmethod
+    def get_suffix(path):
+        '''return the suffix of the import file that says its format, or None if it has none'''
+        for suffix in DumpReader.FORMATS:
+            if path.endswith(suffix):
+                return suffix
+        return None
+
+    @staticmethod
+    def get_command(suffix):
+        '''return the command to decompress files with the suffix to stdout, or None'''
+        for command in DumpReader.FORMATS[suffix][0]:
+            if shutil.which(command[0]):
+                return command
+        return None
+
+    def describe(self):
+        '''return the name of what does the decompressing'''
+        if self.command:
+            return self.command[0]
+        if self.suffix == '.sql':
+            return "nothing"
+        return "python " + self.FORMATS[self.suffix][1].__name__
+
+    def open(self):
+        '''start reading the file, and return self for reading from'''
+        if self.command:
+            self.proc = subprocess.Popen(self.command + [self.path], stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+            self.source = self.proc.stdout
+        elif self.suffix == '.sql':
+            self.source = open(self.path, "rb")
+        else:
+            self.source = self.FORMATS[self.suffix][1].open(self.path, "rb")
+        return self
+
+    def read(self, size=CHUNKSIZE):
+        '''
+        return up to size bytes of sql, or b'' at the end, or if the file can't be
+        read any further, in which case closing the reader says what went wrong
+        '''
+        start = time.monotonic()
+        try:
+            return self.source.read(size)
+        except self.READ_ERRORS as ex:
+            self.error = str(ex) or type(ex).__name__
+            return b''
+        finally:
+            self.read_time += time.monotonic() - start
+
+    def close(self, stop=False):
+        '''
+        finish up, first stopping the decompressor if stop is set, and return
+        a description of what went wrong with the decompression if anything did
+        '''
+        if not self.proc:
+            self.source.close()
+            return self.error
+        if stop:
+            # it may be stuck writing to a pipe nobody reads any more
+            self.proc.kill()
+        self.proc.wait()
+        self.source.close()
+        if self.proc.returncode and not stop:
+            return self.proc.stderr.read().decode('utf-8', errors='replace').strip() or (
+                "{command} exited with {code}".format(command=self.command[0],
+                                                      code=self.proc.returncode))
+        return None
+
+
+def find_import_files(directory):
+    '''return the sorted paths of the import files in the directory, in any format we can read'''
+    return sorted(path for path in glob.glob(os.path.join(directory, "*.sql*"))
+                  if DumpReader.get_suffix(path))
+
+
+class DumpIndex():
+    '''
+    what is in an import file: the size of the sql once decompressed, the
+    number of statements and of rows in it, and for each table, where in the
+    decompressed sql it starts and how much of it there is. a table that shows
+    up in more than one place in the file gets an entry for each place.
+
+    the index is kept in <import file>.index.json along with the sha256 of the
+    import file it was made from; callers get that from their digest cache,
+    which is keyed on path, size and mtime, so an index is only redone when the
+    file changes, and is good for a copy of the file anywhere else
+    '''
+    SUFFIX = '.index.json'
+    VERSION = 1
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    @staticmethod
+    def get_path(path):
+        '''return the path of the index for an import file'''
+        return path + DumpIndex.SUFFIX
+
+    @staticmethod
+    def new_table(name, offset):
+        '''return a fresh index entry for a table that starts at the given offset'''
+        return {'name': name, 'offset': offset, 'bytes': 0, 'statements': 0, 'rows': 0}
+
+    @staticmethod
+    def scan(source):
+        '''read the sql from the source file object and return the index entries for it'''
+        entries = {'version': DumpIndex.VERSION, 'bytes': 0, 'statements': 0, 'rows': 0,
+                   'tables': []}
+        current = None
+        for line in iter_lines(source):
+            table = get_table(line)
+            if table and (not current or table != current['name']):
+                current = DumpIndex.new_table(table, entries['bytes'])
+                entries['tables'].append(current)
+            statements = 1 if line.endswith(b";\n") else 0
+            rows = count_rows(line)
+            entries['bytes'] += len(line)
+            entries['statements'] += statements
+            entries['rows'] += rows
+            if current:
+                current['bytes'] += len(line)
+                current['statements'] += statements
+                current['rows'] += rows
+        return entries
+
+    @staticmethod
+    def scan_file(path):
+        '''decompress the import file and return the index entries for it'''
+        reader = DumpReader(path)
+        entries = DumpIndex.scan(reader.open())
+        error = reader.close()
+        if error:
+            raise ValueError("failed to read {path}: {error}".format(path=path, error=error))
+        return entries
+
+    @staticmethod
+    def load(path, digest=None):
+        '''
+        return the index for the import file if there is one and it is for this
+        version of the file, otherwise None. without a digest, only the size of
+        the file is checked, which is enough where the file can be trusted to
+        be the one the index was made from
+        '''
+        try:
+            with open(DumpIndex.get_path(path), "r") as fhandle:
+                entries = json.load(fhandle)
+        except (OSError, ValueError):
+            return None
+        if entries.get('version') != DumpIndex.VERSION:
+            return None
+        if entries.get('size') != os.stat(path).st_size:
+            return None
+        if digest and entries.get('sha256') != digest:
+            return None
+        return DumpIndex(entries)
+
+    @staticmethod
+    def get(path, digest):
+        '''
+        return the index for the import file with the given sha256, reading the
+        file through and saving a new index next to it if the one there is out
+        of date. if the index can't be saved, it is still returned
+        '''
+        index = DumpIndex.load(path, digest)
+        if index:
+            return index
+        entries = DumpIndex.scan_file(path)
+        entries['size'] = os.stat(path).st_size
+        entries['sha256'] = digest
+        index = DumpIndex(entries)
+        try:
+            index.save(DumpIndex.get_path(path))
+        except OSError as ex:
+            print("failed to save index for", path, "(", ex, ")")
+        return index
+
+    def save(self, indexpath):
+        '''write the index out, so that nobody reading it ever sees half of one'''
+        with open(indexpath + ".tmp", "w") as fhandle:
+            json.dump(self.entries, fhandle, indent=1)
+        os.replace(indexpath + ".tmp", indexpath)
+
+    def get_size(self):
+        '''return the number of bytes of sql in the file once it is decompressed'''
+        return self.entries['bytes']
+
+    def get_table_sizes(self):
+        '''return a dict of the number of bytes of sql for each table, over all its pieces'''
+        sizes = {}
+        for table in self.entries['tables']:
+            sizes[table['name']] = sizes.get(table['name'], 0) + table['bytes']
+        return sizes
+
+    def get_preamble_size(self):
+        '''return the number of bytes of sql that come before the first table'''
+        if not self.entries['tables']:
+            return self.entries['bytes']
+        return self.entries['tables'][0]['offset']
+
+    def describe(self):
+        '''return a short description of the contents for display'''
+        return "{tables} tables, {size:.1f} MB of sql, {statements} statements, {rows} rows".format(
+            tables=len(self.get_table_sizes()), size=self.entries['bytes'] / 1000000,
+            statements=self.entries['statements'], rows=self.entries['rows'])
@@ -4,14 +4,27 @@ Image setup for base and final images for each image type
 """
 import getopt
 import glob
+import io
+import json
 import os
+import re
 import stat
 import sys
 import shutil
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+import concurrent.futures
 import yaml
 import MySQLdb
+from MySQLdb.constants import CLIENT
+try:
+    import dump_index
+except ImportError:
+    # imported from the top of the repo, rather than run in an image with it alongside
+    from docker_helpers import dump_index
 
 
 class ImageSetupOpts():
@@ -27,7 +40,9 @@ class ImageSetupOpts():
         '''
         if message:
             sys.stderr.write(message + "\n")
-            usage_message = """Usage: $0 --stage base|final --type <imagetype> [--set <setname>]
+            usage_message = """Usage: $0 --stage base|final|data|export --type <imagetype>
+       [--set <setname>]
+       [--wikis <wiki>,<wiki>...] [--imports <settings>] [--sample <settings>]
 or: $0 --help
 
 Do image setup for the base or final image of a specific image type, using the
@@ -39,12 +54,27 @@ Arguments:
                   'final' to build the final image for an image type for a specific set
                   using the configuration settings for the set, embedding container names for
                   the set, db credentials and so on into the image.
+                  'data' to build the db data image that dbprimary final images for all
+                  sets with the same wikis and dumps are built from; the server is secured
+                  and the wikis imported, but nothing set-specific is done
+                  'export' to write tablespace archives of wikis on the running db server
+                  of a dbprimary container, into /root/exports, for loading into later
+                  db data images in place of the sql
                   default: none
  --type    (-t):  type of image to build, one of 'snapshot', 'httpd', 'dumpsdata' (nfs),
                   'dbextstore', 'dbreplica', 'phpfpm', 'dbprimary'
                   default: none
- --set     (-S):  setname (required for building 'final' images)
+ --set     (-S):  setname (required for building 'final' images, and for 'export')
                   default: none
+ --wikis   (-w):  comma-separated list of wiki dbs to create and import, for 'data' images,
+                  or to export; default for 'export', all the wikis of the set
+                  default: none
+ --imports (-i):  json with import settings ('workers', 'table_workers', 'bulk',
+                  'fast_shutdown'), for 'data' images
+                  default: none
+ --sample  (-m):  json with the part of each wiki to import ('pages' or 'percent', and
+                  'tables'), for 'data' images
+                  default: none, import everything
 
 Flags:
 
@@ -61,7 +91,8 @@ Flags:
         set: a collection of containers defined in the config for one wikifarm
         test: a name for a specific test defined in the config and associated with a wikifarm
         '''
-        args = {'stage': None, 'type': None, 'set': None}
+        args = {'stage': None, 'type': None, 'set': None, 'wikis': '', 'imports': None,
+                'sample': None}
         return args
 
     def check_opts(self, args):
@@ -75,9 +106,16 @@ Flags:
         if args['type'] not in ['snapshot', 'httpd', 'dumpsdata', 'dbextstore',
                                 'dbreplica', 'phpfpm', 'dbprimary']:
             self.usage("Unknown image type " + args['type'] + " specified.")
-        if 'stage' == 'final' and ('set' not in args or not args['set']):
-            self.usage("When building final images, the --set argument must be"
+        if args['stage'] not in ['base', 'final', 'data', 'export']:
+            self.usage("Unknown stage " + args['stage'] + " specified.")
+        if args['stage'] in ['final', 'export'] and ('set' not in args or not args['set']):
+            self.usage("When building final images or exporting, the --set argument must be"
                        + " specified and may not be empty.")
+        if args['sample']:
+            try:
+                DumpSampler(args['sample'])
+            except ValueError as ex:
+                self.usage("Bad --sample setting: " + str(ex))
 
     def process_opts(self):
         '''
@@ -86,8 +124,8 @@ Flags:
         '''
         try:
             (options, remainder) = getopt.gnu_getopt(
-                sys.argv[1:], "s:t:S:vh",
-                ["stage=", "type=", "set=","verbose", "help"])
+                sys.argv[1:], "s:t:S:w:i:m:vh",
+                ["stage=", "type=", "set=", "wikis=", "imports=", "sample=", "verbose", "help"])
 
         except getopt.GetoptError as err:
             self.usage("Unknown option specified: " + str(err))
@@ -101,6 +139,12 @@ Flags:
                 args['set'] = val
             elif opt in ["-t", "--type"]:
                 args['type'] = val
+            elif opt in ["-w", "--wikis"]:
+                args['wikis'] = val
+            elif opt in ["-i", "--imports"]:
+                args['imports'] = val
+            elif opt in ["-m", "--sample"]:
+                args['sample'] = yaml.safe_load(val) if val else None
             elif opt in ["-v", "--verbose"]:
                 args['verbose'] = True
             elif opt in ["-h", "--help"]:
@@ -115,22 +159,123 @@ Flags:
         return args
 
 
+# lines starting with this in the build output are picked up by the build log
+# on the host and added to its trace, if it is keeping one
+TRACE_PREFIX = 'atg-trace: '
+
+
+def trace(name, start, **fields):
+    '''
+    report a span of work that started at the given time (seconds since the epoch)
+    and ends now, with whatever fields are of interest
+    '''
+    span = {'name': name, 'start': start, 'end': time.time()}
+    span.update(fields)
+    print(TRACE_PREFIX + json.dumps(span), flush=True)
+
+
 class MariaDB():
-    '''start and stop mariadb server, etc.'''
+    '''
+    start and stop mariadb server, etc.
+
+    queries all go over one connection, which is kept open and reused until
+    a query is run with a different password, say after the root password
+    has been changed, or the server goes away
+    '''
+    # "server has gone away" and "lost connection to server" errors
+    CONNECTION_LOST = (2006, 2013)
+    READY_MESSAGE = b"ready for connections"
+
     def __init__(self, sockname, basedir, datadir):
         self.sockname = sockname
         self.basedir = basedir
         self.datadir = datadir
+        self.dbconn = None
+        self.dbconn_password = None
+        # seconds from start to ready, for each time we started the server
+        self.startup_times = []
+
+    @staticmethod
+    def get_bulk_load_options(resize_log=True):
+        '''
+        return server options for loading lots of data when we don't care about
+        crash safety: no syncing the redo log at each commit, no doublewrite buffer,
+        no binlog, and a larger buffer pool and (if resize_log is set) redo log than
+        our usual settings. these only hold for the one run of the server they are
+        given to, except that a resized redo log stays that size until the server
+        is next started without this option
+        '''
+        # a quarter of memory but no more than 4G, in the 128M chunks innodb wants
+        chunk = 128 * 1024 * 1024
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        pool_size = max(chunk, min(memory // 4, 32 * chunk) // chunk * chunk)
+        options = ["--innodb_flush_log_at_trx_commit=0", "--innodb_doublewrite=0",
+                   "--skip-log-bin", "--innodb_buffer_pool_size=" + str(pool_size)]
+        if resize_log:
+            options.append("--innodb_log_file_size=512M")
+        return options
+
+    @staticmethod
+    def get_log_size(path):
+        '''return the size of the error log, if we know where it is and it exists'''
+        if path and os.path.exists(path):
+            return os.path.getsize(path)
+        return 0
+
+    @staticmethod
+    def read_log(path, offset):
+        '''return what has been written to the error log past the given offset'''
+        if not path or not os.path.exists(path):
+            return b''
+        with open(path, "rb") as fin:
+            fin.seek(offset)
+            return fin.read()
+
+    def looks_ready(self, logpath, offset):
+        '''
+        return True if the server claims to be ready: if we know where the error log
+        is, it says so there; otherwise the socket file is there. we don't trust this
+        by itself, a stale socket file may be left from some earlier run
+        '''
+        if logpath:
+            return self.READY_MESSAGE in self.read_log(logpath, offset)
+        return os.path.exists(self.sockname)
 
-    def start_server(self, password=None, networking=False, config_overrides=None):
+    def wait_until_ready(self, proc, password=None, logpath=None, offset=0, timeout=300):
+        '''
+        wait for the newly started server to answer queries, checking often at
+        first and then less so, up to every tenth of a second; raise RuntimeError
+        if the server exits or is not ready in timeout seconds. return the
+        number of seconds it took
+        '''
+        start = time.monotonic()
+        delay = 0.005
+        while True:
+            if proc.poll() is not None:
+                output = self.read_log(logpath, offset).decode('utf-8', errors='replace')
+                raise RuntimeError(
+                    "mysqld exited with code {code} before it was ready {log}".format(
+                        code=proc.returncode, log=output.strip()[-2000:]))
+            if self.looks_ready(logpath, offset) and self.ping(password):
+                return time.monotonic() - start
+            if time.monotonic() - start > timeout:
+                proc.kill()
+                raise RuntimeError("mysqld not ready after {secs} seconds".format(secs=timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def start_server(self, password=None, networking=False, config_overrides=None,
+                     extra_options=None, timeout=300):
         '''
-        start the server and wait for it to become available
+        start the server and wait for it to become available, for up to timeout seconds
 
         because this method is called by the test suite, which relies on the mysql or
         mariadb installation on the host that will run the docker containers, we must
         be able to set additional config values that override the local install
         (i.e. /etc/my.cnf); these should be passed in to config_overrides
 
+        extra_options, if any, are passed along to mysqld as is
+
         the started process is returned
         '''
         mysqld_path = os.path.join(self.basedir, "bin", "mysqld")
@@ -147,34 +292,35 @@ class MariaDB():
                 command.append('--pid-file=' + config_overrides['pid_file'])
             if 'user' in config_overrides:
                 command.append('--user=' + config_overrides['user'])
-        # result = subprocess.run(command, capture_output=True, check=False)
+        if extra_options:
+            command.extend(extra_options)
+        logpath = None
+        if config_overrides:
+            logpath = config_overrides.get('log_error')
+        offset = self.get_log_size(logpath)
         proc = subprocess.Popen(command)
-        if proc.returncode:
-            error = "Unknown error"
-            if proc.stderr:
-                error = proc.stderr
-                print("failed to start mysqld server (", error, ")")
-
-        running = False
-
-        for _index in range(30):
-            if self.do_query("SELECT 1;", password, "mysql"):
-                running = True
-                break
-            time.sleep(1)
-
-        if not running:
-            # fixme probably an exception, no?
-            sys.exit(1)
+        elapsed = self.wait_until_ready(proc, password, logpath, offset, timeout)
+        self.startup_times.append(elapsed)
+        print("mysqld ready in {secs:.2f}s".format(secs=elapsed))
         return proc
 
-    def do_query(self, command, password=None, database=None):
+    def close_connection(self):
+        '''close the connection to the server if we have one, ignoring any problems'''
+        if self.dbconn:
+            try:
+                self.dbconn.close()
+            except MySQLdb.Error:
+                pass
+        self.dbconn = None
+
+    def get_connection(self, password=None):
         '''
-        run a single mariadb/mysql query against the running
-        local server via unix socket, optional password.
-        we don't even bother to return the output, just True
-        on success, False on failure
+        return an open connection to the running local server via unix socket,
+        optional password, reusing the one we have if it was made with the same password
         '''
+        if self.dbconn and self.dbconn_password == password:
+            return self.dbconn
+        self.close_connection()
         # we use an agressive timeout here but honestly 2 seconds is tons
         # of time to establish a connection when we're the only client
         # talking to the server
@@ -182,18 +328,69 @@ class MariaDB():
                   'connect_timeout': 2,
                   'user': 'root',
                   'passwd': password,
-                  'db': database}
+                  'client_flag': CLIENT.MULTI_STATEMENTS}
+        # instead of discarding keyword args with value None, connect() whines that
+        # they aren't strings or whatever. silly thing.
+        self.dbconn = MySQLdb.connect(**{k: v for k, v in kwargs.items() if v is not None})
+        self.dbconn.autocommit(True)
+        self.dbconn_password = password
+        return self.dbconn
+
+    def ping(self, password=None):
+        '''return True if the server answers a query, False otherwise'''
         try:
-            # instead of discarding keyword args with value None, connect() whines that
-            # they aren't strings or whatever. silly thing.
-            dbconn = MySQLdb.connect(**{k: v for k, v in kwargs.items() if v is not None})
-            cursor = dbconn.cursor()
-            cursor.execute(command)
-        # except MySQLdb.Error as ohno:
-        except Exception:
+            self.do_query("SELECT 1;", password, "mysql")
+        except MySQLdb.Error:
+            self.close_connection()
             return False
         return True
 
+    def do_query(self, command, password=None, database=None):
+        '''
+        run a single mariadb/mysql query against the running
+        local server via unix socket, optional password, and
+        return any rows it produced
+
+        errors are raised as MySQLdb.Error; if a connection we have
+        used before has gone away, we make a new one and try once more
+        '''
+        return self.do_queries([command], password, database)
+
+    def do_queries(self, commands, password=None, database=None):
+        '''
+        run a list of queries in one round trip to the server, stopping at the
+        first one that fails and raising MySQLdb.Error for it; return any rows
+        produced by the last query
+
+        note that statements like CREATE USER or GRANT commit implicitly, so
+        sending these together saves trips to the server but does not
+        make them all or nothing
+        '''
+        reused = self.dbconn is not None and self.dbconn_password == password
+        try:
+            return self.run_queries(self.get_connection(password), commands, database)
+        except MySQLdb.OperationalError as ohno:
+            self.close_connection()
+            if not reused or ohno.args[0] not in self.CONNECTION_LOST:
+                raise
+        return self.run_queries(self.get_connection(password), commands, database)
+
+    @staticmethod
+    def run_queries(dbconn, commands, database=None):
+        '''run the queries on the given connection, returning the rows from the last one'''
+        if database:
+            dbconn.select_db(database)
+        cursor = dbconn.cursor()
+        try:
+            cursor.execute("\n".join(command.rstrip().rstrip(';') + ';' for command in commands))
+            rows = cursor.fetchall()
+            # errors in later statements only show up as we step through the results
+            while cursor.nextset():
+                rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        return rows
+
     def make_server_secure(self, password=None):
         '''get rid of stuff like test db, anonymous user, etc'''
         # queries and do_query stolen from mysql_secure_installation script
@@ -224,10 +421,24 @@ class MariaDB():
                 passwd=new_password),
             current_password)
 
-    def stop_server(self, password=None, proc=None):
-        '''stop mysql/mariadb server politely'''
-        # fixme check return and whine if needed
-        self.do_query("SHUTDOWN;", password)
+    def stop_server(self, password=None, proc=None, fast=False):
+        '''
+        stop mysql/mariadb server politely
+
+        if fast is set, innodb skips flushing dirty pages and saving the buffer
+        pool list, leaving the next start to catch up from the redo log, which
+        is flushed; nothing committed is lost
+        '''
+        if fast:
+            self.do_queries(["SET GLOBAL innodb_fast_shutdown=2",
+                             "SET GLOBAL innodb_buffer_pool_dump_at_shutdown=OFF"], password)
+        try:
+            self.do_query("SHUTDOWN;", password)
+        except MySQLdb.OperationalError as ohno:
+            # the server may hang up on us as it goes down, that's fine
+            if ohno.args[0] not in self.CONNECTION_LOST:
+                raise
+        self.close_connection()
         if proc:
             # the server is going to take a little while to shut down after
             # the command was given
@@ -243,29 +454,959 @@ class MariaDB():
         '''
         if not os.path.exists(import_data_path):
             return
-        command = "/bin/gzip -dc " + import_data_path + " | /usr/local/bin/mysql -u root"
-        if password:
-            command = command + " -p" + password
-        command = command + " " + dbname
-        result = subprocess.run(command, shell=True, capture_output=True, check=False)
-        if result.returncode:
-            error = "Unknown error"
-            if result.stderr:
-                error = result.stderr
-            print("failed to import data:", import_data_path, "(", error, ")")
-
-    def do_all_imports(self, importdir, wikis, password=None):
-        '''
-        for the specified directory, process all the sql.gz files in it as imports to
-        the local db
-
-        files should be named <wikidb>.anythinghere.sql.gz
-        '''
-        files = glob.glob(os.path.join(importdir, "*.sql.gz"))
-        for sql_file in files:
+        SqlImporter(password).import_file(import_data_path, dbname)
+
+    def import_tablespaces(self, importdir, wiki, password, importer):
+        '''
+        load the wiki from its tablespace archive in the directory, if it has one;
+        return True if it was loaded, False if the sql files should be imported
+        instead. if loading the archive fails, the wiki db is emptied again
+        '''
+        path = TablespaceArchive.get_path(importdir, wiki)
+        if not os.path.exists(path):
+            return False
+        start = time.time()
+        try:
+            tables = TablespaceArchive(self, password).load(wiki, path, importer)
+        except (ValueError, OSError, KeyError, MySQLdb.Error) as ex:
+            print("can't load tablespaces for {wiki}, importing its sql instead ({error})".format(
+                wiki=wiki, error=ex))
+            self.do_queries(["DROP DATABASE IF EXISTS `{wiki}`".format(wiki=wiki),
+                             "CREATE DATABASE `{wiki}`".format(wiki=wiki)], password)
+            trace('import tablespaces', start, wiki=wiki, failed=True)
+            return False
+        print("loaded {count} tables of {wiki} from {path} in {elapsed:.1f}s".format(
+            count=tables, wiki=wiki, path=os.path.basename(path), elapsed=time.time() - start))
+        trace('import tablespaces', start, wiki=wiki, tables=tables, failed=False)
+        return True
+
+    def do_all_imports(self, importdir, wikis, password=None, workers=None, bulk=False,
+                       table_workers=None, sample=None):
+        '''
+        for the specified directory, process all the sql files in it as imports to
+        the local db, several wikis at once, with bulk load session settings if
+        bulk is set, several tables of each wiki at once if table_workers is set,
+        and only the part of each wiki given by the sample settings, if any
+
+        files should be named <wikidb>.anythinghere.sql, with .gz, .bz2, .zst or .xz
+        on the end if compressed; a wiki with a tablespace archive
+        <wikidb>.tablespaces.tar is loaded from that instead, unless we are only
+        importing a sample
+        '''
+        importer = SqlImporter(password, workers, bulk, socket=self.sockname,
+                               table_workers=table_workers, sample=sample)
+        if not sample:
+            wikis = [wiki for wiki in wikis
+                     if not self.import_tablespaces(importdir, wiki, password, importer)]
+        return importer.run(importdir, wikis)
+
+
+class IndexDeferrer():
+    '''
+    rewrite the CREATE TABLE statements in a stream of sql as written by mysqldump
+    so that secondary indexes are left out, and hand back ALTER TABLE statements
+    that add them, to be run after all the data has been loaded; innodb builds
+    an index on a full table much faster than it maintains one row by row
+
+    only plain and unique keys are deferred; fulltext and spatial indexes stay
+    where they are, and so do all the keys of any table with an auto increment
+    column that is not part of its primary key, since such a column must be
+    in some index when the table is created
+
+    data is handed in and back in pieces of any size; only the lines of
+    CREATE TABLE statements are ever looked at one by one, so the long lines
+    of extended INSERT statements go through without being split up
+    '''
+    MARKER = b"CREATE TABLE `"
+    KEY_LINE = re.compile(rb"^\s*(UNIQUE )?KEY `")
+
+    def __init__(self):
+        self.carry = b''
+        self.at_line_start = True
+        self.table_lines = None
+        self.alters = []
+
+    def rewrite_table(self, lines):
+        '''
+        given the lines of a CREATE TABLE statement, return the statement with
+        secondary keys removed, saving the ALTER TABLE statement that adds them back
+        '''
+        header, body, footer = lines[0], lines[1:-1], lines[-1]
+        keys = [line for line in body if self.KEY_LINE.match(line)]
+        primary = [line for line in body if line.strip().startswith(b"PRIMARY KEY")]
+        for line in body:
+            if b" AUTO_INCREMENT" in line and line.strip().startswith(b"`"):
+                column = line.strip().split(b"`")[1]
+                if not primary or b"`" + column + b"`" not in primary[0]:
+                    keys = []
+        if not keys:
+            return b"\n".join(lines) + b"\n"
+        table = header[len(self.MARKER):].split(b"`")[0]
+        self.alters.append(b"ALTER TABLE `" + table + b"` " + b", ".join(
+            b"ADD " + line.strip().rstrip(b",") for line in keys) + b";\n")
+        kept = [line.rstrip(b",") for line in body if line not in keys]
+        return header + b"\n" + b",\n".join(kept) + b"\n" + footer + b"\n"
+
+    def feed(self, data):
+        '''take the next piece of the sql stream and return what can be passed on so far'''
+        data = self.carry + data
+        self.carry = b''
+        out = []
+        pos = 0
+        while pos < len(data):
+            if self.table_lines is not None:
+                end = data.find(b"\n", pos)
+                if end == -1:
+                    self.carry = data[pos:]
+                    break
+                line = data[pos:end]
+                pos = end + 1
+                self.table_lines.append(line)
+                if line.startswith(b")"):
+                    out.append(self.rewrite_table(self.table_lines))
+                    self.table_lines = None
+                continue
+            if self.at_line_start:
+                start = data[pos:pos + len(self.MARKER)]
+                if start == self.MARKER:
+                    self.table_lines = []
+                    continue
+                if len(start) < len(self.MARKER) and self.MARKER.startswith(start):
+                    # might be the start of a CREATE TABLE, wait for more
+                    self.carry = data[pos:]
+                    break
+            found = data.find(b"\n" + self.MARKER, pos)
+            if found != -1:
+                out.append(data[pos:found + 1])
+                pos = found + 1
+                self.at_line_start = True
+                continue
+            # pass on everything but a last partial line that might be a CREATE TABLE
+            cut = data.rfind(b"\n", max(pos, len(data) - len(self.MARKER)))
+            if cut == -1:
+                out.append(data[pos:])
+                self.at_line_start = False
+                break
+            out.append(data[pos:cut + 1])
+            pos = cut + 1
+            self.at_line_start = True
+        return b''.join(out)
+
+    def finish(self):
+        '''return whatever is left of the sql stream, followed by the statements adding indexes'''
+        remainder = self.carry
+        if self.table_lines is not None:
+            remainder = b"\n".join(self.table_lines + [remainder])
+        if remainder and not remainder.endswith(b"\n"):
+            remainder += b"\n"
+        return remainder + b''.join(self.alters)
+
+
+class TableSplitter():
+    '''
+    split the sql from a dump written by mysqldump into a file per table as it
+    is read, so that the tables can be loaded side by side
+
+    a new table starts at the first DROP TABLE, CREATE TABLE, LOCK TABLES,
+    INSERT INTO or ALTER TABLE line that names a table other than the current
+    one, so its CREATE TABLE comes before its data in its file. whatever comes
+    before the first table (the SET statements for the character set, time
+    zone and so on) is put at the top of every table's file. tables come out in
+    the same order as in the index of the file
+    '''
+    CHUNKSIZE = 1024 * 1024
+
+    def __init__(self, scratchdir, label):
+        self.scratchdir = scratchdir
+        self.label = label
+        self.preamble = []
+        self.table = None
+        self.path = None
+        self.output = None
+        self.count = 0
+
+    def finish_table(self):
+        '''close the file for the current table and return (table, path), or None if none'''
+        if not self.output:
+            return None
+        self.output.close()
+        self.output = None
+        return self.table, self.path
+
+    def start_table(self, table):
+        '''
+        close the file for the current table and start one for the new table;
+        return (table, path) for the table just finished, or None
+        '''
+        finished = self.finish_table()
+        self.count += 1
+        self.table = table
+        self.path = os.path.join(self.scratchdir, "{label}.{num:04d}.{table}.sql".format(
+            label=self.label, num=self.count, table=table))
+        self.output = open(self.path, "wb")
+        self.output.writelines(self.preamble)
+        return finished
+
+    def add_line(self, line):
+        '''
+        handle one line of sql, newline included; return (table, path) if this
+        line finished off the file for a table, or None
+        '''
+        finished = None
+        table = dump_index.get_table(line)
+        if table and table != self.table:
+            finished = self.start_table(table)
+        if self.output:
+            self.output.write(line)
+        else:
+            self.preamble.append(line)
+        return finished
+
+    def split(self, source):
+        '''
+        read the sql from the source file object, generating (table, path) for
+        each table as soon as its file is complete
+        '''
+        for line in dump_index.iter_lines(source, self.CHUNKSIZE):
+            finished = self.add_line(line)
+            if finished:
+                yield finished
+        finished = self.finish_table()
+        if finished:
+            yield finished
+
+
+class DumpSampler():
+    '''
+    cut the sql from a dump written by mysqldump down to a sample of the wiki:
+    the schema of every table, and rows only for some of the pages, with the
+    revision, slot, content and text rows and the links for just those pages,
+    so that what is kept hangs together. tables not tied to pages are kept in
+    full. the pages are either the first so many in the dump or a percentage
+    of them picked by page id. if there is a list of tables, only those tables
+    get any rows at all
+
+    one sampler is used for all the files of a wiki, so that rows in a later
+    file are matched against pages kept from an earlier one. mysqldump writes
+    the tables in alphabetical order, so many come before the table whose rows
+    say which of theirs we want: categorylinks and the other links tables come
+    before page, and content before slots. such a table is held back in a
+    scratch file until the tables it waits for are done. rows of a table are
+    only filtered if the ids they are matched against have been collected;
+    if what a table waits for isn't in the file, it goes out at the end of the
+    file with all its rows
+    '''
+    INSERT_LINE = re.compile(rb"INSERT(?: IGNORE)? INTO `([^`]+)`(?: \(([^)]*)\))? VALUES ")
+    COLUMN_LINE = re.compile(rb"\s+`([^`]+)` ")
+    ROW = re.compile(rb"\((?:[^'()]|'(?:[^'\\]|\\.)*')*\)", re.DOTALL)
+    FIELD = re.compile(rb"'(?:[^'\\]|\\.)*'|[^,]+", re.DOTALL)
+    # table -> (column, kind of id that must have been kept for the row to be kept)
+    MATCH = {
+        'revision': ('rev_page', 'page'),
+        'slots': ('slot_revision_id', 'revision'),
+        'content': ('content_id', 'content'),
+        'text': ('old_id', 'text'),
+        'categorylinks': ('cl_from', 'page'),
+        'externallinks': ('el_from', 'page'),
+        'imagelinks': ('il_from', 'page'),
+        'iwlinks': ('iwl_from', 'page'),
+        'langlinks': ('ll_from', 'page'),
+        'page_props': ('pp_page', 'page'),
+        'page_restrictions': ('pr_page', 'page'),
+        'pagelinks': ('pl_from', 'page'),
+        'redirect': ('rd_from', 'page'),
+        'templatelinks': ('tl_from', 'page'),
+    }
+    # table -> [(column, kind of id the values in the rows kept are)]
+    COLLECT = {
+        'page': [('page_id', 'page')],
+        'revision': [('rev_id', 'revision'), ('rev_text_id', 'text')],
+        'slots': [('slot_content_id', 'content')],
+        'content': [('content_address', 'text')],
+    }
+
+    def __init__(self, settings):
+        self.pages = settings.get('pages')
+        self.percent = settings.get('percent')
+        self.tables = settings.get('tables')
+        if self.pages is not None and (not isinstance(self.pages, int) or self.pages < 1):
+            raise ValueError("sample 'pages' must be a positive number")
+        if self.percent is not None and (not isinstance(self.percent, (int, float)) or
+                                         not 0 < self.percent <= 100):
+            raise ValueError("sample 'percent' must be more than 0 and at most 100")
+        if self.pages and self.percent:
+            raise ValueError("sample 'pages' and 'percent' can't both be set")
+        if self.tables is not None and not isinstance(self.tables, list):
+            raise ValueError("sample 'tables' must be a list of table names")
+        unknown = [setting for setting in settings if setting not in ['pages', 'percent', 'tables']]
+        if unknown:
+            raise ValueError("unknown sample setting(s) " + ", ".join(unknown))
+        # kind of id -> ids of that kind in the rows kept so far
+        self.kept = {'page': set(), 'revision': set(), 'content': set(), 'text': set()}
+        # the kinds of ids that some table we have seen collects
+        self.filled = set()
+        # table -> column names, from its CREATE TABLE
+        self.columns = {}
+        # table -> the tables that collect the ids its rows are matched against
+        self.waits = {table: [source for source, collected in self.COLLECT.items()
+                              if source != table and kind in [entry[1] for entry in collected]]
+                      for table, (_column, kind) in self.MATCH.items()}
+        # tables whose rows have been through the sampler
+        self.finished = set()
+        self.reset()
+
+    def reset(self):
+        '''get ready for a new file'''
+        self.table = None
+        self.creating = None
+        # table -> scratch file, for the tables held back, in the order they came
+        self.deferred = {}
+        self.deferring = None
+
+    @staticmethod
+    def get_id(field):
+        '''return the id in a field from an INSERT statement, or None if there is none'''
+        field = field.strip().strip(b"'")
+        # text ids in content rows look like tt:1234
+        if field.startswith(b"tt:"):
+            field = field[3:]
+        try:
+            return int(field)
+        except ValueError:
+            return None
+
+    def keep_page(self, page_id):
+        '''return True if the page should be in the sample'''
+        if page_id is None:
+            return True
+        if self.pages:
+            return len(self.kept['page']) < self.pages
+        # spread the pick over the ids, and pick the same pages every time
+        return (page_id * 2654435761) % 2 ** 32 < self.percent / 100 * 2 ** 32
+
+    def keep_row(self, table, columns, fields):
+        '''return True if the row of the table with the given fields should be kept'''
+        if table == 'page':
+            return 'page_id' not in columns or self.keep_page(
+                self.get_id(fields[columns.index('page_id')]))
+        column, kind = self.MATCH.get(table, (None, None))
+        if kind not in self.filled or column not in columns:
+            return True
+        return self.get_id(fields[columns.index(column)]) in self.kept[kind]
+
+    def sample_insert(self, table, line, match):
+        '''return the INSERT line with only the rows for the sample, or None if there are none'''
+        if not self.pages and not self.percent:
+            return line
+        if table != 'page' and table not in self.MATCH and table not in self.COLLECT:
+            return line
+        if match.group(2):
+            columns = [name.strip(b" `").decode('utf-8') for name in match.group(2).split(b",")]
+        else:
+            columns = self.columns.get(table)
+        if not columns:
+            return line
+        collect = [(columns.index(column), kind) for column, kind in self.COLLECT.get(table, [])
+                   if column in columns]
+        rows = []
+        for row in self.ROW.finditer(line, match.end()):
+            fields = self.FIELD.findall(row.group(0)[1:-1])
+            if len(fields) != len(columns) or not self.keep_row(table, columns, fields):
+                continue
+            for position, kind in collect:
+                value = self.get_id(fields[position])
+                if value is not None:
+                    self.kept[kind].add(value)
+            rows.append(row.group(0))
+        if not rows:
+            return None
+        return line[:match.end()] + b",".join(rows) + b";\n"
+
+    def sample_line(self, line):
+        '''return the line of sql as it should be in the sample, or None to drop it'''
+        if self.creating:
+            match = self.COLUMN_LINE.match(line)
+            if match:
+                self.columns[self.creating].append(match.group(1).decode('utf-8'))
+            elif line.startswith(b")"):
+                for column, kind in self.COLLECT.get(self.creating, []):
+                    if column in self.columns[self.creating]:
+                        self.filled.add(kind)
+                self.creating = None
+            return line
+        if line.startswith(b"CREATE TABLE"):
+            self.creating = dump_index.get_table(line)
+            self.columns[self.creating] = []
+            return line
+        # only the start of the line matters, and INSERT lines can be huge
+        match = self.INSERT_LINE.match(line[:65536])
+        if not match:
+            return line
+        table = match.group(1).decode('utf-8')
+        if self.tables is not None and table not in self.tables:
+            return None
+        return self.sample_insert(table, line, match)
+
+    def is_waiting(self, table):
+        '''return True if the table waits on some table whose rows haven't been sampled yet'''
+        return bool([source for source in self.waits.get(table, [])
+                     if source not in self.finished])
+
+    def replay(self, table):
+        '''generate the sampled lines held back for the table'''
+        scratch = self.deferred.pop(table)
+        scratch.seek(0)
+        for line in dump_index.iter_lines(scratch):
+            line = self.sample_line(line)
+            if line:
+                yield line
+        scratch.close()
+        self.finished.add(table)
+
+    def release(self, everything=False):
+        '''
+        generate the sampled lines held back for every table that need not wait
+        any longer, or for all of them if everything is set
+        '''
+        while True:
+            ready = [table for table in self.deferred
+                     if everything or not self.is_waiting(table)]
+            if not ready:
+                return
+            # one table going out may let others go
+            yield from self.replay(ready[0])
+
+    def end_table(self):
+        '''note the end of the current table'''
+        if self.table and self.table != self.deferring:
+            self.finished.add(self.table)
+        self.table = None
+        self.deferring = None
+
+    def start_table(self, table):
+        '''
+        note the end of the current table and the start of the new one, generating
+        any held back lines that can go out now
+        '''
+        self.end_table()
+        yield from self.release()
+        self.table = table
+        if (self.pages or self.percent) and (table in self.deferred or self.is_waiting(table)):
+            self.deferring = table
+            if table not in self.deferred:
+                self.deferred[table] = tempfile.TemporaryFile()
+
+    def filter(self, source):
+        '''generate the lines of the sample of the sql read from the source file object'''
+        self.reset()
+        for line in dump_index.iter_lines(source):
+            table = dump_index.get_table(line)
+            if table and table != self.table:
+                yield from self.start_table(table)
+            if self.deferring:
+                self.deferred[self.deferring].write(line)
+                continue
+            line = self.sample_line(line)
+            if line:
+                yield line
+        self.end_table()
+        yield from self.release()
+        # whatever is still held back waits on something that isn't in this file
+        yield from self.release(everything=True)
+
+    def open(self, source):
+        '''return a file object reading the sample of the sql read from the source file object'''
+        return io.BufferedReader(dump_index.ChunkReader(self.filter(source)), dump_index.CHUNKSIZE)
+
+
+class SqlImporter():
+    '''
+    import sql files, plain or compressed, into the local db, one mysql client per wiki,
+    with as many wikis going at once as we have workers; or if table_workers is
+    set, a mysql client per table, with that many tables of a wiki going at once
+
+    the decompressed sql is passed to mysql by us rather than by a shell pipe,
+    so that we can count bytes and rows as they go by and report on progress;
+    mysql errors are displayed as they happen rather than saved up until
+    the end. the row count is the number of rows in INSERT statements, which
+    is exact for files written by mysqldump unless a quoted value has "),("
+    in it. we also keep the time spent
+    waiting for sql from the decompressor and the time spent waiting for
+    mysql to take it, so that we can say which of the two is holding things up
+
+    in bulk mode, foreign key and unique checks and the binlog are turned off
+    for the session, and secondary indexes are added after the data is in
+
+    if there are sample settings, the sql for each wiki is cut down to the
+    sample on its way to mysql
+
+    if an import file has an index alongside it, we know how much sql there is
+    before we start, so progress reports say how long there is to go, and the
+    biggest wikis are started first so that they don't finish last on their own
+    '''
+    MYSQL = "/usr/local/bin/mysql"
+    CHUNKSIZE = 1024 * 1024
+    REPORT_INTERVAL = 30
+    BULK_SESSION = b"SET SESSION foreign_key_checks=0, unique_checks=0, sql_log_bin=0;\n"
+
+    def __init__(self, password=None, workers=None, bulk=False, mysql=MYSQL, socket=None,
+                 table_workers=None, sample=None):
+        self.password = password
+        if not workers:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.bulk = bulk
+        # if set, the tables of each wiki are split out and this many loaded at once
+        self.table_workers = table_workers
+        self.sample = sample
+        self.mysql = mysql
+        self.socket = socket
+        self.output_lock = threading.Lock()
+
+    @staticmethod
+    def new_stats():
+        '''return a fresh set of counts for an import'''
+        return {'bytes': 0, 'rows': 0, 'decompress_time': 0, 'load_time': 0}
+
+    def get_index(self, path):
+        '''
+        return the index of the import file if it has an up to date one, or None;
+        if we are only importing a sample, the index doesn't tell us about what we import
+        '''
+        if self.sample:
+            return None
+        return dump_index.DumpIndex.load(path)
+
+    def show(self, label, text):
+        '''display a line of output for one wiki so that lines from different imports don't mix'''
+        with self.output_lock:
+            print("[{label}] {text}".format(label=label, text=text), flush=True)
+
+    def show_errors(self, label, stream, errors):
+        '''display each line of mysql error output as it arrives, keeping a copy'''
+        for line in stream:
+            line = line.decode('utf-8', errors='replace').rstrip()
+            errors.append(line)
+            self.show(label, line)
+
+    def show_rates(self, label, status, stats, elapsed):
+        '''display bytes and rows imported so far and the rates'''
+        elapsed = max(elapsed, 0.001)
+        self.show(label, "{status}: {size:.1f} MB, {rows} rows in {elapsed:.1f}s "
+                  "({mbps:.1f} MB/s, {rps:.0f} rows/s)".format(
+                      status=status, size=stats['bytes'] / 1000000, rows=stats['rows'],
+                      elapsed=elapsed, mbps=stats['bytes'] / 1000000 / elapsed,
+                      rps=stats['rows'] / elapsed))
+
+    def show_waits(self, label, stats):
+        '''display how long we waited on decompression and on mysql, and which held us up'''
+        if stats['decompress_time'] > stats['load_time']:
+            slower = "decompression"
+        else:
+            slower = "loading"
+        self.show(label, "waited {decompress:.1f}s for decompression, {load:.1f}s for mysql "
+                  "({slower} is the bottleneck)".format(
+                      decompress=stats['decompress_time'], load=stats['load_time'],
+                      slower=slower))
+
+    def show_progress(self, label, done, total, elapsed):
+        '''display how much of the expected sql has been imported and a guess at the time left'''
+        if not done or not total:
+            return
+        self.show(label, "{percent:.0f}% of {total:.1f} MB, about {eta:.0f}s to go".format(
+            percent=min(done / total, 1) * 100, total=total / 1000000,
+            eta=max(total - done, 0) * elapsed / done))
+
+    def load(self, label, source, dbname, stats, total=None):
+        '''
+        pass the sql read from the source file object to a mysql client for the
+        specified db, adding the bytes and rows to stats; return the client's
+        exit code and its error output. if we know how many bytes of sql there
+        are in total, progress reports include how much longer it should take
+        '''
+        env = os.environ.copy()
+        if self.password:
+            # this keeps the password out of the process list
+            env['MYSQL_PWD'] = self.password
+        command = [self.mysql, "-u", "root", dbname]
+        if self.socket:
+            command.append("--socket=" + self.socket)
+        mysql = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+        errors = []
+        watcher = threading.Thread(target=self.show_errors, args=(label, mysql.stderr, errors))
+        watcher.start()
+        start = time.monotonic()
+        last_report = start
+        tail = b''
+        done = 0
+        deferrer = None
+        try:
+            if self.bulk:
+                deferrer = IndexDeferrer()
+                mysql.stdin.write(self.BULK_SESSION)
+            while True:
+                data = source.read(self.CHUNKSIZE)
+                if not data:
+                    break
+                write_start = time.monotonic()
+                if deferrer:
+                    mysql.stdin.write(deferrer.feed(data))
+                else:
+                    mysql.stdin.write(data)
+                stats['load_time'] += time.monotonic() - write_start
+                done += len(data)
+                stats['bytes'] += len(data)
+                stats['rows'] += dump_index.count_rows(data, tail)
+                # reads of sampled sql may come up short
+                tail = (tail + data[-dump_index.TAIL_SIZE:])[-dump_index.TAIL_SIZE:]
+                if time.monotonic() - last_report >= self.REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    self.show_rates(label, "in progress", stats, last_report - start)
+                    self.show_progress(label, done, total, last_report - start)
+            write_start = time.monotonic()
+            if deferrer:
+                mysql.stdin.write(deferrer.finish())
+            mysql.stdin.close()
+            # closing our end doesn't wait for mysql to finish, but it has to finish sometime
+            mysql.wait()
+            stats['load_time'] += time.monotonic() - write_start
+        except BrokenPipeError:
+            # mysql bailed; its complaint will have been displayed already
+            pass
+        mysql.wait()
+        watcher.join()
+        return mysql.returncode, errors
+
+    def import_file(self, path, dbname, stats=None, sampler=None):
+        '''
+        import the sql in one file into the specified db, adding the bytes and rows
+        imported and the time spent waiting on each side to stats, passing it through
+        the sampler if there is one; return True on success, False on failure
+        '''
+        if stats is None:
+            stats = self.new_stats()
+        label = os.path.basename(path)
+        wall_start = time.time()
+        before = dict(stats)
+        index = self.get_index(path)
+        reader = dump_index.DumpReader(path).open()
+        source = sampler.open(reader) if sampler else reader
+        returncode, errors = self.load(label, source, dbname, stats,
+                                       index.get_size() if index else None)
+        read_error = reader.close(stop=bool(returncode))
+        if read_error:
+            errors.append(read_error)
+        stats['decompress_time'] += reader.read_time
+        trace('import file', wall_start, wiki=dbname, file=label, bulk=self.bulk,
+              bytes=stats['bytes'] - before['bytes'], rows=stats['rows'] - before['rows'],
+              decompressor=reader.describe(),
+              decompress_time=stats['decompress_time'] - before['decompress_time'],
+              load_time=stats['load_time'] - before['load_time'],
+              failed=bool(read_error or returncode))
+        if read_error or returncode:
+            print("failed to import data:", path, "(", "; ".join(errors) or "Unknown error", ")")
+            return False
+        return True
+
+    def load_table(self, dbname, table, path, previous=None, total=None):
+        '''
+        load the sql for one table from the file split out for it, then remove
+        the file; if there was an earlier piece of the same table, wait for it
+        to be loaded first, since it has the CREATE TABLE. total is the size of
+        the file, if known. return the stats and time taken, and whether it succeeded
+        '''
+        if previous:
+            previous.result()
+        label = "{wiki}.{table}".format(wiki=dbname, table=table)
+        stats = self.new_stats()
+        wall_start = time.time()
+        start = time.monotonic()
+        try:
+            with open(path, "rb") as fhandle:
+                returncode, errors = self.load(label, fhandle, dbname, stats, total)
+        finally:
+            os.unlink(path)
+        trace('import table', wall_start, wiki=dbname, table=table, bulk=self.bulk,
+              bytes=stats['bytes'], rows=stats['rows'], failed=bool(returncode))
+        if returncode:
+            print("failed to import table:", label, "(", "; ".join(errors) or "Unknown error",
+                  ")")
+        return stats, time.monotonic() - start, not returncode
+
+    def import_wiki_tables(self, dbname, paths, stats, sampler=None):
+        '''
+        import the files for one wiki a table at a time: each file is read once,
+        passed through the sampler if there is one, and split into a file per
+        table, and each table is loaded over its own connection as soon as it
+        has been split out, with up to table_workers tables loading at once.
+        add the bytes and rows imported to stats, show the rates for each
+        table, and return the list of files that failed
+        '''
+        scratchdir = tempfile.mkdtemp(prefix=dbname + ".tables.")
+        failed = []
+        # future -> (file the table came from, table)
+        loads = {}
+        # table -> future for the last piece of it
+        latest = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.table_workers) as executor:
+                for path in paths:
+                    reader = dump_index.DumpReader(path).open()
+                    splitter = TableSplitter(scratchdir, os.path.basename(path))
+                    index = self.get_index(path)
+                    source = sampler.open(reader) if sampler else reader
+                    for piece, (table, tablepath) in enumerate(splitter.split(source)):
+                        total = None
+                        if index and piece < len(index.entries['tables']):
+                            total = (index.entries['tables'][piece]['bytes'] +
+                                     index.get_preamble_size())
+                        future = executor.submit(self.load_table, dbname, table, tablepath,
+                                                 latest.get(table), total)
+                        latest[table] = future
+                        loads[future] = (path, table)
+                    read_error = reader.close()
+                    stats['decompress_time'] += reader.read_time
+                    if read_error:
+                        print("failed to read data:", path, "(", read_error, ")")
+                        failed.append(path)
+                results = []
+                for future, (path, table) in loads.items():
+                    table_stats, elapsed, succeeded = future.result()
+                    stats['bytes'] += table_stats['bytes']
+                    stats['rows'] += table_stats['rows']
+                    stats['load_time'] += table_stats['load_time']
+                    results.append((elapsed, table, table_stats))
+                    if not succeeded and path not in failed:
+                        failed.append(path)
+        finally:
+            shutil.rmtree(scratchdir, ignore_errors=True)
+        # slowest first, since those are the ones that decide how long the wiki takes
+        for elapsed, table, table_stats in sorted(results, key=lambda entry: -entry[0]):
+            self.show_rates("{wiki}.{table}".format(wiki=dbname, table=table), "loaded",
+                            table_stats, elapsed)
+        return failed
+
+    def import_wiki(self, dbname, paths):
+        '''import each of the files for one wiki in turn; return the list of files that failed'''
+        stats = self.new_stats()
+        start = time.monotonic()
+        # the one sampler for all the files, so rows are matched up across them
+        sampler = DumpSampler(self.sample) if self.sample else None
+        if self.table_workers:
+            failed = self.import_wiki_tables(dbname, paths, stats, sampler)
+        else:
+            failed = [path for path in paths
+                      if not self.import_file(path, dbname, stats, sampler)]
+        self.show_rates(dbname, "failed" if failed else "imported", stats,
+                        time.monotonic() - start)
+        self.show_waits(dbname, stats)
+        return failed
+
+    def run(self, importdir, wikis):
+        '''
+        import the <wikidb>.anythinghere.sql files, compressed or not, in the specified
+        directory for the given wikis, and return the list of files that failed
+        '''
+        files_by_wiki = {}
+        # suffix -> what decompresses files with it
+        readers = {}
+        unreadable = []
+        for sql_file in dump_index.find_import_files(importdir):
             prefix = os.path.basename(sql_file).split('.')[0]
-            if prefix in wikis:
-                self.import_sql(sql_file, prefix, password)
+            if prefix not in wikis:
+                continue
+            try:
+                reader = dump_index.DumpReader(sql_file)
+            except ValueError as ex:
+                print("failed to import data:", sql_file, "(", ex, ")")
+                unreadable.append(sql_file)
+                continue
+            if reader.suffix != '.sql':
+                readers[reader.suffix] = reader.describe()
+            files_by_wiki.setdefault(prefix, []).append(sql_file)
+        if not files_by_wiki:
+            return unreadable
+        sizes = {}
+        indexed = True
+        for wiki, paths in files_by_wiki.items():
+            sizes[wiki] = 0
+            for path in paths:
+                index = self.get_index(path)
+                if index:
+                    sizes[wiki] += index.get_size()
+                else:
+                    # the compressed size will have to do for ordering
+                    indexed = False
+                    sizes[wiki] += os.stat(path).st_size
+        # biggest first; those are the ones that decide when we finish
+        wikis_in_order = sorted(files_by_wiki, key=lambda wiki: -sizes[wiki])
+        workers = min(self.workers, len(files_by_wiki))
+        print("importing {count} wikis with {workers} at a time".format(
+            count=len(files_by_wiki), workers=workers))
+        for suffix, tool in sorted(readers.items()):
+            print("decompressing {suffix} files with {tool}".format(suffix=suffix, tool=tool))
+        if indexed:
+            print("{size:.1f} MB of sql to import".format(size=sum(sizes.values()) / 1000000))
+        if self.sample:
+            print("importing only a sample of each wiki:", json.dumps(self.sample, sort_keys=True))
+        start = time.monotonic()
+        failed = unreadable
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(lambda wiki: self.import_wiki(wiki, files_by_wiki[wiki]),
+                                       wikis_in_order):
+                failed.extend(result)
+        print("imports done in {elapsed:.1f}s, {count} files failed".format(
+            elapsed=time.monotonic() - start, count=len(failed)))
+        return failed
+
+
+class TablespaceArchive():
+    '''
+    a physical copy of the tables of one wiki db, which loads much faster than
+    replaying its sql: the schema as written by mysqldump, and the InnoDB
+    tablespace (.ibd) and metadata (.cfg) files for each table, copied while
+    the tables were flushed for export, all in a tar file <wikidb>.tablespaces.tar.
+    a manifest in the archive says which server version it came from, since
+    tablespaces can only be imported into the same version. tables in other
+    engines (MyISAM or Aria, say, for searchindex) have no tablespace to copy,
+    so their rows go into the archive as sql instead
+
+    loading one creates the tables from the schema, throws away their empty
+    tablespaces, puts the copied files in their place and imports those, then
+    loads the rows of the other tables from their sql
+    '''
+    SUFFIX = '.tablespaces.tar'
+    MANIFEST = 'manifest.json'
+    SCHEMA = 'schema.sql'
+    OTHER_DATA = 'other-tables.sql'
+    MYSQLDUMP = "/usr/local/bin/mysqldump"
+
+    def __init__(self, mdb, password=None):
+        self.mdb = mdb
+        self.password = password
+
+    @staticmethod
+    def get_path(directory, wiki):
+        '''return the path of the archive for the wiki in the directory'''
+        return os.path.join(directory, wiki + TablespaceArchive.SUFFIX)
+
+    def get_version(self):
+        '''return the version of the running server'''
+        return self.mdb.do_query("SELECT VERSION()", self.password)[0][0]
+
+    def get_tables(self, wiki):
+        '''
+        return the names of the InnoDB tables in the wiki db, and of the tables
+        in any other engine
+        '''
+        rows = self.mdb.do_query(
+            "SELECT TABLE_NAME, ENGINE FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = '{wiki}' AND TABLE_TYPE = 'BASE TABLE' "
+            "ORDER BY TABLE_NAME".format(wiki=wiki), self.password)
+        return ([row[0] for row in rows if row[1] == 'InnoDB'],
+                [row[0] for row in rows if row[1] != 'InnoDB'])
+
+    def run_mysqldump(self, wiki, path, options, tables=None):
+        '''
+        write the output of mysqldump of the wiki db, or only the given tables
+        of it, with the given options to the file
+        '''
+        env = os.environ.copy()
+        if self.password:
+            env['MYSQL_PWD'] = self.password
+        with open(path, "wb") as fhandle:
+            subprocess.run([self.MYSQLDUMP, "-u", "root", "--socket=" + self.mdb.sockname,
+                            "--skip-triggers"] + options + [wiki] + (tables or []),
+                           stdout=fhandle, env=env, check=True)
+
+    def dump_schema(self, wiki, path):
+        '''write the CREATE TABLE statements for the wiki db to the file'''
+        self.run_mysqldump(wiki, path, ["--no-data"])
+
+    def dump_other_tables(self, wiki, tables, path):
+        '''write the rows of the given tables of the wiki db to the file as sql'''
+        self.run_mysqldump(wiki, path, ["--no-create-info"], tables)
+
+    def export(self, wiki, outdir):
+        '''write the archive for the wiki db into the directory and return its path'''
+        tables, others = self.get_tables(wiki)
+        scratchdir = tempfile.mkdtemp(prefix=wiki + ".export.")
+        try:
+            self.dump_schema(wiki, os.path.join(scratchdir, self.SCHEMA))
+            if others:
+                self.dump_other_tables(wiki, others, os.path.join(scratchdir, self.OTHER_DATA))
+            # the tables stay flushed and read locked until we unlock them on the
+            # same connection, so the files can't change while we copy them
+            self.mdb.do_query("FLUSH TABLES " + ", ".join(
+                "`{table}`".format(table=table) for table in tables) + " FOR EXPORT",
+                              self.password, wiki)
+            try:
+                for table in tables:
+                    for suffix in [".ibd", ".cfg"]:
+                        shutil.copy(os.path.join(self.mdb.datadir, wiki, table + suffix),
+                                    scratchdir)
+            finally:
+                self.mdb.do_query("UNLOCK TABLES", self.password, wiki)
+            with open(os.path.join(scratchdir, self.MANIFEST), "w") as fhandle:
+                json.dump({'wiki': wiki, 'version': self.get_version(), 'tables': tables,
+                           'other_tables': others}, fhandle)
+            os.makedirs(outdir, exist_ok=True)
+            path = self.get_path(outdir, wiki)
+            with tarfile.open(path, "w") as tar:
+                for name in sorted(os.listdir(scratchdir)):
+                    tar.add(os.path.join(scratchdir, name), arcname=name)
+        finally:
+            shutil.rmtree(scratchdir, ignore_errors=True)
+        return path
+
+    def load(self, wiki, path, importer):
+        '''
+        load the archive into the wiki db, which should exist and be empty,
+        using the sql importer for the schema; raise ValueError if the archive
+        can't be used here, and MySQLdb.Error or OSError if loading it fails
+        '''
+        scratchdir = tempfile.mkdtemp(prefix=wiki + ".tablespaces.")
+        try:
+            with tarfile.open(path, "r") as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(scratchdir, filter='data')
+                else:
+                    tar.extractall(scratchdir)
+            with open(os.path.join(scratchdir, self.MANIFEST), "r") as fhandle:
+                manifest = json.load(fhandle)
+            version = self.get_version()
+            if manifest['version'] != version:
+                raise ValueError("made by server version {theirs}, this is {ours}".format(
+                    theirs=manifest['version'], ours=version))
+            with open(os.path.join(scratchdir, self.SCHEMA), "rb") as fhandle:
+                returncode, errors = importer.load(wiki, fhandle, wiki, importer.new_stats())
+            if returncode:
+                raise ValueError("schema failed to load: " + "; ".join(errors))
+            tables = manifest['tables']
+            self.mdb.do_queries(["SET SESSION foreign_key_checks=0"] + [
+                "ALTER TABLE `{table}` DISCARD TABLESPACE".format(table=table)
+                for table in tables], self.password, wiki)
+            for table in tables:
+                for suffix in [".ibd", ".cfg"]:
+                    dest = os.path.join(self.mdb.datadir, wiki, table + suffix)
+                    shutil.move(os.path.join(scratchdir, table + suffix), dest)
+                    shutil.chown(dest, "mysql", "mysql")
+            self.mdb.do_queries(["ALTER TABLE `{table}` IMPORT TABLESPACE".format(table=table)
+                                 for table in tables], self.password, wiki)
+            # the .cfg files are only needed for the import
+            for table in tables:
+                os.unlink(os.path.join(self.mdb.datadir, wiki, table + ".cfg"))
+            others = manifest.get('other_tables') or []
+            if others:
+                with open(os.path.join(scratchdir, self.OTHER_DATA), "rb") as fhandle:
+                    returncode, errors = importer.load(wiki, fhandle, wiki, importer.new_stats())
+                if returncode:
+                    raise ValueError("rows of {tables} failed to load: {errors}".format(
+                        tables=", ".join(others), errors="; ".join(errors)))
+        finally:
+            shutil.rmtree(scratchdir, ignore_errors=True)
+        return len(tables) + len(others)
 
 
 class Httpd():
@@ -469,6 +1610,10 @@ class Credentials():
     '''
     manage passwords for container access, db access
     '''
+    # run by the db server every time it starts, to set the set's db credentials
+    DB_INIT_FILE = '/etc/mysql-set-creds.sql'
+    MY_CNF = '/etc/my.cnf'
+
     def __init__(self, itype, setname, credspath):
         self.itype = itype
         self.setname = setname
@@ -491,70 +1636,80 @@ class Credentials():
                     error = result.stderr
                 print("failed to set container root creds (", error, ")")
 
-    def setup_db_user(self, dbuser, password, wiki, mdb):
+    @staticmethod
+    def get_db_user_queries(dbuser, password, wikis):
         '''
-        create a user and add the appropriate grants for access to a wiki db
+        return the queries to create a user and add the appropriate grants
+        for access to each of the wiki dbs
         '''
-        command = "CREATE USER '{dbuser}'@'%' IDENTIFIED BY '{passwd}';".format(
-            dbuser=dbuser, passwd=password)
-        mdb.do_query(command, self.creds['rootdbuser'])
-        command = "GRANT USAGE ON *.* TO `{dbuser}`@`%` IDENTIFIED BY '{passwd}';".format(
-            dbuser=dbuser, passwd=password)
-        mdb.do_query(command, self.creds['rootdbuser'])
-        command = ("GRANT SELECT, INSERT, UPDATE, DELETE, CREATE, DROP, REFERENCES, INDEX, " +
-                   "ALTER, CREATE TEMPORARY TABLES, LOCK TABLES, EXECUTE, CREATE VIEW, " +
-                   "SHOW VIEW, CREATE ROUTINE, ALTER ROUTINE, EVENT, TRIGGER ON " +
-                   "`{wiki}`.* TO `{dbuser}`@`%`;".format(wiki=wiki, dbuser=dbuser))
-        mdb.do_query(command, self.creds['rootdbuser'])
-
-    def set_db_creds(self, password=None, config_overrides=None):
+        queries = ["CREATE USER IF NOT EXISTS '{dbuser}'@'%' IDENTIFIED BY '{passwd}';".format(
+            dbuser=dbuser, passwd=password)]
+        for wiki in wikis:
+            queries.append(
+                "GRANT SELECT, INSERT, UPDATE, DELETE, CREATE, DROP, REFERENCES, INDEX, " +
+                "ALTER, CREATE TEMPORARY TABLES, LOCK TABLES, EXECUTE, CREATE VIEW, " +
+                "SHOW VIEW, CREATE ROUTINE, ALTER ROUTINE, EVENT, TRIGGER ON " +
+                "`{wiki}`.* TO `{dbuser}`@`%`;".format(wiki=wiki, dbuser=dbuser))
+        return queries
+
+    def set_db_creds(self):
         '''
         set root password but also wikidb_user and wikidb_admin passwords for the specified
-        wiki databases, as well as creating the dbs themselves (empty)
+        wiki databases, as well as creating the dbs themselves (empty) if need be
 
-        for testing config_overrides can specify another user, etc. for mysqld
+        the server is not started for this; the queries go into a file that the
+        server runs each time it starts, before it lets anyone connect, so the db
+        server is only ever started once during the build, for the db data image.
+        the queries can all be run again at each start without harm
         '''
         if self.itype != 'dbprimary':
             return
-        mdb = MariaDB("/run/mysqld/mysqld.sock", "/opt/wmf-mariadb104", "/srv/sqldata")
-        proc = mdb.start_server(password, config_overrides=config_overrides)
-        mdb.set_root_password(self.creds['rootdbuser'], password)
-
+        queries = ["SET PASSWORD FOR root@'localhost' = PASSWORD('{passwd}');".format(
+            passwd=self.creds['rootdbuser'])] + self.get_wikis_and_users_queries()
+        with open(self.DB_INIT_FILE, "w") as fhandle:
+            # one statement to a line, as the server wants them
+            fhandle.write("\n".join(query.rstrip(';') + ';' for query in queries) + "\n")
+        os.chmod(self.DB_INIT_FILE, 0o600)
+        shutil.chown(self.DB_INIT_FILE, "mysql", "mysql")
+        with open(self.MY_CNF, "a") as fhandle:
+            fhandle.write("\n[mysqld]\ninit_file = {path}\n".format(path=self.DB_INIT_FILE))
+
+    def get_wikis_and_users_queries(self):
+        '''
+        return the queries that create the (empty) wiki databases and the wikidb
+        users, on a server that has its root password set already
+        '''
         # set up wikidb users which will have access to every wikidb we're going to have in the set.
-        for wiki in self.creds['wikis']:
-            mdb.do_query("CREATE DATABASE IF NOT EXISTS " + wiki,
-                         self.creds['rootdbuser'])
-
-            for dbuser_entry in self.creds['wikidbusers']:
-                # dbuser_entry is {username: password}
-                if len(dbuser_entry) != 1:
-                    print("Bad db user entry in config file", dbuser_entry)
-                    # fixme this ought to be an exception I guess, meh
-                    sys.exit(1)
-                self.setup_db_user(list(dbuser_entry.keys())[0],
-                                   list(dbuser_entry.values())[0], wiki, mdb)
-
-        mdb.stop_server(self.creds['rootdbuser'], proc=proc)
-
-    def set_all(self, password=None, config_overrides=None):
+        queries = ["CREATE DATABASE IF NOT EXISTS " + wiki for wiki in self.creds['wikis']]
+        for dbuser_entry in self.creds['wikidbusers']:
+            # dbuser_entry is {username: password}
+            if len(dbuser_entry) != 1:
+                print("Bad db user entry in config file", dbuser_entry)
+                # fixme this ought to be an exception I guess, meh
+                sys.exit(1)
+            queries.extend(self.get_db_user_queries(list(dbuser_entry.keys())[0],
+                                                    list(dbuser_entry.values())[0],
+                                                    self.creds['wikis']))
+        return queries
+
+    def set_all(self):
         '''
         set up all credentials needed for any image type
         '''
         # some things get done on all images, some will check to be sure they are the
         # right image type first, we don't have to do any of that here
         self.set_container_root_creds()
-        self.set_db_creds(password, config_overrides)
+        self.set_db_creds()
 
 
 class FinalImage():
     '''
     manage setup of the base image for any image type
     '''
-    def __init__(self, itype, setname, credspath, first_db_root_pass=None):
+    def __init__(self, itype, setname, credspath):
         self.itype = itype
         self.setname = setname
         self.credspath = credspath
-        self.first_db_root_pass = first_db_root_pass
 
     def run(self):
         '''
@@ -563,13 +1718,83 @@ class FinalImage():
         '''
         ContainerSubs.do_all('/root/substitution.conf', '/root/container_list', self.setname)
         creds = Credentials(self.itype, "/root/credentials." + self.setname, self.credspath)
-        creds.set_all(self.first_db_root_pass)
+        # for db servers, the wikis were imported already, in the db data image
+        creds.set_all()
 
-        if self.itype == 'dbprimary':
-            mdb = MariaDB("/run/mysqld/mysqld.sock", "/opt/wmf-mariadb104", "/srv/sqldata")
-            proc = mdb.start_server(creds.creds['rootdbuser'])
-            mdb.do_all_imports('/root/imports', creds.creds['wikis'], creds.creds['rootdbuser'])
-            mdb.stop_server(creds.creds['rootdbuser'], proc=proc)
+
+class DataImage():
+    '''
+    manage setup of the db data image: the db server with the wikis imported
+    into it, shared by the final images of the db servers of all sets with
+    the same wikis and dumps
+    '''
+    def __init__(self, wikis, root_password, import_settings=None, sample=None):
+        self.wikis = wikis
+        self.root_password = root_password
+        self.import_settings = import_settings or {}
+        self.sample = sample
+
+    def run(self):
+        '''
+        starting from a freshly installed datadir, secure the server, set the root
+        password, create the wiki dbs and import them, then shut down, all with one
+        start of the server. if any import fails, exit non-zero once the server
+        is down, so that the build fails: the image is shared by every set with
+        the same key, and one with a wiki missing must never be tagged
+        '''
+        bulk = self.import_settings.get('bulk', True)
+        mdb = MariaDB("/run/mysqld/mysqld.sock", "/opt/wmf-mariadb104", "/srv/sqldata")
+        start = time.time()
+        # there is only the one start, so we leave the redo log size alone
+        proc = mdb.start_server(extra_options=(
+            mdb.get_bulk_load_options(resize_log=False) if bulk else None))
+        trace('db server start', start)
+        start = time.time()
+        mdb.make_server_secure()
+        mdb.set_root_password(self.root_password)
+        if self.wikis:
+            mdb.do_queries(["CREATE DATABASE IF NOT EXISTS " + wiki for wiki in self.wikis],
+                           self.root_password)
+        trace('db setup', start, wikis=len(self.wikis))
+        start = time.time()
+        failed = mdb.do_all_imports('/root/imports', self.wikis, self.root_password,
+                                    self.import_settings.get('workers'), bulk,
+                                    self.import_settings.get('table_workers'), self.sample)
+        trace('imports', start, wikis=len(self.wikis), bulk=bulk, sampled=bool(self.sample),
+              failed=len(failed))
+        start = time.time()
+        mdb.stop_server(self.root_password, proc=proc,
+                        fast=self.import_settings.get('fast_shutdown', False))
+        trace('db server stop', start)
+        if failed:
+            print("failed to import {files}, so there will be no db data image".format(
+                files=", ".join(failed)))
+            sys.exit(1)
+
+
+class DataExport():
+    '''
+    write tablespace archives of the wikis on the db server of a running dbprimary
+    container, for the host to copy out and use in place of their sql dumps
+    '''
+    EXPORT_DIR = '/root/exports'
+
+    def __init__(self, setname, credspath, wikis=None):
+        self.setname = setname
+        self.creds = Credentials('dbprimary', setname, credspath).creds
+        self.wikis = wikis or self.creds['wikis']
+
+    def run(self):
+        '''export each wiki, giving up at the first one that fails'''
+        mdb = MariaDB("/run/mysqld/mysqld.sock", "/opt/wmf-mariadb104", "/srv/sqldata")
+        archive = TablespaceArchive(mdb, self.creds['rootdbuser'])
+        for wiki in self.wikis:
+            start = time.time()
+            path = archive.export(wiki, self.EXPORT_DIR)
+            print("exported {wiki} to {path} ({size:.1f} MB) in {elapsed:.1f}s".format(
+                wiki=wiki, path=path, size=os.stat(path).st_size / 1000000,
+                elapsed=time.time() - start))
+        mdb.close_connection()
 
 
 class ContainerSubs():
@@ -637,9 +1862,16 @@ def do_main():
     args = opts.process_opts()
     if args['stage'] == 'base':
         manager = BaseImage(args['type'], args['set'], 'notverysecure')
+    elif args['stage'] == 'data':
+        manager = DataImage([wiki for wiki in args['wikis'].split(',') if wiki], 'notverysecure',
+                            yaml.safe_load(args['imports']) if args['imports'] else None,
+                            args['sample'])
     elif args['stage'] == 'final':
         credspath = "/root/credentials." + args['set'] + ".yaml"
-        manager = FinalImage(args['type'], args['set'], credspath, 'notverysecure')
+        manager = FinalImage(args['type'], args['set'], credspath)
+    elif args['stage'] == 'export':
+        manager = DataExport(args['set'], "/root/credentials." + args['set'] + ".yaml",
+                             [wiki for wiki in args['wikis'].split(',') if wiki])
     manager.run()
 
 
@@ -0,0 +1,412 @@
+#!/usr/bin/python3
+'''
+some benchmarks for the sql/xml dumps testbed
+
+unlike the unit tests, these need a running docker daemon and may take
+quite a while; they are run by hand when we want numbers to look at
+'''
+import getopt
+import gzip
+import io
+import os
+import pwd
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from docker import DockerClient
+import docker_dumps_tester
+from docker_helpers.setup_image import MariaDB, SqlImporter
+
+
+class BenchTimer():
+    '''run a callable some number of times and report on how long it took'''
+    def __init__(self, repeats):
+        self.repeats = repeats
+
+    def time_it(self, func):
+        '''
+        call the function repeatedly and return the median and the max
+        elapsed time for one call, in milliseconds
+        '''
+        timings = []
+        for _index in range(self.repeats):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings), max(timings)
+
+    @staticmethod
+    def show(label, timings):
+        '''display the timings for one benchmark step'''
+        print("{label}: median {median:.1f} ms, max {maximum:.1f} ms".format(
+            label=label.ljust(48), median=timings[0], maximum=timings[1]))
+
+
+class InventoryBench():
+    '''
+    seed the host with a pile of images and containers that aren't ours,
+    and compare listing and existence checks done by scanning everything
+    on the client side with the same done via label filters on the daemon
+    '''
+    SEED_LABEL = {'atgbench': 'seed'}
+
+    def __init__(self, count, repeats, verbose):
+        self.count = count
+        self.verbose = verbose
+        self.timer = BenchTimer(repeats)
+        self.client = DockerClient(base_url='unix://var/run/docker.sock')
+        self.labeler = docker_dumps_tester.ContainerLabels({'set': 'atgbench'})
+
+    def seed(self):
+        '''
+        build self.count tiny distinct images from scratch, and create (but
+        don't start) one container from each; none of them carry our blame label
+        '''
+        if self.verbose:
+            print("seeding {count} foreign images and containers".format(count=self.count))
+        for index in range(self.count):
+            dockerfile = 'FROM scratch\nLABEL atgbench=seed atgbench.index={index}\nCMD ["/none"]\n'
+            image, _logs = self.client.images.build(
+                fileobj=io.BytesIO(dockerfile.format(index=index).encode('utf-8')),
+                tag='atgbench/seed-{index}:latest'.format(index=index),
+                rm=True, labels=self.SEED_LABEL)
+            self.client.containers.create(image=image.id, labels=self.SEED_LABEL,
+                                          name='atgbench-seed-{index}'.format(index=index))
+
+    def cleanup(self):
+        '''get rid of everything we seeded'''
+        filters = {'label': self.labeler.get_label_filters(self.SEED_LABEL)}
+        for entry in self.client.containers.list(all=True, filters=filters):
+            entry.remove(force=True)
+        for entry in self.client.images.list(filters=filters):
+            self.client.images.remove(entry.id, force=True)
+
+    def scan_images(self):
+        '''the old way: fetch every image on the host and check labels here'''
+        return [entry for entry in self.client.images.list(all=True)
+                if self.labeler.has_blame_label(entry)]
+
+    def filter_images(self):
+        '''the new way: have the daemon hand us only our images'''
+        return self.client.images.list(filters={
+            'label': self.labeler.get_label_filters(self.labeler.get_blame_label()),
+            'dangling': False})
+
+    def scan_containers(self):
+        '''the old way: fetch every container on the host and check labels here'''
+        return [entry for entry in self.client.containers.list(all=True)
+                if self.labeler.has_labels(entry.labels, self.labeler.get_blame_label())]
+
+    def filter_containers(self):
+        '''the new way: have the daemon hand us only our containers'''
+        return self.client.containers.list(all=True, filters={
+            'label': self.labeler.get_label_filters(self.labeler.get_blame_label())})
+
+    def scan_image_exists(self, tag):
+        '''the old way: fetch every image on the host, look for the tag'''
+        for entry in self.client.images.list(all=True):
+            if self.labeler.has_blame_label(entry) and tag in entry.tags:
+                return True
+        return False
+
+    def filter_image_exists(self, tag):
+        '''the new way: ask the daemon for images with this reference and our label'''
+        return bool(self.client.images.list(name=tag, filters={
+            'label': self.labeler.get_label_filters(self.labeler.get_blame_label())}))
+
+    def run(self):
+        '''seed, time everything, clean up'''
+        self.seed()
+        try:
+            tag = 'wikimedia-dumps/base:latest'
+            self.timer.show("list images, client-side scan", self.timer.time_it(self.scan_images))
+            self.timer.show("list images, label filter", self.timer.time_it(self.filter_images))
+            self.timer.show("list containers, client-side scan",
+                            self.timer.time_it(self.scan_containers))
+            self.timer.show("list containers, label filter",
+                            self.timer.time_it(self.filter_containers))
+            self.timer.show("image exists, client-side scan",
+                            self.timer.time_it(lambda: self.scan_image_exists(tag)))
+            self.timer.show("image exists, reference and label filter",
+                            self.timer.time_it(lambda: self.filter_image_exists(tag)))
+            inventory = docker_dumps_tester.DockerInventory({'verbose': False})
+            self.timer.show("image exists, inventory load",
+                            self.timer.time_it(lambda: (inventory.invalidate(),
+                                                        inventory.get_image(tag))))
+            self.timer.show("image exists, inventory lookup",
+                            self.timer.time_it(lambda: inventory.get_image(tag)))
+        finally:
+            if self.verbose:
+                print("removing seeded images and containers")
+            self.cleanup()
+
+
+class ImportBench():
+    '''
+    import a generated sample dump into a scratch mariadb server on this host,
+    once with our usual server and session settings, once in bulk load mode,
+    and once in bulk load mode with the tables loaded side by side, and compare
+    the times
+    '''
+    WORKDIR = "bench_import_temp"
+    WIKI = "benchwiki"
+
+    def __init__(self, basedir, rows, tables, verbose):
+        self.basedir = basedir
+        self.rows = rows
+        self.tables = tables
+        self.verbose = verbose
+        self.workdir = os.path.join(os.getcwd(), self.WORKDIR)
+        self.datadir = os.path.join(self.workdir, "mysqldata")
+        self.mdb = MariaDB(os.path.join(self.workdir, "mysqld.sock"), basedir, self.datadir)
+        self.config_overrides = {'log_error': os.path.join(self.workdir, "mysqld.log"),
+                                 'pid_file': os.path.join(self.workdir, "mysqld.pid"),
+                                 'user': pwd.getpwuid(os.geteuid()).pw_name}
+
+    def write_dump(self, path):
+        '''
+        write a gzipped dump shaped like what mysqldump gives us for a page table,
+        with a few secondary indexes and extended inserts of 1000 rows each; the
+        rows are spread over as many copies of the table as we were asked for
+        '''
+        rand = random.Random(42)
+        with gzip.open(path, "wb", compresslevel=1) as fout:
+            for table in range(self.tables):
+                self.write_table(fout, "page" if not table else "page{num}".format(num=table),
+                                 self.rows // self.tables + (table < self.rows % self.tables),
+                                 rand)
+
+    @staticmethod
+    def write_table(fout, name, rows, rand):
+        '''write the schema and data for one page table to the open dump file'''
+        fout.write(b"""DROP TABLE IF EXISTS `page`;
+CREATE TABLE `page` (
+  `page_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `page_namespace` int(11) NOT NULL,
+  `page_title` varbinary(255) NOT NULL,
+  `page_touched` binary(14) NOT NULL,
+  `page_len` int(10) unsigned NOT NULL,
+  PRIMARY KEY (`page_id`),
+  UNIQUE KEY `name_title` (`page_namespace`,`page_title`),
+  KEY `page_len` (`page_len`),
+  KEY `page_touched` (`page_touched`)
+) ENGINE=InnoDB;
+""".replace(b"`page`", "`{name}`".format(name=name).encode('utf-8')))
+        for start in range(0, rows, 1000):
+            values = ["({pid},{nsp},'Title_{pid}_{rnd}','2020{rnd:010d}',{size})".format(
+                pid=pid + 1, nsp=pid % 16, rnd=rand.randrange(10000000000),
+                size=rand.randrange(100000))
+                      for pid in range(start, min(start + 1000, rows))]
+            fout.write("INSERT INTO `{name}` VALUES {values};\n".format(
+                name=name, values=",".join(values)).encode('utf-8'))
+
+    def install(self):
+        '''set up an empty datadir with the system tables in it'''
+        os.makedirs(self.datadir)
+        command = [os.path.join(self.basedir, "bin", "mysql_install_db"),
+                   "--basedir=" + self.basedir, "--datadir=" + self.datadir,
+                   "--auth-root-authentication-method=normal",
+                   "--user=" + self.config_overrides['user']]
+        subprocess.run(command, capture_output=True, check=True)
+
+    def time_import(self, dumppath, bulk, table_workers=None):
+        '''
+        start the server, import the dump into a fresh db, stop the server;
+        return the seconds taken
+        '''
+        proc = self.mdb.start_server(config_overrides=self.config_overrides, extra_options=(
+            self.mdb.get_bulk_load_options() if bulk else None))
+        try:
+            self.mdb.do_query("DROP DATABASE IF EXISTS " + self.WIKI)
+            self.mdb.do_query("CREATE DATABASE " + self.WIKI)
+            importer = SqlImporter(bulk=bulk, mysql=os.path.join(self.basedir, "bin", "mysql"),
+                                   socket=self.mdb.sockname, table_workers=table_workers)
+            start = time.perf_counter()
+            if importer.import_wiki(self.WIKI, [dumppath]):
+                raise RuntimeError("import of sample dump failed")
+            return time.perf_counter() - start
+        finally:
+            self.mdb.stop_server(proc=proc)
+
+    def run(self):
+        '''set up, time the imports, clean up'''
+        if os.path.exists(self.workdir):
+            shutil.rmtree(self.workdir)
+        try:
+            self.install()
+            dumppath = os.path.join(self.workdir, self.WIKI + ".page.sql.gz")
+            if self.verbose:
+                print("writing sample dump with {rows} rows in {tables} tables".format(
+                    rows=self.rows, tables=self.tables))
+            self.write_dump(dumppath)
+            usual = self.time_import(dumppath, bulk=False)
+            bulk = self.time_import(dumppath, bulk=True)
+            tables = self.time_import(dumppath, bulk=True, table_workers=self.tables)
+            print("import of {rows} rows, usual settings: {secs:.1f}s".format(
+                rows=self.rows, secs=usual))
+            print("import of {rows} rows, bulk load settings: {secs:.1f}s ({ratio:.1f}x)".format(
+                rows=self.rows, secs=bulk, ratio=usual / max(bulk, 0.001)))
+            print("import of {rows} rows, bulk load settings, {count} tables at once: "
+                  "{secs:.1f}s ({ratio:.1f}x)".format(
+                      rows=self.rows, count=self.tables, secs=tables,
+                      ratio=usual / max(tables, 0.001)))
+        finally:
+            if self.verbose:
+                print("removing scratch db server files")
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class ResetBench():
+    '''
+    with a set already started, time taking a snapshot of its db containers,
+    putting them back from it, and for comparison destroying them and
+    creating and starting them again from the final images
+    '''
+    def __init__(self, setname, configpath, repeats, verbose):
+        self.timer = BenchTimer(repeats)
+        self.verbose = verbose
+        self.args = docker_dumps_tester.DumpsTestbedOpts.get_default_opts()
+        self.args.update({'set': setname, 'config': configpath, 'verbose': verbose,
+                          'name': 'dbprimary', 'tag': 'atgbench'})
+        config = docker_dumps_tester.ContainerConfig(configpath, verbose)
+        labeler = docker_dumps_tester.ContainerLabels(self.args)
+        inventory = docker_dumps_tester.DockerInventory(self.args)
+        networks = docker_dumps_tester.Networks(self.args, config, labeler, inventory)
+        self.containers = docker_dumps_tester.Containers(self.args, config, labeler, networks,
+                                                         inventory)
+        self.snapshots = docker_dumps_tester.Snapshots(self.args, config, self.containers,
+                                                       inventory)
+
+    def recreate(self):
+        '''the old way: destroy the db server and create and start it again'''
+        self.containers.do_destroy()
+        self.containers.do_start()
+
+    def run(self):
+        '''snapshot, time everything, clean up'''
+        if not self.snapshots.get_db_containers():
+            sys.stderr.write("No db containers in set {setname}; start the set first\n".format(
+                setname=self.args['set']))
+            sys.exit(1)
+        try:
+            self.timer.show("snapshot", self.timer.time_it(self.snapshots.do_snapshot))
+            self.timer.show("reset to snapshot", self.timer.time_it(self.snapshots.do_reset))
+            self.timer.show("destroy, create and start", self.timer.time_it(self.recreate))
+        finally:
+            if self.verbose:
+                print("removing snapshot images")
+            self.snapshots.do_remove()
+
+
+class BenchOpts():
+    '''
+    deal with command line options for this script
+    '''
+    BENCHMARKS = ['inventory', 'imports', 'reset']
+
+    @staticmethod
+    def usage(message=None):
+        '''
+        display a nice usage message along with an optional message
+        describing an error
+        '''
+        if message:
+            sys.stderr.write(message + "\n")
+        usage_message = """Usage: $0 --bench <name> [--count <num>] [--repeats <num>]
+          [--rows <num>] [--tables <num>] [--basedir <path>] [--set <setname>]
+          [--config <path>] [--verbose]
+or: $0 --help
+
+Run one of the benchmarks for the dumps testbed and display the timings.
+
+Arguments:
+
+ --bench   (-b):  name of the benchmark to run, one of: {benchmarks}
+ --count   (-c):  number of foreign images and containers to seed the host with,
+                  for benchmarks that care
+                  default: 2000
+ --repeats (-r):  number of times to repeat each timed step
+                  default: 5
+ --rows    (-R):  number of rows in the sample dump, for the imports benchmark
+                  default: 1000000
+ --tables  (-t):  number of tables the rows in the sample dump are spread over, and
+                  the number loaded at once in the last run, for the imports benchmark
+                  default: 4
+ --basedir (-B):  base directory of the local mariadb install, for the imports benchmark
+                  default: /usr/local
+ --set     (-s):  name of a set that is already started, for the reset benchmark;
+                  its db containers will be destroyed and created again
+                  default: none
+ --config  (-C):  path to the testbed configuration file, for the reset benchmark
+                  default: none, the values in default.conf are used
+
+Flags:
+
+ --verbose (-v):  write some progress messages
+ --help    (-h):  show this help message
+""".format(benchmarks=', '.join(BenchOpts.BENCHMARKS))
+        sys.stderr.write(usage_message)
+        sys.exit(1)
+
+    def process_opts(self):
+        '''
+        get command-line args and values, falling back to defaults
+        where needed, whining about bad args
+        '''
+        try:
+            (options, remainder) = getopt.gnu_getopt(
+                sys.argv[1:], "b:c:r:R:t:B:s:C:vh",
+                ["bench=", "count=", "repeats=", "rows=", "tables=", "basedir=", "set=", "config=",
+                 "verbose", "help"])
+        except getopt.GetoptError as err:
+            self.usage("Unknown option specified: " + str(err))
+
+        args = {'bench': None, 'count': 2000, 'repeats': 5, 'rows': 1000000, 'tables': 4,
+                'basedir': '/usr/local', 'set': None, 'config': None, 'verbose': False}
+        for (opt, val) in options:
+            if opt in ["-b", "--bench"]:
+                args['bench'] = val
+            elif opt in ["-c", "--count"]:
+                args['count'] = int(val)
+            elif opt in ["-r", "--repeats"]:
+                args['repeats'] = int(val)
+            elif opt in ["-R", "--rows"]:
+                args['rows'] = int(val)
+            elif opt in ["-t", "--tables"]:
+                args['tables'] = int(val)
+            elif opt in ["-B", "--basedir"]:
+                args['basedir'] = val
+            elif opt in ["-s", "--set"]:
+                args['set'] = val
+            elif opt in ["-C", "--config"]:
+                args['config'] = val
+            elif opt in ["-v", "--verbose"]:
+                args['verbose'] = True
+            elif opt in ["-h", "--help"]:
+                self.usage('Help for this script\n')
+
+        if remainder:
+            self.usage("Unknown option(s) specified: {opt}".format(opt=remainder[0]))
+        if args['bench'] not in self.BENCHMARKS:
+            self.usage("A known benchmark must be specified with --bench")
+        if args['bench'] == 'reset' and not args['set']:
+            self.usage("The reset benchmark needs a started set specified with --set")
+        return args
+
+
+def do_main():
+    '''entry point'''
+    args = BenchOpts().process_opts()
+    if args['bench'] == 'inventory':
+        InventoryBench(args['count'], args['repeats'], args['verbose']).run()
+    elif args['bench'] == 'imports':
+        ImportBench(args['basedir'], args['rows'], args['tables'], args['verbose']).run()
+    elif args['bench'] == 'reset':
+        ResetBench(args['set'], args['config'], args['repeats'], args['verbose']).run()
+
+
+if __name__ == '__main__':
+    do_main()
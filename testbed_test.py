@@ -2,15 +2,28 @@
 '''
 some unit tests for the sql/xml dumps testbed
 '''
+import bz2
+import contextlib
+import functools
+import gzip
+import io
+import json
+import lzma
 import os
 import pwd
 import shutil
 import subprocess
+import tarfile
+import threading
+import time
 import unittest
+from unittest import mock
 import psutil
 import yaml
+import MySQLdb
 import docker_dumps_tester
-from docker_helpers.setup_image import MariaDB
+from docker_helpers.setup_image import MariaDB, IndexDeferrer, TableSplitter, DumpSampler, DataImage
+from docker_helpers import dump_index
 
 
 class MariaDBTest(unittest.TestCase):
@@ -145,8 +158,306 @@ class MariaDBTest(unittest.TestCase):
                             'user': current_user}
 
         proc = mdb.start_server(config_overrides=config_overrides)
+        self.assertEqual(len(mdb.startup_times), 1)
         mdb.stop_server(proc=proc)
 
+    def test_connection_reuse(self):
+        '''
+        start the db server, run a pile of queries over one reused connection
+        and then with a new connection for each, compare the times, and
+        make sure that errors are not swallowed
+        '''
+        basedir = self.get_mysqld_basedir()
+        if not basedir:
+            print("Skipping this test, no mysqld binaries available")
+            return
+
+        sockname = os.path.join(os.getcwd(), self.MYSQLTESTDIR, "mysqld.sock")
+        mdb = MariaDB(sockname, basedir, self.get_datadir())
+        config_overrides = {'log_error': self.get_logfile(),
+                            'pid_file': os.path.join(os.getcwd(), self.MYSQLTESTDIR, "mysql.pid"),
+                            'user': pwd.getpwuid(os.geteuid()).pw_name}
+        proc = mdb.start_server(config_overrides=config_overrides)
+        try:
+            count = 200
+            start = time.perf_counter()
+            for _index in range(count):
+                mdb.do_query("SELECT 1;")
+            reused = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _index in range(count):
+                mdb.close_connection()
+                mdb.do_query("SELECT 1;")
+            fresh = time.perf_counter() - start
+            print("{count} queries: {reused:.3f}s reusing a connection, "
+                  "{fresh:.3f}s connecting for each".format(count=count, reused=reused,
+                                                            fresh=fresh))
+            self.assertLess(reused, fresh)
+
+            self.assertEqual(mdb.do_queries(["CREATE DATABASE IF NOT EXISTS conntest",
+                                             "SELECT 2"]), ((2,),))
+            with self.assertRaises(MySQLdb.Error):
+                mdb.do_queries(["DROP DATABASE conntest", "DROP DATABASE conntest"])
+        finally:
+            mdb.stop_server(proc=proc)
+
+
+class SqlImporterTest(unittest.TestCase):
+    '''
+    test the bits of sql import that don't need a server
+    '''
+    def test_count_rows(self):
+        '''
+        rows in extended inserts should be counted, however the data is
+        split into pieces, even in the middle of a row marker
+        '''
+        data = (b"INSERT INTO `page` VALUES (1,'a'),(2,'b'),(3,'c');\n"
+                b"INSERT INTO `user` VALUES (1);\n")
+        self.assertEqual(dump_index.count_rows(data), 4)
+        for size in range(1, 20):
+            rows = 0
+            tail = b''
+            for start in range(0, len(data), size):
+                piece = data[start:start + size]
+                rows += dump_index.count_rows(piece, tail)
+                tail = (tail + piece[-dump_index.TAIL_SIZE:])[-dump_index.TAIL_SIZE:]
+            self.assertEqual(rows, 4)
+
+    def test_defer_indexes(self):
+        '''
+        secondary keys should come out of CREATE TABLE and be added at the end,
+        no matter how the stream is split up, and tables where that won't
+        work should be left alone
+        '''
+        sql = b"""CREATE TABLE `page` (
+  `page_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `page_title` varbinary(255) NOT NULL,
+  PRIMARY KEY (`page_id`),
+  UNIQUE KEY `page_title` (`page_title`),
+  FULLTEXT KEY `page_ft` (`page_title`)
+) ENGINE=InnoDB;
+INSERT INTO `page` VALUES (1,'a'),(2,'b');
+CREATE TABLE `log` (
+  `log_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  KEY `log_id` (`log_id`)
+) ENGINE=InnoDB;
+"""
+        expected = b"""CREATE TABLE `page` (
+  `page_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `page_title` varbinary(255) NOT NULL,
+  PRIMARY KEY (`page_id`),
+  FULLTEXT KEY `page_ft` (`page_title`)
+) ENGINE=InnoDB;
+INSERT INTO `page` VALUES (1,'a'),(2,'b');
+CREATE TABLE `log` (
+  `log_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  KEY `log_id` (`log_id`)
+) ENGINE=InnoDB;
+ALTER TABLE `page` ADD UNIQUE KEY `page_title` (`page_title`);
+"""
+        for size in [1, 5, 13, len(sql)]:
+            deferrer = IndexDeferrer()
+            output = b''.join(deferrer.feed(sql[index:index + size])
+                              for index in range(0, len(sql), size))
+            self.assertEqual(output + deferrer.finish(), expected)
+
+    def test_split_tables(self):
+        '''
+        each table should get its own file with the preamble, its schema and its
+        data, however the input is chunked, and each file should be handed back
+        as soon as the next table starts
+        '''
+        sql = b"""/*!40101 SET NAMES utf8mb4 */;
+DROP TABLE IF EXISTS `page`;
+CREATE TABLE `page` (
+  `page_id` int(10) unsigned NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `page` VALUES (1),(2);
+DROP TABLE IF EXISTS `text`;
+CREATE TABLE `text` (
+  `old_id` int(10) unsigned NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `text` VALUES (1);
+/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */"""
+        tempdir = os.path.join(os.getcwd(), "dump_test_temp")
+        os.makedirs(tempdir)
+        try:
+            for size in [1, 7, len(sql)]:
+                splitter = TableSplitter(tempdir, "wiki.sql.gz")
+                splitter.CHUNKSIZE = size
+                tables = []
+                for table, path in splitter.split(io.BytesIO(sql)):
+                    with open(path, "rb") as fhandle:
+                        tables.append((table, fhandle.read()))
+                    os.unlink(path)
+                start = sql.index(b"DROP TABLE IF EXISTS `text`")
+                self.assertEqual(tables, [
+                    ('page', sql[:start]),
+                    ('text', sql[:sql.index(b"DROP")] + sql[start:])])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_dump_index(self):
+        '''
+        the index should have the offset and counts for each table, be saved
+        next to the file, and be used again only for the same file contents
+        '''
+        sql = b"""/*!40101 SET NAMES utf8mb4 */;
+DROP TABLE IF EXISTS `page`;
+CREATE TABLE `page` (
+  `page_id` int(10) unsigned NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `page` VALUES (1),(2);
+INSERT INTO `text` VALUES (1);
+INSERT INTO `page` VALUES (3);
+"""
+        tempdir = os.path.join(os.getcwd(), "dump_test_temp")
+        os.makedirs(tempdir)
+        try:
+            path = os.path.join(tempdir, "wiki.sql.gz")
+            with gzip.open(path, "wb") as fhandle:
+                fhandle.write(sql)
+            index = dump_index.DumpIndex.get(path, "digest1")
+            text_start = sql.index(b"INSERT INTO `text`")
+            last_start = sql.index(b"INSERT INTO `page` VALUES (3)")
+            self.assertEqual(index.get_size(), len(sql))
+            self.assertEqual(index.entries['statements'], 6)
+            self.assertEqual(index.entries['rows'], 4)
+            self.assertEqual([(table['name'], table['offset'], table['bytes'], table['rows'])
+                              for table in index.entries['tables']],
+                             [('page', index.get_preamble_size(), text_start -
+                               index.get_preamble_size(), 2),
+                              ('text', text_start, last_start - text_start, 1),
+                              ('page', last_start, len(sql) - last_start, 1)])
+            self.assertEqual(index.get_preamble_size(), sql.index(b"DROP"))
+            self.assertEqual(dump_index.DumpIndex.load(path, "digest1").entries, index.entries)
+            self.assertIsNone(dump_index.DumpIndex.load(path, "digest2"))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_read_formats(self):
+        '''
+        import files in every format should be found and read back the same, with
+        the decompressor command or without it, and damage should be reported
+        '''
+        sql = b"INSERT INTO `page` VALUES (1,'a'),(2,'b');\n" * 1000
+        tempdir = os.path.join(os.getcwd(), "dump_test_temp")
+        os.makedirs(tempdir)
+        try:
+            writers = {'.sql': open, '.sql.gz': gzip.open, '.sql.bz2': bz2.open,
+                       '.sql.xz': lzma.open}
+            for suffix, opener in writers.items():
+                with opener(os.path.join(tempdir, "wiki.pages" + suffix), "wb") as fhandle:
+                    fhandle.write(sql)
+            with open(os.path.join(tempdir, "wiki.pages.sql.gz.index.json"), "w") as fhandle:
+                fhandle.write("{}")
+            paths = dump_index.find_import_files(tempdir)
+            self.assertEqual([os.path.basename(path) for path in paths],
+                             ["wiki.pages.sql", "wiki.pages.sql.bz2", "wiki.pages.sql.gz",
+                              "wiki.pages.sql.xz"])
+            for path in paths:
+                for use_command in [True, False]:
+                    reader = dump_index.DumpReader(path)
+                    if not use_command:
+                        reader.command = None
+                    reader.open()
+                    data = b''.join(iter(lambda: reader.read(1000), b''))
+                    self.assertIsNone(reader.close())
+                    self.assertEqual(data, sql)
+            path = os.path.join(tempdir, "wiki.pages.sql.gz")
+            with open(path, "r+b") as fhandle:
+                fhandle.truncate(100)
+            reader = dump_index.DumpReader(path)
+            reader.command = None
+            reader.open()
+            while reader.read(1000):
+                pass
+            self.assertIsNotNone(reader.close())
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_sample(self):
+        '''
+        only rows that go with the pages picked should be kept, tables that come
+        before the ones they are matched against in mysqldump's alphabetical order,
+        links before pages and content before slots, should wait for them, and
+        tables not tied to pages should be left alone
+        '''
+        sql = b"""CREATE TABLE `categorylinks` (
+  `cl_from` int(10) unsigned NOT NULL,
+  `cl_to` varbinary(255) NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `categorylinks` VALUES (1,'Cats'),(2,'Dogs'),(1,'Pets');
+CREATE TABLE `content` (
+  `content_id` bigint(20) unsigned NOT NULL,
+  `content_address` varbinary(255) NOT NULL
+) ENGINE=InnoDB;
+LOCK TABLES `content` WRITE;
+INSERT INTO `content` VALUES (10,'tt:100'),(20,'tt:200');
+UNLOCK TABLES;
+CREATE TABLE `page` (
+  `page_id` int(10) unsigned NOT NULL,
+  `page_title` varbinary(255) NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `page` VALUES (1,'A (b), c'),(2,'it\\'s');
+CREATE TABLE `revision` (
+  `rev_id` int(10) unsigned NOT NULL,
+  `rev_page` int(10) unsigned NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `revision` VALUES (5,1),(6,2);
+CREATE TABLE `site_stats` (
+  `ss_row_id` int(10) unsigned NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `site_stats` VALUES (1);
+CREATE TABLE `slots` (
+  `slot_revision_id` bigint(20) unsigned NOT NULL,
+  `slot_content_id` bigint(20) unsigned NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `slots` VALUES (5,10),(6,20);
+CREATE TABLE `text` (
+  `old_id` int(10) unsigned NOT NULL,
+  `old_text` mediumblob NOT NULL
+) ENGINE=InnoDB;
+INSERT INTO `text` VALUES (100,'one'),(200,'two');
+"""
+        output = DumpSampler({'pages': 1}).open(io.BytesIO(sql)).read()
+        inserts = [line for line in output.split(b"\n") if line.startswith(b"INSERT")]
+        self.assertEqual(inserts, [
+            b"INSERT INTO `page` VALUES (1,'A (b), c');",
+            b"INSERT INTO `categorylinks` VALUES (1,'Cats'),(1,'Pets');",
+            b"INSERT INTO `revision` VALUES (5,1);",
+            b"INSERT INTO `site_stats` VALUES (1);",
+            b"INSERT INTO `slots` VALUES (5,10);",
+            b"INSERT INTO `content` VALUES (10,'tt:100');",
+            b"INSERT INTO `text` VALUES (100,'one');"])
+        # the content table goes out in one piece, lock and all
+        self.assertIn(b"LOCK TABLES `content` WRITE;\nINSERT INTO `content` VALUES (10,'tt:100');"
+                      b"\nUNLOCK TABLES;\n", output)
+        self.assertEqual(output.count(b"CREATE TABLE"), 7)
+        output = DumpSampler({'tables': ['page']}).open(io.BytesIO(sql)).read()
+        self.assertEqual([line for line in output.split(b"\n") if line.startswith(b"INSERT")],
+                         [b"INSERT INTO `page` VALUES (1,'A (b), c'),(2,'it\\'s');"])
+
+
+    def test_failed_import(self):
+        '''
+        the data stage should fail if any wiki fails to import, after shutting
+        the server down, so that no shared image is made with a wiki missing
+        '''
+        with mock.patch('docker_helpers.setup_image.MariaDB') as mariadb, \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            mdb = mariadb.return_value
+            mdb.do_all_imports.return_value = ['/root/imports/elwikivoyage.sql.gz']
+            with self.assertRaises(SystemExit) as context:
+                DataImage(['elwikivoyage'], 'notverysecure').run()
+            self.assertEqual(context.exception.code, 1)
+            mdb.stop_server.assert_called_once()
+            self.assertIn("failed to import /root/imports/elwikivoyage.sql.gz", output.getvalue())
+
+            mdb.do_all_imports.return_value = []
+            DataImage(['elwikivoyage'], 'notverysecure').run()
+
 
 class CredentialsTest(unittest.TestCase):
     '''
@@ -216,5 +527,467 @@ wikis:
             shutil.rmtree(tempfilesdir)
 
 
+class BuildSchedulerTest(unittest.TestCase):
+    '''
+    test ordering and failure handling of parallel image builds
+    '''
+    @staticmethod
+    def get_targets():
+        '''a small dependency graph shaped like our real one'''
+        targets = [docker_dumps_tester.BuildTarget('base', 'basest', 'base', 'Dockerfile.base')]
+        for name in ['snapshot', 'httpd', 'dbprimary']:
+            targets.append(docker_dumps_tester.BuildTarget(
+                name, 'base', name + '-base', 'Dockerfile.' + name + '-base', parent='base'))
+            targets.append(docker_dumps_tester.BuildTarget(
+                name, 'final', name + '-final', 'Dockerfile.' + name + '-final',
+                parent=name + '-base'))
+        return targets
+
+    def test_build_order(self):
+        '''
+        every image should be built exactly once and only after its parent
+        '''
+        built = []
+
+        def builder(target):
+            built.append(target.tag)
+
+        scheduler = docker_dumps_tester.BuildScheduler(self.get_targets(), builder, 3, False)
+        scheduler.run()
+        self.assertEqual(sorted(built), sorted([target.tag for target in self.get_targets()]))
+        for target in self.get_targets():
+            if target.parent:
+                self.assertLess(built.index(target.parent), built.index(target.tag))
+
+    def test_build_failure(self):
+        '''
+        a failed build should be raised, and nothing built from it should be attempted
+        '''
+        built = []
+
+        def builder(target):
+            if target.tag == 'httpd-base':
+                raise RuntimeError("no apache for you")
+            built.append(target.tag)
+
+        scheduler = docker_dumps_tester.BuildScheduler(self.get_targets(), builder, 1, False)
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+        self.assertNotIn('httpd-final', built)
+        self.assertEqual(scheduler.results['httpd-base'][0], 'FAILED')
+        self.assertEqual(scheduler.results['httpd-final'][0], 'not built')
+
+
+class TracerTest(unittest.TestCase):
+    '''
+    test recording and reporting of timed spans
+    '''
+    def test_spans(self):
+        '''
+        make sure spans are recorded only when enabled, that spans printed by a
+        build script are picked up, and that the chrome trace events come out right
+        '''
+        ticks = iter([0.0, 1.0, 10.0, 12.5, 20.0, 21.0])
+        tracer = docker_dumps_tester.Tracer(clock=lambda: next(ticks))
+        with tracer.span('build image', image='base'):
+            pass
+        self.assertEqual(tracer.spans, [])
+
+        tracer.enabled = True
+        with tracer.span('build image', image='base') as fields:
+            fields['bytes'] = 100
+        with self.assertRaises(ValueError):
+            with tracer.span('build image', image='other'):
+                raise ValueError("oops")
+        line = tracer.PREFIX + json.dumps({'name': 'import file', 'start': 11.0, 'end': 12.0,
+                                           'wiki': 'elwikivoyage'})
+        self.assertTrue(tracer.add_from_line(line, image='dbdata'))
+        self.assertFalse(tracer.add_from_line("Step 1/2 : FROM base"))
+
+        self.assertEqual(tracer.get_summary(), [('build image', 2, 3.5, 2.5),
+                                                ('import file', 1, 1.0, 1.0)])
+        events = [event for event in tracer.get_chrome_events() if event['ph'] == 'X']
+        self.assertEqual([(event['name'], event['ts'], event['dur']) for event in events],
+                         [('build image', 0, 2500000), ('import file', 1000000, 1000000),
+                          ('build image', 10000000, 1000000)])
+        self.assertEqual(events[0]['args'], {'image': 'base', 'bytes': 100})
+        self.assertEqual(events[1]['args'], {'image': 'dbdata', 'wiki': 'elwikivoyage'})
+        self.assertEqual(events[2]['args'], {'image': 'other', 'failed': True})
+
+
+class BuildLogTest(unittest.TestCase):
+    '''
+    test that streamed build output gets turned into per-step progress
+    '''
+    @staticmethod
+    def get_clock(times):
+        '''return a fake clock that hands out the given times in order'''
+        return iter(times).__next__
+
+    def test_steps(self):
+        '''
+        steps should be timed, cache hits noticed, and the image id picked up
+        '''
+        chunks = [{'stream': 'Step 1/3 : FROM wikimedia-dumps/base:latest\n'},
+                  {'stream': ' ---> 0123456789ab\n'},
+                  {'stream': 'Step 2/3 : COPY setup_image.py /root/\n'},
+                  {'stream': ' ---> Using cache\n ---> ba9876543210\n'},
+                  {'stream': 'Step 3/3 : RUN /root/setup_image.py\n'},
+                  {'stream': 'setting up\n'},
+                  {'aux': {'ID': 'sha256:fedcba'}},
+                  {'stream': 'Successfully built fedcba\n'}]
+        buildlog = docker_dumps_tester.BuildLog(
+            'httpd-base', threading.Lock(), jsonlog=True,
+            clock=self.get_clock([0.0, 1.0, 1.5, 1.5, 1.6, 1.6, 31.6, 32.0]))
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(buildlog.consume(chunks), 'sha256:fedcba')
+        self.assertEqual([(step['step'], step['cached'], round(step['elapsed'], 3))
+                          for step in buildlog.steps],
+                         [(1, False, 0.5), (2, True, 0.1), (3, False, 30.0)])
+        events = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([event['event'] for event in events],
+                         ['step', 'step_done', 'step', 'step_done', 'step', 'step_done', 'done'])
+        self.assertTrue(all(event['image'] == 'httpd-base' for event in events))
+
+    def test_error(self):
+        '''an error from the daemon should be raised with the output so far'''
+        chunks = [{'stream': 'Step 1/2 : FROM wikimedia-dumps/base:latest\n'},
+                  {'stream': 'Step 2/2 : RUN false\n'},
+                  {'error': "The command '/bin/sh -c false' returned a non-zero code: 1"}]
+        buildlog = docker_dumps_tester.BuildLog('httpd-base', threading.Lock())
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(docker_dumps_tester.docker.errors.BuildError):
+                buildlog.consume(chunks)
+        self.assertEqual(len(buildlog.steps), 2)
+
+
+class SubnetAllocatorTest(unittest.TestCase):
+    '''
+    test picking subnets for set networks
+    '''
+    def test_pick(self):
+        '''
+        make sure we get the first aligned free block, skipping over used
+        subnets of any size and ignoring ones outside the pool
+        '''
+        allocator = docker_dumps_tester.SubnetAllocator()
+        self.assertEqual(str(allocator.pick([])), "172.16.0.0/24")
+        used = ["172.17.0.0/16", "172.16.0.0/24", "172.16.1.128/25", "192.168.0.0/16",
+                "fd00::/64"]
+        self.assertEqual(str(allocator.pick(used)), "172.16.2.0/24")
+        # a block taken out of the middle of a larger free range
+        self.assertEqual(str(allocator.pick(["172.16.0.0/23", "172.16.3.0/24"])),
+                         "172.16.2.0/24")
+
+        allocator = docker_dumps_tester.SubnetAllocator("10.10.0.0/22", 23)
+        self.assertEqual(str(allocator.pick(["10.10.1.0/24"])), "10.10.2.0/23")
+        self.assertIsNone(allocator.pick(["10.10.0.0/24", "10.10.3.0/24"]))
+        with self.assertRaises(ValueError):
+            docker_dumps_tester.SubnetAllocator("10.10.0.0/22", 20)
+
+
+class SetBatchTest(unittest.TestCase):
+    '''
+    test handling of commands for several sets at once
+    '''
+    def test_get_set_names(self):
+        '''
+        make sure we recognize lists of sets and expand them, and complain
+        about sets that aren't in the config
+        '''
+        config = docker_dumps_tester.ContainerConfig(None, False)
+        self.assertFalse(docker_dumps_tester.SetBatch.is_batch('defaultset'))
+        self.assertTrue(docker_dumps_tester.SetBatch.is_batch('all'))
+        self.assertTrue(docker_dumps_tester.SetBatch.is_batch('defaultset,'))
+        self.assertEqual(docker_dumps_tester.SetBatch.get_set_names('all', config),
+                         list(config.config['sets']))
+        self.assertEqual(docker_dumps_tester.SetBatch.get_set_names(
+            'defaultset, defaultset,', config), ['defaultset'])
+        with self.assertRaises(ValueError):
+            docker_dumps_tester.SetBatch.get_set_names('defaultset,nosuchset', config)
+
+
+class DataExportsTest(unittest.TestCase):
+    '''
+    test the parts of exporting wikis that don't need docker
+    '''
+    def test_get_wikis(self):
+        '''
+        all of the set's wikis should be exported unless some are named, and
+        wikis that aren't in the set should be refused
+        '''
+        config = docker_dumps_tester.ContainerConfig(None, False)
+        args = {'set': 'defaultset', 'wikis': None, 'verbose': False, 'dryrun': True}
+        exports = docker_dumps_tester.DataExports(args, config, None)
+        self.assertEqual(exports.get_wikis(), ['elwikivoyage'])
+        args['wikis'] = 'elwikivoyage,'
+        self.assertEqual(exports.get_wikis(), ['elwikivoyage'])
+        args['wikis'] = 'elwikivoyage,nosuchwiki'
+        with self.assertRaises(ValueError):
+            exports.get_wikis()
+
+
+class ContainerChannelTest(unittest.TestCase):
+    '''
+    test the parts of copying to and from containers that don't need docker
+    '''
+    def test_round_trip(self):
+        '''
+        a directory archived the way we send it to a container, and extracted
+        the way we get one back, a few bytes at a time, should come out the same
+        '''
+        tempdir = os.path.join(os.getcwd(), "dump_test_temp")
+        source = os.path.join(tempdir, "etc")
+        os.makedirs(os.path.join(source, "dblists"))
+        try:
+            with open(os.path.join(source, "dblists", "all.dblist"), "w") as fhandle:
+                fhandle.write("elwikivoyage\n" * 1000)
+            with open(os.path.join(source, "wikidump.conf"), "w") as fhandle:
+                fhandle.write("[wiki]\n")
+            channel = docker_dumps_tester.ContainerChannel
+            entries = channel.get_local_entries(source)
+            self.assertEqual([arcname for _path, arcname in entries],
+                             ["etc", "etc/dblists", "etc/wikidump.conf", "etc/dblists/all.dblist"])
+            archive = b''.join(docker_dumps_tester.BuildContext.stream_entries(entries))
+            dest = os.path.join(tempdir, "copy")
+            channel.extract((archive[i:i + 700] for i in range(0, len(archive), 700)), dest)
+            with open(os.path.join(dest, "etc", "dblists", "all.dblist"), "r") as fhandle:
+                self.assertEqual(fhandle.read(), "elwikivoyage\n" * 1000)
+            self.assertTrue(os.path.exists(os.path.join(dest, "etc", "wikidump.conf")))
+        finally:
+            shutil.rmtree(tempdir)
+
+        self.assertEqual(channel.split_path("snapshot-01:/srv/dumps"),
+                         ("snapshot-01", "/srv/dumps"))
+        self.assertEqual(channel.split_path("./local/a:b"), (None, "./local/a:b"))
+
+
+class DumpsTestRunnerTest(unittest.TestCase):
+    '''
+    test the parts of the test runner that don't need docker
+    '''
+    def test_resolve(self):
+        '''
+        make sure test specs from the command line are turned into the right
+        set and tests, and bad ones are refused
+        '''
+        config = docker_dumps_tester.ContainerConfig(None, False)
+        config.config['sets']['otherset'] = config.config['sets']['defaultset']
+        config.config['tests'] = {'defaultset': 'wikidata_batch_test',
+                                  'otherset': ['wikidata_batch_test', 'enwiki_test']}
+        config.config['testdefs'] = {'wikidata_batch_test': {'steps': [{'command': 'true'}]},
+                                     'enwiki_test': {'steps': [{'command': 'true'}]}}
+        resolve = docker_dumps_tester.DumpsTestRunner.resolve
+        self.assertEqual(resolve('enwiki_test', config), ('otherset', ['enwiki_test']))
+        self.assertEqual(resolve('defaultset:wikidata_batch_test', config),
+                         ('defaultset', ['wikidata_batch_test']))
+        self.assertEqual(resolve('otherset:all', config),
+                         ('otherset', ['wikidata_batch_test', 'enwiki_test']))
+        for testspec in ['wikidata_batch_test', 'defaultset:enwiki_test', 'nosuchset:all']:
+            with self.assertRaises(ValueError):
+                resolve(testspec, config)
+
+
+class SnapshotsTest(unittest.TestCase):
+    '''
+    test the parts of snapshots that don't need docker
+    '''
+    def test_copy_tree(self):
+        '''
+        the copy should end up with exactly what the source has, whatever
+        was in it before
+        '''
+        tempdir = os.path.join(os.getcwd(), "dump_test_temp")
+        source = os.path.join(tempdir, "runs")
+        dest = os.path.join(tempdir, "runs.snapshot-latest")
+        os.makedirs(os.path.join(source, "elwikivoyage", "20200101"))
+        try:
+            status_path = os.path.join(source, "elwikivoyage", "20200101", "status.txt")
+            with open(status_path, "w") as fhandle:
+                fhandle.write("done\n")
+            os.makedirs(os.path.join(dest, "enwiki"))
+            docker_dumps_tester.Snapshots.copy_tree(source, dest)
+            self.assertEqual(os.listdir(dest), ["elwikivoyage"])
+            with open(os.path.join(dest, "elwikivoyage", "20200101", "status.txt"), "r") as fhandle:
+                self.assertEqual(fhandle.read(), "done\n")
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_remove(self):
+        '''
+        removing the snapshots of a set should remove those of its db containers,
+        every tag, and leave alone those of a set whose name starts with its own
+        '''
+        class FakeImage():
+            '''just enough of a docker image'''
+            def __init__(self, tags):
+                self.tags = tags
+
+        class FakeInventory():
+            '''just enough of the docker inventory'''
+            def __init__(self, images):
+                self.images = images
+                self.removed = []
+
+            def get_images(self):
+                '''return all the images'''
+                return self.images
+
+            @staticmethod
+            def get_containers(_labels=None):
+                '''the containers may be gone, their snapshots are still there'''
+                return []
+
+            def remove_image(self, tag):
+                '''remember what got removed'''
+                self.removed.append(tag)
+
+        config = docker_dumps_tester.ContainerConfig(None, False)
+        args = {'set': 'defaultset', 'verbose': False, 'dryrun': False, 'tag': 'latest'}
+        inventory = FakeInventory([
+            FakeImage(['wikimedia-dumps/defaultset-dbprimary-snapshot:latest',
+                       'wikimedia-dumps/defaultset-dbprimary-snapshot:before']),
+            FakeImage(['wikimedia-dumps/defaultset-foo-dbprimary-snapshot:latest']),
+            FakeImage(['wikimedia-dumps/defaultset-dbprimary-final:latest'])])
+        containers = docker_dumps_tester.Containers(
+            args, config, docker_dumps_tester.ContainerLabels(args), None, inventory)
+        docker_dumps_tester.Snapshots(args, config, containers, inventory).do_remove()
+        self.assertEqual(inventory.removed,
+                         ['wikimedia-dumps/defaultset-dbprimary-snapshot:latest',
+                          'wikimedia-dumps/defaultset-dbprimary-snapshot:before'])
+
+
+class ParallelTasksTest(unittest.TestCase):
+    '''
+    test that per-container tasks all get run and failures get collected
+    '''
+    def test_failures_collected(self):
+        '''
+        one failure should not keep the rest of the tasks from running,
+        and should be raised at the end
+        '''
+        done = []
+
+        def good(name):
+            done.append(name)
+
+        def bad():
+            raise ValueError("container went away")
+
+        tasks = [(str(index), functools.partial(good, str(index))) for index in range(5)]
+        tasks.append(('broken', bad))
+        runner = docker_dumps_tester.ParallelTasks(3)
+        with self.assertRaises(RuntimeError):
+            runner.run("stop containers", tasks)
+        self.assertEqual(sorted(done), ['0', '1', '2', '3', '4'])
+        self.assertEqual(runner.results['broken'][0], 'FAILED')
+        self.assertEqual(runner.results['3'][0], 'ok')
+
+
+class BuildContextTest(unittest.TestCase):
+    '''
+    test that build contexts get just the files the Dockerfile wants
+    '''
+    def test_copy_sources(self):
+        '''
+        COPY lines in both forms should be found, with build args filled in
+        '''
+        context = docker_dumps_tester.BuildContext(
+            "docker_helpers", "Dockerfile.dbprimary-final",
+            {'SETNAME': 'atg', 'DBDATA': 'wikimedia-dumps/dbdata:0123456789abcdef'})
+        self.assertEqual(context.get_copy_sources(),
+                         ['mariadb/substitution.conf', 'container_list.atg',
+                          'credentials.atg.yaml', 'setup_image.py', 'dump_index.py'])
+        self.assertEqual(context.get_parent_image(), 'wikimedia-dumps/dbdata:0123456789abcdef')
+        context = docker_dumps_tester.BuildContext(
+            "docker_helpers", "Dockerfile.dbdata",
+            {'DATAKEY': '0123456789abcdef', 'WIKIS': 'elwikivoyage'})
+        self.assertEqual(context.get_copy_sources(),
+                         ['setup_image.py', 'dump_index.py', 'mariadb/dbdata/0123456789abcdef'])
+
+    def test_stream(self):
+        '''
+        the tar stream should be readable and contain only what was asked for
+        '''
+        context = docker_dumps_tester.BuildContext("docker_helpers", "Dockerfile.phpfpm-final",
+                                                   {'SETNAME': 'atg'})
+        archive = tarfile.open(fileobj=io.BytesIO(b''.join(context.stream())))
+        self.assertEqual(archive.getnames(),
+                         ['Dockerfile.phpfpm-final', 'dump_index.py', 'httpd/html/404.php',
+                          'httpd/html/hello.php', 'httpd/html/invalidate-cache.php',
+                          'phpfpm/substitution.conf', 'setup_image.py'])
+
+    def test_manifest_changes(self):
+        '''
+        changing a file that is copied into the image should change the content
+        hash, and we should be able to say which file it was
+        '''
+        tempdir = os.path.join(os.getcwd(), "dump_test_temp")
+        os.makedirs(tempdir)
+        try:
+            with open(os.path.join(tempdir, "Dockerfile.test"), "w") as fhandle:
+                fhandle.write("FROM wikimedia-dumps/base:latest\nARG SETNAME\n"
+                              "COPY [\"conf.$SETNAME\", \"/root/\"]\n")
+            with open(os.path.join(tempdir, "conf.atg"), "w") as fhandle:
+                fhandle.write("some: setting\n")
+            digests = docker_dumps_tester.FileDigests(os.path.join(tempdir, "digests.json"))
+            context = docker_dumps_tester.BuildContext(tempdir, "Dockerfile.test",
+                                                       {'SETNAME': 'atg'})
+            self.assertEqual(context.get_parent_image(), "wikimedia-dumps/base:latest")
+            old_manifest = context.get_manifest("someid", digests)
+
+            # make sure the mtime changes even on filesystems with coarse timestamps
+            with open(os.path.join(tempdir, "conf.atg"), "w") as fhandle:
+                fhandle.write("some: other setting\n")
+            os.utime(os.path.join(tempdir, "conf.atg"), ns=(0, 0))
+            new_manifest = context.get_manifest("someid", digests)
+            self.assertNotEqual(docker_dumps_tester.BuildContext.get_digest(old_manifest),
+                                docker_dumps_tester.BuildContext.get_digest(new_manifest))
+            self.assertEqual(docker_dumps_tester.BuildContext.get_changes(
+                old_manifest, new_manifest), ['conf.atg'])
+            self.assertEqual(docker_dumps_tester.BuildContext.get_changes(
+                new_manifest, context.get_manifest("otherid", digests)), ['parent image'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_stage_dbdata(self):
+        '''
+        staging the import files for a db data image should link in just those
+        files, leave links already there alone, and the links should not go
+        into its manifest, since the key covers them
+        '''
+        tempdir = os.path.join(os.getcwd(), "dump_test_temp")
+        datadir = os.path.join(tempdir, "mariadb", "dbdata", "0123456789abcdef")
+        os.makedirs(datadir)
+        try:
+            with open(os.path.join(tempdir, "Dockerfile.test"), "w") as fhandle:
+                fhandle.write("FROM wikimedia-dumps/base:latest\nARG DATAKEY\n"
+                              "COPY [\"mariadb/dbdata/$DATAKEY\", \"/root/imports\"]\n")
+            for name in ["elwikivoyage.sql.gz", "tenwiki.sql.gz"]:
+                with open(os.path.join(tempdir, name), "wb") as fhandle:
+                    fhandle.write(b"sql for " + name.encode('utf-8'))
+            os.symlink("gone.sql.gz", os.path.join(datadir, "stale.sql.gz"))
+            os.symlink(os.path.join("..", "..", "..", "elwikivoyage.sql.gz"),
+                       os.path.join(datadir, "elwikivoyage.sql.gz"))
+            kept = os.lstat(os.path.join(datadir, "elwikivoyage.sql.gz")).st_ino
+            docker_dumps_tester.Images.stage_dbdata(datadir, [
+                ('elwikivoyage', os.path.join(tempdir, "elwikivoyage.sql.gz")),
+                ('tenwiki', os.path.join(tempdir, "tenwiki.sql.gz"))])
+            self.assertEqual(sorted(os.listdir(datadir)), ["elwikivoyage.sql.gz", "tenwiki.sql.gz"])
+            self.assertEqual(os.lstat(os.path.join(datadir, "elwikivoyage.sql.gz")).st_ino, kept)
+            with open(os.path.join(datadir, "tenwiki.sql.gz"), "rb") as fhandle:
+                self.assertEqual(fhandle.read(), b"sql for tenwiki.sql.gz")
+
+            digests = docker_dumps_tester.FileDigests(os.path.join(tempdir, "digests.json"))
+            context = docker_dumps_tester.BuildContext(tempdir, "Dockerfile.test",
+                                                       {'DATAKEY': '0123456789abcdef'},
+                                                       unhashed=["mariadb/dbdata"])
+            self.assertEqual(len(context.get_entries()), 4)
+            self.assertEqual(list(context.get_manifest("someid", digests)['files']),
+                             ["Dockerfile.test"])
+        finally:
+            shutil.rmtree(tempdir)
+
+
 if __name__ == '__main__':
     unittest.main()